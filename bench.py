@@ -0,0 +1,321 @@
+"""Офлайн-бенчмарк бота без сети.
+
+Гоняет синтетические обновления через настоящий dp из bot.py, а вместо
+Bot API подставляет локальную сессию, которая сразу отвечает успехом.
+База создаётся во временной папке. Для каждого сценария выводятся
+пропускная способность, p50/p99 задержки и число операций с БД.
+
+Запуск:
+    python bench.py                          # все сценарии
+    python bench.py registration tickets     # только выбранные
+    python bench.py --users 5000 --audience 10000 --api-latency 20 --json result.json
+"""
+import argparse
+import asyncio
+import datetime
+import itertools
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+
+SCENARIOS = ("registration", "returning_start", "tickets", "users", "stats", "broadcast")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Офлайн-бенчмарк бота")
+    parser.add_argument("scenarios", nargs="*", metavar="scenario",
+                        help=f"сценарии: {', '.join(SCENARIOS)} (по умолчанию все)")
+    parser.add_argument("--users", type=int, default=1000, help="сотрудников в сценариях диалога")
+    parser.add_argument("--audience", type=int, default=10000, help="сотрудников, добавляемых перед рассылкой")
+    parser.add_argument("--repeat", type=int, default=200, help="повторов команд админа")
+    parser.add_argument("--concurrency", type=int, default=50, help="одновременных диалогов")
+    parser.add_argument("--api-latency", type=float, default=0.0, help="задержка ответа Bot API, мс")
+    parser.add_argument("--telegram-rate", type=float, default=0.0,
+                        help="лимит отправки в секунду (0 — без лимитов Telegram)")
+    parser.add_argument("--json", help="записать результаты в файл")
+    parsed = parser.parse_args()
+    unknown = set(parsed.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"неизвестные сценарии: {', '.join(sorted(unknown))}")
+    parsed.scenarios = parsed.scenarios or list(SCENARIOS)
+    return parsed
+
+
+args = None  # заполняется в __main__
+app = None  # создаётся в main
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from aiogram.client.session.base import BaseSession  # noqa: E402
+from aiogram.types import Chat, Message, Update, User  # noqa: E402
+
+import bot  # noqa: E402
+
+logging.getLogger().setLevel(logging.WARNING)
+
+
+def create_app(api_latency=0.0, speed=None):
+    """Новый экземпляр бота с временной базой и поддельным Bot API.
+
+    Обновления идут плотнее, чем пишут живые люди, поэтому защита от флуда
+    и кулдауны сжимаются в speed раз; speed=None (без пауз) — отключаются.
+    """
+    db_path = os.path.join(tempfile.mkdtemp(prefix="bot-bench-"), "bench.db")
+    app = bot.create_app(token="123456:BENCHMARK", db_path=db_path)
+    app.bot.session = FakeSession(api_latency)
+    app.bot.session.middleware(bot.ApiMetricsMiddleware(app.metrics))
+    flood = app.flood_control
+    if speed is None:
+        flood.rate = flood.burst = 1_000_000
+        flood.cooldown_scale = 0.0
+    else:
+        flood.rate *= speed
+        flood.cooldown_scale = 1 / speed
+    return app
+
+
+class FakeSession(BaseSession):
+    """Bot API без сети: каждый метод сразу (или через latency) успешен"""
+
+    def __init__(self, latency=0.0):
+        super().__init__()
+        self.latency = latency
+        self.message_ids = itertools.count(1)
+        self.sent = []  # (время, chat_id, текст) отправленных сообщений
+
+    async def make_request(self, bot_, method, timeout=None):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        name = method.__api_method__
+        if name in ("sendMessage", "editMessageText"):
+            self.sent.append((time.perf_counter(), method.chat_id, method.text))
+            return Message(
+                message_id=next(self.message_ids),
+                date=datetime.datetime.now(),
+                chat=Chat(id=method.chat_id, type="private"),
+                text=method.text
+            ).as_(bot_)
+        if name == "getMe":
+            return User(id=123456, is_bot=True, first_name="Bench")
+        return True
+
+    async def stream_content(self, *args, **kwargs):
+        yield b""
+
+    async def close(self):
+        pass
+
+
+class DbCounter:
+    """Считает обращения к db_engine (чтения и транзакции записи)"""
+
+    def __init__(self, engine):
+        self.reads = 0
+        self.writes = 0
+        read, write = engine.read, engine.write
+
+        async def counted_read(func, *a):
+            self.reads += 1
+            return await read(func, *a)
+
+        async def counted_write(func, *a):
+            self.writes += 1
+            return await write(func, *a)
+
+        engine.read, engine.write = counted_read, counted_write
+
+    def snapshot(self):
+        return self.reads, self.writes
+
+
+update_ids = itertools.count(1)
+
+
+def message_update(user_id, text):
+    return Update(update_id=next(update_ids), message=Message(
+        message_id=next(update_ids),
+        date=datetime.datetime.now(),
+        chat=Chat(id=user_id, type="private"),
+        from_user=User(id=user_id, is_bot=False, first_name="Bench"),
+        text=text
+    ))
+
+
+async def feed(user_id, text, samples):
+    started = time.perf_counter()
+    await app.dp.feed_update(app.bot, message_update(user_id, text))
+    samples.append(time.perf_counter() - started)
+
+
+async def run_dialogs(user_ids, script):
+    """Каждый сотрудник по очереди отправляет script, сотрудники — параллельно"""
+    samples = []
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def dialog(user_id):
+        async with semaphore:
+            for text in script(user_id):
+                await feed(user_id, text, samples)
+
+    await asyncio.gather(*(dialog(user_id) for user_id in user_ids))
+    return samples, len(samples)
+
+
+async def seed_users(user_ids):
+    """Быстро заводит сотрудников напрямую в БД (для сценариев, где регистрация не важна)"""
+    workplace = sorted(app.catalog.workplaces)[0]
+    await app.db_engine.executemany(
+        "INSERT OR IGNORE INTO users (user_id, name, workplace) VALUES (?, ?, ?)",
+        [(user_id, f"Сотрудник {user_id}", workplace) for user_id in user_ids]
+    )
+
+
+DIALOG_BASE = 1_000_000  # id сотрудников в сценариях диалога
+AUDIENCE_BASE = 2_000_000  # id получателей рассылки
+registered = False
+
+
+async def ensure_registered():
+    """Сотрудники диалогов зарегистрированы и находятся в главном меню"""
+    global registered
+    if not registered:
+        user_ids = range(DIALOG_BASE, DIALOG_BASE + args.users)
+        await seed_users(user_ids)
+        await run_dialogs(user_ids, lambda user_id: ["/start"])
+        registered = True
+
+
+async def scenario_registration():
+    global registered
+    workplace = sorted(app.catalog.workplaces)[0]
+    result = await run_dialogs(
+        range(DIALOG_BASE, DIALOG_BASE + args.users),
+        lambda user_id: ["/start", f"Сотрудник {user_id}", "✅ Да", workplace, "✅ Да"]
+    )
+    registered = True
+    return result
+
+
+async def scenario_returning_start():
+    await ensure_registered()
+    return await run_dialogs(range(DIALOG_BASE, DIALOG_BASE + args.users), lambda user_id: ["/start"])
+
+
+async def scenario_tickets():
+    await ensure_registered()
+    problem = sorted(app.catalog.problems)[0]
+    samples, count = await run_dialogs(
+        range(DIALOG_BASE, DIALOG_BASE + args.users),
+        lambda user_id: ["📝 Новая заявка", problem]
+    )
+    # Уведомления админу уходят в фоне — ждём, пока очередь заявок опустеет
+    while await app.db_engine.fetchone("SELECT 1 FROM tickets WHERE status IN ('pending', 'sending') LIMIT 1"):
+        await asyncio.sleep(0.05)
+    return samples, count
+
+
+async def scenario_admin_command(text):
+    await ensure_registered()
+    samples = []
+    for _ in range(args.repeat):
+        await feed(bot.ADMIN_ID, text, samples)
+    return samples, len(samples)
+
+
+async def scenario_broadcast():
+    """Время от /send до доставки каждому получателю"""
+    await seed_users(range(AUDIENCE_BASE, AUDIENCE_BASE + args.audience))
+    text = f"Бенчмарк рассылки {time.time()}"
+    session = app.bot.session
+    first_sent = len(session.sent)
+    started = time.perf_counter()
+    await app.dp.feed_update(app.bot, message_update(bot.ADMIN_ID, f"/send {text}"))
+    while app.broadcast_manager.jobs:
+        await asyncio.sleep(0.05)
+    samples = [
+        sent_at - started
+        for sent_at, _, sent_text in session.sent[first_sent:]
+        if sent_text.endswith(text)
+    ]
+    return samples, len(samples)
+
+
+RUNNERS = {
+    "registration": scenario_registration,
+    "returning_start": scenario_returning_start,
+    "tickets": scenario_tickets,
+    "users": lambda: scenario_admin_command("/users"),
+    "stats": lambda: scenario_admin_command("/stats"),
+    "broadcast": scenario_broadcast,
+}
+
+
+def write_json(path, data):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+
+
+def percentile(samples, q):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+async def main():
+    global app
+    app = create_app(args.api_latency / 1000)
+    # Лимитер общий для рассылок и заявок — настраиваем его на месте
+    if args.telegram_rate:
+        app.send_limiter.bucket = bot.TokenBucket(args.telegram_rate)
+    else:
+        app.send_limiter.bucket = bot.TokenBucket(1_000_000)
+        app.send_limiter.chat_interval = 0
+    counter = DbCounter(app.db_engine)
+    await app.start_services(metrics_port=0, record_path=None)
+
+    results = []
+    try:
+        for name in SCENARIOS:
+            if name not in args.scenarios:
+                continue
+            reads, writes = counter.snapshot()
+            started = time.perf_counter()
+            samples, count = await RUNNERS[name]()
+            elapsed = time.perf_counter() - started
+            # Отложенные записи (активность, FSM) — тоже цена сценария
+            await app.activity_buffer.flush()
+            await app.fsm_storage.flush()
+            db_reads = counter.reads - reads
+            db_writes = counter.writes - writes
+            results.append({
+                "scenario": name,
+                "operations": count,
+                "seconds": round(elapsed, 3),
+                "ops_per_second": round(count / elapsed, 1) if elapsed else 0.0,
+                "p50_ms": round(percentile(samples, 0.5) * 1000, 2),
+                "p99_ms": round(percentile(samples, 0.99) * 1000, 2),
+                "db_reads": db_reads,
+                "db_writes": db_writes,
+                "db_ops_per_operation": round((db_reads + db_writes) / count, 2) if count else 0.0,
+            })
+    finally:
+        await app.stop_services()
+
+    header = f"{'сценарий':<16}{'операций':>10}{'оп/с':>10}{'p50 мс':>10}{'p99 мс':>10}" \
+             f"{'чтений БД':>11}{'записей БД':>12}{'БД/оп':>8}"
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        print(f"{r['scenario']:<16}{r['operations']:>10}{r['ops_per_second']:>10}{r['p50_ms']:>10}"
+              f"{r['p99_ms']:>10}{r['db_reads']:>11}{r['db_writes']:>12}{r['db_ops_per_operation']:>8}")
+    if args.json:
+        await asyncio.to_thread(write_json, args.json, results)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    asyncio.run(main())
@@ -1,152 +1,3134 @@
 import asyncio
+import bisect
+import csv
+import datetime
+import functools
+import gzip
+import hashlib
+import hmac
+import html
+import inspect
+import json
 import sqlite3
 import logging
+import multiprocessing
 import os
-from aiogram import Bot, Dispatcher, types
-from aiogram.filters import Command
+import queue as queue_module
+import random
+import secrets
+import signal
+import string
+import sys
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from aiohttp import web
+from aiogram import BaseMiddleware, Bot, Dispatcher, Router, types
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.dispatcher.event.bases import UNHANDLED
+from aiogram.exceptions import (
+    DataNotDictLikeError,
+    TelegramAPIError,
+    TelegramBadRequest,
+    TelegramConflictError,
+    TelegramEntityTooLarge,
+    TelegramForbiddenError,
+    TelegramMigrateToChat,
+    TelegramNetworkError,
+    TelegramNotFound,
+    TelegramRetryAfter,
+    TelegramServerError,
+    TelegramUnauthorizedError
+)
+from aiogram.filters import Command, CommandObject
+from aiogram.filters.callback_data import CallbackData
 from aiogram.types import (
     ReplyKeyboardMarkup,
     KeyboardButton,
     ReplyKeyboardRemove,
-    ChatMemberUpdated
+    InlineKeyboardMarkup,
+    InlineKeyboardButton,
+    ChatMemberUpdated,
+    FSInputFile,
+    InputMediaAudio,
+    InputMediaDocument,
+    InputMediaPhoto,
+    InputMediaVideo
 )
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder
 from aiogram.utils.markdown import hbold
 
-# ===== ТВОИ НАСТРОЙКИ =====
-ADMIN_ID = 911966345  # Твой ID
-BOT_TOKEN = os.getenv('BOT_TOKEN')
+# ===== ТВОИ НАСТРОЙКИ =====
+ADMIN_ID = 911966345  # Твой ID
+BOT_TOKEN = os.getenv('BOT_TOKEN')
+
+# ===== НАСТРОЙКИ =====
+DB_PATH = os.getenv("DB_PATH", "users.db")
+DB_READERS = 4  # Потоков-читателей SQLite
+ACTIVITY_FLUSH_INTERVAL = 1.0  # Секунд между сбросами буфера активности
+ACTIVITY_BUFFER_SIZE = 500  # Сброс раньше срока, если набралось столько пользователей
+USER_CACHE_SIZE = 10000  # Профилей в кэше
+USER_CACHE_TTL = 300  # Секунд жизни записи кэша
+USERS_PAGE_SIZE = 20  # Сотрудников на странице /users
+EXPORT_CHUNK_SIZE = 1000  # Строк, читаемых с курсора за раз при /export
+IMPORT_BATCH_SIZE = 1000  # Строк в одной транзакции при /import
+IMPORT_MAX_SIZE = 20 * 1024 * 1024  # Больше файл бот скачать не может (лимит Bot API)
+IMPORT_SHOWN_ERRORS = 10  # Ошибок, перечисленных в отчёте /import
+FSM_FLUSH_INTERVAL = 0.5  # Секунд между сбросами состояний FSM в БД
+FSM_SESSION_TTL = 24 * 3600  # Через сколько секунд бездействия сессия удаляется
+FSM_IDLE_TTL = 1800  # Через сколько секунд бездействия сессия выгружается из памяти (в БД остаётся)
+FSM_MEMORY_LIMIT = 32 * 1024 * 1024  # Байт на сессии FSM в памяти; сверх — выгружаются самые старые
+FSM_EXPIRE_INTERVAL = 600  # Секунд между чистками устаревших сессий
+CATALOG_PATH = os.getenv("CATALOG_PATH", "catalog.json")  # Места работы и проблемы
+TELEGRAM_GLOBAL_RATE = 30  # Сообщений в секунду на весь бот (лимит Telegram)
+TELEGRAM_CHAT_INTERVAL = 1.0  # Секунд между сообщениями в один чат
+BROADCAST_CONCURRENCY = 25  # Одновременных запросов при рассылке
+BROADCAST_MAX_RETRIES = 3  # Повторов при сетевых ошибках
+BROADCAST_BATCH_SIZE = 100  # Получателей, захватываемых из БД за раз
+BROADCAST_PROGRESS_INTERVAL = 5.0  # Секунд между обновлениями статуса рассылки
+BROADCAST_HEADER = "📢 Уведомление от админа:\n\n"  # Заголовок перед текстом рассылки
+BROADCAST_TEXT_LIMIT = 4000  # Символов в сообщении рассылки с заголовком (лимит Telegram — 4096)
+BROADCAST_CAPTION_LIMIT = 1000  # Символов в подписи к файлу с заголовком (лимит Telegram — 1024)
+MEDIA_GROUP_WAIT = 1.0  # Секунд без новых частей альбома, после которых он считается полученным
+TICKET_BATCH_SIZE = 20  # Заявок, доставляемых админу одновременно
+TICKET_POLL_INTERVAL = 30.0  # Секунд между проверками очереди заявок
+TICKET_CLAIM_TIMEOUT = 60.0  # Через сколько секунд захваченная заявка снова доступна
+TICKET_RETRY_BASE = 5.0  # Первая пауза перед повтором доставки, секунд
+TICKET_RETRY_MAX = 600.0  # Максимальная пауза между повторами, секунд
+TICKET_GROUP_WINDOW = 300.0  # Секунд, пока заявки с одной проблемой собираются в одно сообщение
+TICKET_EDIT_INTERVAL = 3.0  # Секунд между обновлениями сводного сообщения
+TICKET_GROUP_SHOWN = 30  # Последних заявок, перечисленных в сводном сообщении
+TICKET_COOLDOWN = 60.0  # Секунд между заявками одного сотрудника
+TICKET_ACK_TIMEOUT = 900  # Секунд на «✅ Беру», потом заявка уходит другому админу
+TICKET_OPEN_TTL = 24 * 3600  # Сколько секунд незакрытая заявка считается нагрузкой админа
+ADMIN_REFRESH_INTERVAL = 30.0  # Секунд между перечитываниями админов и их нагрузки из БД
+FLOOD_RATE = 1.0  # Сообщений в секунду от одного пользователя (в среднем)
+FLOOD_BURST = 5  # Сообщений подряд без ограничения
+FLOOD_TRACKED_USERS = 10000  # Пользователей в таблице ограничений (давно писавшие вытесняются)
+MIGRATION_BATCH_SIZE = 5000  # Строк за одну транзакцию при переносе данных в миграциях
+
+# Адрес собственного сервера Bot API (по умолчанию — api.telegram.org)
+BOT_API_URL = os.getenv("BOT_API_URL")
+
+# Режим получения обновлений: polling (по умолчанию) или webhook
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # Публичный адрес, например https://bot.example.com
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")  # Если не задан — генерируется при запуске
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+UPDATE_WORKERS = 16  # Одновременно обрабатываемых обновлений
+UPDATE_QUEUE_SIZE = 1000  # Обновлений в очереди, дальше webhook отвечает 503
+UPDATE_DRAIN_TIMEOUT = 10.0  # Секунд на обработку очереди при остановке
+UPDATE_HANDLER_DEADLINE = 5.0  # Секунд, которые после этого даются уже начатым обработчикам
+BROADCAST_STOP_TIMEOUT = 5.0  # Секунд на уже начатые отправки рассылки при остановке
+# Секунд на плавную остановку процесса-обработчика, потом он убивается
+WORKER_STOP_TIMEOUT = UPDATE_DRAIN_TIMEOUT + UPDATE_HANDLER_DEADLINE + BROADCAST_STOP_TIMEOUT + 10
+POLLING_TIMEOUT = 30  # Секунд long polling в процессе приёма
+
+# Процессов-обработчиков; больше 1 — отдельный процесс приёма раздаёт им обновления
+BOT_WORKERS = int(os.getenv("BOT_WORKERS", "1"))
+# Рассылки и доставку заявок ведёт только обработчик 0, ему же весь лимит отправки Telegram;
+# остальные оставляют эту работу в БД. Так же через БД процессы узнают о массовых правках профилей
+WORKER_POLL_INTERVAL = 1.0  # Секунд между такими проверками БД
+CATALOG_CHECK_INTERVAL = 30.0  # Секунд между проверками файла справочника в процессах
+
+# Обслуживание БД: работы выполняются, когда бот простаивает
+MAINTENANCE_CHECK_INTERVAL = 60.0  # Секунд между проверками, не пора ли что-то сделать
+MAINTENANCE_IDLE = 30.0  # Секунд без обновлений, после которых бот считается простаивающим
+MAINTENANCE_BATCH_SIZE = 500  # Строк, удаляемых одной транзакцией
+MAINTENANCE_VACUUM_PAGES = 2000  # Страниц, возвращаемых ОС за один incremental_vacuum
+RETENTION_INTERVAL = 6 * 3600  # Секунд между чистками по срокам хранения
+OPTIMIZE_INTERVAL = 6 * 3600  # Секунд между PRAGMA optimize (обновление статистики индексов)
+VACUUM_INTERVAL = 3600  # Секунд между incremental_vacuum
+CHECKPOINT_INTERVAL = 600  # Секунд между сбросами WAL в основной файл
+# Сроки хранения в днях (0 — не удалять)
+BLOCKED_RETENTION_DAYS = int(os.getenv("BLOCKED_RETENTION_DAYS", "0"))  # Заблокировавшие бота, по last_active
+INACTIVE_RETENTION_DAYS = int(os.getenv("INACTIVE_RETENTION_DAYS", "0"))  # Все, кто давно не писал
+TICKET_RETENTION_DAYS = int(os.getenv("TICKET_RETENTION_DAYS", "180"))  # Доставленные и неудачные заявки
+BROADCAST_RETENTION_DAYS = int(os.getenv("BROADCAST_RETENTION_DAYS", "30"))  # Завершённые рассылки
+
+# Метрики в формате Prometheus на http://METRICS_HOST:METRICS_PORT/metrics (0 — выключено).
+# Процессы-обработчики занимают следующие порты: METRICS_PORT + 1, + 2, ...
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9090"))
+PERF_TOP = 10  # Строк в каждом разделе /perf
+
+# Запись входящих обновлений для replay.py (не задан — запись выключена).
+# Процессы-обработчики пишут в RECORD_PATH.0, RECORD_PATH.1, ...
+RECORD_PATH = os.getenv("RECORD_PATH")  # например traffic.jsonl.gz
+RECORD_KEY = os.getenv("RECORD_KEY")  # Ключ HMAC для обезличивания ID; без него — новый при каждом запуске
+RECORD_FLUSH_INTERVAL = 1.0  # Секунд между сбросами журнала на диск
+
+# ===== ЛОГИРОВАНИЕ =====
+logger = logging.getLogger(__name__)
+
+# ===== МЕТРИКИ =====
+class Histogram:
+    """Гистограмма длительностей с фиксированными границами корзин, как в Prometheus"""
+
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)  # последняя корзина — +Inf
+        self.sum = 0.0
+        self.count = 0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(self.BUCKETS, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+        self.max = max(self.max, seconds)
+
+    def quantile(self, q):
+        """Оценка квантиля: линейная интерполяция внутри корзины, не больше максимума"""
+        rank = q * self.count
+        seen = 0
+        lower = 0.0
+        for bound, count in zip(self.BUCKETS, self.counts):
+            if count and seen + count >= rank:
+                return min(lower + (bound - lower) * (rank - seen) / count, self.max)
+            seen += count
+            lower = bound
+        return self.max
+
+
+class Metrics:
+    """Гистограммы, счётчики и датчики одного экземпляра бота (App.metrics).
+
+    Метки — кортеж пар (имя, значение), например (("handler", "cmd_start"),).
+    """
+
+    HELP = {
+        "bot_handler_seconds": ("histogram", "Время работы обработчика"),
+        "bot_handler_errors_total": ("counter", "Исключения в обработчиках"),
+        "bot_db_seconds": ("histogram", "Время метода Database, включая очередь потоков"),
+        "bot_db_errors_total": ("counter", "Исключения в методах Database"),
+        "bot_api_seconds": ("histogram", "Время запроса к Bot API"),
+        "bot_api_errors_total": ("counter", "Ошибки Bot API по error_code (сетевые — по типу исключения)"),
+        "bot_throttled_total": ("counter", "Отброшенные сообщения флуда и отказы по кулдауну"),
+        "bot_fsm_evicted_total": ("counter", "Сессии FSM, выгруженные из памяти (простой или лимит памяти)"),
+        "bot_maintenance_seconds": ("histogram", "Время работ по обслуживанию БД"),
+        "bot_maintenance_errors_total": ("counter", "Ошибки работ по обслуживанию БД"),
+    }
+    BUCKET_LABELS = [repr(bound) for bound in Histogram.BUCKETS] + ["+Inf"]
+
+    def __init__(self):
+        self._histograms = {}  # (имя, метки) -> Histogram
+        self._counters = {}  # (имя, метки) -> значение
+        self._gauges = {}  # имя -> (описание, функция без аргументов)
+
+    def observe(self, name, labels, seconds):
+        histogram = self._histograms.get((name, labels))
+        if histogram is None:
+            histogram = self._histograms[(name, labels)] = Histogram()
+        histogram.observe(seconds)
+
+    def inc(self, name, labels, value=1):
+        self._counters[(name, labels)] = self._counters.get((name, labels), 0) + value
+
+    def gauge(self, name, description, func):
+        """Датчик, значение которого вычисляется при каждом чтении метрик"""
+        self._gauges[name] = (description, func)
+
+    def histograms(self, name):
+        return {labels: h for (n, labels), h in self._histograms.items() if n == name}
+
+    def counters(self, name):
+        return {labels: v for (n, labels), v in self._counters.items() if n == name}
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        pairs = labels + extra
+        if not pairs:
+            return ""
+        escaped = []
+        for key, value in pairs:
+            value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+            escaped.append(f'{key}="{value}"')
+        return "{" + ",".join(escaped) + "}"
+
+    def render(self):
+        """Текстовый формат экспозиции Prometheus"""
+        lines = []
+        for name, (kind, description) in self.HELP.items():
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind == "histogram":
+                for labels, histogram in self.histograms(name).items():
+                    cumulative = 0
+                    for bound, count in zip(self.BUCKET_LABELS, histogram.counts):
+                        cumulative += count
+                        lines.append(f"{name}_bucket{self._labels(labels, (('le', bound),))} {cumulative}")
+                    lines.append(f"{name}_sum{self._labels(labels)} {histogram.sum}")
+                    lines.append(f"{name}_count{self._labels(labels)} {histogram.count}")
+            else:
+                for labels, value in self.counters(name).items():
+                    lines.append(f"{name}{self._labels(labels)} {value}")
+        for name, (description, func) in self._gauges.items():
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {func()}")
+        return "\n".join(lines) + "\n"
+
+
+def timed(histogram, errors, **labels):
+    """Декоратор метода-корутины: время выполнения в histogram, исключения — в errors.
+
+    Метрики пишутся в реестр self.metrics экземпляра, чей метод вызван.
+    """
+    labels = tuple(labels.items())
+
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(self, *args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await func(self, *args, **kwargs)
+            except Exception:
+                self.metrics.inc(errors, labels)
+                raise
+            finally:
+                self.metrics.observe(histogram, labels, time.perf_counter() - started)
+        return wrapper
+    return decorator
+
+
+def instrument_database(cls):
+    """Замеряет время каждого асинхронного метода Database"""
+    for name, attr in list(vars(cls).items()):
+        if inspect.iscoroutinefunction(attr):
+            setattr(cls, name, timed("bot_db_seconds", "bot_db_errors_total", method=name)(attr))
+    return cls
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Время обработчиков в разрезе имени обработчика и состояния FSM"""
+
+    async def __call__(self, handler, event, data):
+        metrics = data["app"].metrics
+        handler_object = data.get("handler")
+        name = handler_object.callback.__name__ if handler_object else "unknown"
+        labels = (("handler", name), ("state", data.get("raw_state") or "none"))
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            metrics.inc("bot_handler_errors_total", (("handler", name),))
+            raise
+        finally:
+            metrics.observe("bot_handler_seconds", labels, time.perf_counter() - started)
+
+
+# error_code ответа Bot API по классу исключения aiogram (сам код aiogram в исключении не хранит)
+API_ERROR_CODES = {
+    TelegramRetryAfter: 429,
+    TelegramMigrateToChat: 400,
+    TelegramBadRequest: 400,
+    TelegramUnauthorizedError: 401,
+    TelegramForbiddenError: 403,
+    TelegramNotFound: 404,
+    TelegramConflictError: 409,
+    TelegramEntityTooLarge: 413,
+    TelegramServerError: 500,
+}
+
+
+def api_error_code(error):
+    """error_code Bot API для метки ошибки; у сетевых и прочих ошибок — имя типа"""
+    code = getattr(error, "error_code", None)
+    if code is None:
+        code = next((API_ERROR_CODES[cls] for cls in type(error).__mro__ if cls in API_ERROR_CODES), None)
+    return str(code) if code is not None else type(error).__name__
+
+
+class ApiMetricsMiddleware(BaseRequestMiddleware):
+    """Время запросов к Bot API и ошибки по error_code (повторы видны как отдельные запросы)"""
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+
+    async def __call__(self, make_request, bot, method):
+        name = method.__api_method__
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            self.metrics.inc("bot_api_errors_total", (("method", name), ("error", api_error_code(e))))
+            raise
+        finally:
+            self.metrics.observe("bot_api_seconds", (("method", name),), time.perf_counter() - started)
+
+
+class MetricsServer:
+    """HTTP-сервер, отдающий /metrics для Prometheus"""
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self._runner = None
+
+    async def handle(self, request):
+        return web.Response(text=self.metrics.render(), content_type="text/plain", charset="utf-8")
+
+    async def start(self, host=METRICS_HOST, port=METRICS_PORT):
+        if not port:
+            return
+        app = web.Application()
+        app.router.add_get("/metrics", self.handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        try:
+            await web.TCPSite(self._runner, host, port).start()
+        except OSError as e:
+            logger.error(f"❌ Метрики на {host}:{port} недоступны: {e}")
+            await self.stop()
+            return
+        logger.info(f"📈 Метрики: http://{host}:{port}/metrics")
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+# ===== БАЗА ДАННЫХ =====
+class DatabaseEngine:
+    """Долгоживущие соединения SQLite: один поток-писатель и пул читателей.
+
+    Все запросы выполняются в отдельных потоках, поэтому медленный fsync
+    не останавливает цикл событий и не тормозит остальные диалоги.
+    """
+
+    PRAGMAS = (
+        # Действует только для новой базы; старую переводит MaintenanceScheduler
+        "PRAGMA auto_vacuum = INCREMENTAL",
+        "PRAGMA journal_mode = WAL",
+        "PRAGMA synchronous = NORMAL",
+        "PRAGMA busy_timeout = 5000",
+        "PRAGMA temp_store = MEMORY",
+        "PRAGMA cache_size = -16000",
+        "PRAGMA mmap_size = 134217728",
+        "PRAGMA foreign_keys = ON",
+    )
+
+    def __init__(self, path, readers=DB_READERS):
+        self.path = path
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+        # Один поток-писатель сериализует все изменения — SQLite всё равно
+        # допускает только одного писателя, а так не бывает SQLITE_BUSY
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer")
+        self._readers = ThreadPoolExecutor(max_workers=readers, thread_name_prefix="db-reader")
+
+    def _connection(self):
+        """Соединение текущего потока (создаётся один раз)"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+            for pragma in self.PRAGMAS:
+                conn.execute(pragma)
+            self._local.conn = conn
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    def _read(self, func, args):
+        return func(self._connection(), *args)
+
+    def _write(self, func, args):
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            result = func(conn, *args)
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+        return result
+
+    async def read(self, func, *args):
+        """Выполняет func(conn, *args) в потоке-читателе"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._readers, self._read, func, args)
+
+    async def write(self, func, *args):
+        """Выполняет func(conn, *args) в одной транзакции в потоке-писателе"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._writer, self._write, func, args)
+
+    async def maintain(self, func, *args):
+        """Выполняет func(conn, *args) в потоке-писателе вне транзакции (VACUUM, checkpoint)"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._writer, self._read, func, args)
+
+    async def fetchone(self, sql, params=()):
+        return await self.read(lambda conn: conn.execute(sql, params).fetchone())
+
+    async def fetchall(self, sql, params=()):
+        return await self.read(lambda conn: conn.execute(sql, params).fetchall())
+
+    async def execute(self, sql, params=()):
+        """Выполняет изменяющий запрос и возвращает число затронутых строк"""
+        return await self.write(lambda conn: conn.execute(sql, params).rowcount)
+
+    async def executemany(self, sql, seq_of_params):
+        return await self.write(lambda conn: conn.executemany(sql, seq_of_params).rowcount)
+
+    async def close(self):
+        """Дожидается выполнения очереди запросов и закрывает соединения"""
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self._writer.shutdown)
+        await loop.run_in_executor(None, self._readers.shutdown)
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+
+
+# ===== МИГРАЦИИ =====
+class Migration:
+    """Шаг схемы БД; номер применённого шага хранится в PRAGMA user_version.
+
+    schema(conn) выполняется одной транзакцией и возвращает True, если
+    после неё нужен перенос данных. Тогда backfill(conn, cursor, limit)
+    вызывается пачками: обрабатывает до limit строк после cursor (в первый
+    раз cursor — None) и возвращает новый курсор или None, когда всё готово.
+    """
+
+    def __init__(self, version, description, schema, backfill=None):
+        self.version = version
+        self.description = description
+        self.schema = schema
+        self.backfill = backfill
+
+
+class Migrator:
+    """Применяет миграции по порядку номеров.
+
+    Каждая пачка переноса данных — отдельная короткая транзакция, и курсор
+    сохраняется в migration_progress в ней же: после падения процесса
+    перенос продолжается с места остановки. user_version повышается только
+    после последней пачки. Если схема уже последней версии, запуск стоит
+    одного чтения PRAGMA.
+    """
+
+    def __init__(self, engine, migrations=None, batch_size=MIGRATION_BATCH_SIZE):
+        self.engine = engine
+        self.migrations = sorted(migrations or MIGRATIONS, key=lambda m: m.version)
+        self.batch_size = batch_size
+
+    async def version(self):
+        row = await self.engine.fetchone("PRAGMA user_version")
+        return row[0]
+
+    async def migrate(self):
+        """Применяет недостающие миграции; возвращает итоговую версию"""
+        current = await self.version()
+        for migration in self.migrations:
+            if migration.version > current:
+                await self.apply(migration)
+                current = migration.version
+        return current
+
+    async def apply(self, migration):
+        started = time.perf_counter()
+        pending, cursor = await self.engine.write(self._start, migration)
+        batches = 0
+        while pending:
+            cursor = await self.engine.write(self._step, migration, cursor)
+            pending = cursor is not None
+            batches += 1
+        logger.info(
+            f"🗂 Миграция {migration.version} ({migration.description}) применена "
+            f"за {time.perf_counter() - started:.2f} с" + (f", пачек данных: {batches}" if batches else "")
+        )
+
+    @staticmethod
+    def _set_version(conn, version):
+        conn.execute(f"PRAGMA user_version = {int(version)}")
+
+    def _start(self, conn, migration):
+        """Схема миграции; возвращает (нужен перенос данных, курсор)"""
+        if conn.execute("PRAGMA user_version").fetchone()[0] >= migration.version:
+            return False, None  # другой процесс успел раньше
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS migration_progress (
+                version INTEGER PRIMARY KEY,
+                cursor INTEGER
+            )
+        """)
+        row = conn.execute(
+            "SELECT cursor FROM migration_progress WHERE version = ?", (migration.version,)
+        ).fetchone()
+        if row is not None:
+            logger.info(f"🗂 Продолжаю перенос данных миграции {migration.version}")
+            return True, row[0]
+        if migration.schema(conn) and migration.backfill is not None:
+            conn.execute("INSERT INTO migration_progress (version) VALUES (?)", (migration.version,))
+            return True, None
+        self._set_version(conn, migration.version)
+        return False, None
+
+    def _step(self, conn, migration, cursor):
+        cursor = migration.backfill(conn, cursor, self.batch_size)
+        if cursor is None:
+            conn.execute("DELETE FROM migration_progress WHERE version = ?", (migration.version,))
+            self._set_version(conn, migration.version)
+        else:
+            conn.execute(
+                "UPDATE migration_progress SET cursor = ? WHERE version = ?",
+                (cursor, migration.version)
+            )
+        return cursor
+
+
+def schema_v1(conn):
+    """Исходная схема; True — статистику нужно заполнить по существующим данным"""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            workplace TEXT NOT NULL,
+            registered_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            is_blocked INTEGER DEFAULT 0,
+            last_active TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_is_blocked ON users(is_blocked)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_last_active ON users(last_active)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_workplace ON users(workplace)")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            text TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'running',
+            admin_chat_id INTEGER NOT NULL,
+            status_message_id INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            finished_at TIMESTAMP
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS broadcast_recipients (
+            broadcast_id INTEGER NOT NULL REFERENCES broadcasts(id) ON DELETE CASCADE,
+            user_id INTEGER NOT NULL,
+            state INTEGER NOT NULL DEFAULT 0,
+            error TEXT,
+            PRIMARY KEY (broadcast_id, user_id)
+        ) WITHOUT ROWID
+    """)
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_broadcast_recipients_state
+        ON broadcast_recipients(broadcast_id, state)
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS tickets (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            workplace TEXT NOT NULL,
+            problem TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at REAL NOT NULL DEFAULT 0,
+            delivered_at TIMESTAMP,
+            admin_message_id INTEGER,
+            last_error TEXT
+        )
+    """)
+    # Очередь недоставленных заявок (outbox) — частичный индекс
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_tickets_outbox ON tickets(next_attempt_at)
+        WHERE status IN ('pending', 'sending')
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS fsm_sessions (
+            key TEXT PRIMARY KEY,
+            state TEXT,
+            data TEXT NOT NULL DEFAULT '{}',
+            updated_at REAL NOT NULL
+        ) WITHOUT ROWID
+    """)
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_fsm_sessions_updated ON fsm_sessions(updated_at)"
+    )
+    return create_stats_schema(conn)
+
+
+def create_stats_schema(conn):
+    """Таблицы статистики, которые обновляются триггерами в той же транзакции.
+
+    Возвращает True, если таблиц ещё не было.
+    """
+    is_new = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'workplace_stats'"
+    ).fetchone() is None
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS workplace_stats (
+            workplace TEXT PRIMARY KEY,
+            total INTEGER NOT NULL DEFAULT 0,
+            blocked INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS problem_stats (
+            problem TEXT PRIMARY KEY,
+            tickets INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS activity_daily (
+            day TEXT PRIMARY KEY,
+            users INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS activity_weekly (
+            week TEXT PRIMARY KEY,
+            users INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    # Численность по местам работы
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_users_stats_insert AFTER INSERT ON users
+        BEGIN
+            INSERT INTO workplace_stats (workplace, total, blocked)
+            VALUES (NEW.workplace, 1, NEW.is_blocked != 0)
+            ON CONFLICT(workplace) DO UPDATE SET
+                total = total + 1,
+                blocked = blocked + excluded.blocked;
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_users_stats_delete AFTER DELETE ON users
+        BEGIN
+            UPDATE workplace_stats SET
+                total = total - 1,
+                blocked = blocked - (OLD.is_blocked != 0)
+            WHERE workplace = OLD.workplace;
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_users_stats_update
+        AFTER UPDATE OF workplace, is_blocked ON users
+        WHEN OLD.workplace IS NOT NEW.workplace
+            OR (OLD.is_blocked != 0) != (NEW.is_blocked != 0)
+        BEGIN
+            UPDATE workplace_stats SET
+                total = total - 1,
+                blocked = blocked - (OLD.is_blocked != 0)
+            WHERE workplace = OLD.workplace;
+            INSERT INTO workplace_stats (workplace, total, blocked)
+            VALUES (NEW.workplace, 1, NEW.is_blocked != 0)
+            ON CONFLICT(workplace) DO UPDATE SET
+                total = total + 1,
+                blocked = blocked + excluded.blocked;
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_tickets_stats_insert AFTER INSERT ON tickets
+        BEGIN
+            INSERT INTO problem_stats (problem, tickets) VALUES (NEW.problem, 1)
+            ON CONFLICT(problem) DO UPDATE SET tickets = tickets + 1;
+        END
+    """)
+    # Активность: пользователь засчитывается дню (неделе) при первом
+    # за этот день (неделю) обновлении last_active
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_users_activity_insert AFTER INSERT ON users
+        BEGIN
+            INSERT INTO activity_daily (day, users) VALUES (date(NEW.last_active), 1)
+            ON CONFLICT(day) DO UPDATE SET users = users + 1;
+            INSERT INTO activity_weekly (week, users)
+            VALUES (strftime('%Y-%W', NEW.last_active), 1)
+            ON CONFLICT(week) DO UPDATE SET users = users + 1;
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_users_activity_daily AFTER UPDATE OF last_active ON users
+        WHEN date(NEW.last_active) IS NOT date(OLD.last_active)
+        BEGIN
+            INSERT INTO activity_daily (day, users) VALUES (date(NEW.last_active), 1)
+            ON CONFLICT(day) DO UPDATE SET users = users + 1;
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_users_activity_weekly AFTER UPDATE OF last_active ON users
+        WHEN strftime('%Y-%W', NEW.last_active) IS NOT strftime('%Y-%W', OLD.last_active)
+        BEGIN
+            INSERT INTO activity_weekly (week, users)
+            VALUES (strftime('%Y-%W', NEW.last_active), 1)
+            ON CONFLICT(week) DO UPDATE SET users = users + 1;
+        END
+    """)
+    return is_new
+
+
+def batch_bounds(conn, table, key, after, limit):
+    """Границы очередной пачки строк по ключу key: (после, до включительно) или None"""
+    after = -2 ** 63 if after is None else after
+    last = conn.execute(
+        f"SELECT MAX({key}) FROM (SELECT {key} FROM {table} WHERE {key} > ? ORDER BY {key} LIMIT ?)",
+        (after, limit)
+    ).fetchone()[0]
+    return None if last is None else (after, last)
+
+
+def backfill_stats(conn, after, limit):
+    """Заполняет сводки статистики по уже существующим сотрудникам"""
+    bounds = batch_bounds(conn, "users", "user_id", after, limit)
+    if bounds is None:
+        return None
+    conn.execute("""
+        INSERT INTO workplace_stats (workplace, total, blocked)
+        SELECT workplace, COUNT(*), SUM(is_blocked != 0) FROM users
+        WHERE user_id > ? AND user_id <= ? GROUP BY workplace
+        ON CONFLICT(workplace) DO UPDATE SET
+            total = total + excluded.total,
+            blocked = blocked + excluded.blocked
+    """, bounds)
+    conn.execute("""
+        INSERT INTO activity_daily (day, users)
+        SELECT date(last_active), COUNT(*) FROM users
+        WHERE user_id > ? AND user_id <= ? GROUP BY date(last_active)
+        ON CONFLICT(day) DO UPDATE SET users = users + excluded.users
+    """, bounds)
+    conn.execute("""
+        INSERT INTO activity_weekly (week, users)
+        SELECT strftime('%Y-%W', last_active), COUNT(*) FROM users
+        WHERE user_id > ? AND user_id <= ? GROUP BY strftime('%Y-%W', last_active)
+        ON CONFLICT(week) DO UPDATE SET users = users + excluded.users
+    """, bounds)
+    return bounds[1]
+
+
+def schema_v2(conn):
+    """Несколько админов: список, маршруты заявок, назначение и подтверждение заявок"""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS admins (
+            admin_id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL DEFAULT '',
+            on_call INTEGER NOT NULL DEFAULT 1,
+            added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    # kind — 'workplace' или 'problem', value — название из справочника
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS admin_routes (
+            admin_id INTEGER NOT NULL REFERENCES admins(admin_id) ON DELETE CASCADE,
+            kind TEXT NOT NULL,
+            value TEXT NOT NULL,
+            PRIMARY KEY (admin_id, kind, value)
+        ) WITHOUT ROWID
+    """)
+    conn.execute("ALTER TABLE tickets ADD COLUMN assigned_admin INTEGER")
+    conn.execute("ALTER TABLE tickets ADD COLUMN acked_at TIMESTAMP")
+    conn.execute("ALTER TABLE tickets ADD COLUMN closed_at TIMESTAMP")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_tickets_message ON tickets(admin_message_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_tickets_open ON tickets(created_at) WHERE closed_at IS NULL")
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_tickets_unacked ON tickets(delivered_at)
+        WHERE status = 'delivered' AND acked_at IS NULL AND closed_at IS NULL
+    """)
+    return True
+
+
+def backfill_ticket_admins(conn, after, limit):
+    """Старые заявки — за ADMIN_ID; уже доставленные считаются закрытыми"""
+    bounds = batch_bounds(conn, "tickets", "id", after, limit)
+    if bounds is None:
+        return None
+    conn.execute("""
+        UPDATE tickets SET
+            assigned_admin = ?,
+            closed_at = CASE WHEN status IN ('pending', 'sending') THEN NULL
+                             ELSE COALESCE(delivered_at, created_at) END
+        WHERE id > ? AND id <= ?
+    """, (ADMIN_ID, *bounds))
+    return bounds[1]
+
+
+def schema_v3(conn):
+    """Рассылки по сегментам: индекс даты регистрации, описание аудитории, шаблоны"""
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_registered_at ON users(registered_at)")
+    conn.execute("ALTER TABLE broadcasts ADD COLUMN audience TEXT")
+    # Текст рассылки теперь шаблон: фигурные скобки старых рассылок экранируем
+    conn.execute("""
+        UPDATE broadcasts SET text = replace(replace(text, '{', '{{'), '}', '}}')
+        WHERE instr(text, '{') OR instr(text, '}')
+    """)
+    return False
+
+
+def schema_v4(conn):
+    """Медиа в рассылках: JSON-список [тип, file_id] уже загруженных в Telegram файлов"""
+    conn.execute("ALTER TABLE broadcasts ADD COLUMN media TEXT")
+    return False
+
+
+def schema_v5(conn):
+    """Импортированные без даты активности (last_active IS NULL) не засчитываются ни дню, ни неделе"""
+    conn.execute("DROP TRIGGER IF EXISTS trg_users_activity_insert")
+    conn.execute("""
+        CREATE TRIGGER trg_users_activity_insert AFTER INSERT ON users
+        WHEN NEW.last_active IS NOT NULL
+        BEGIN
+            INSERT INTO activity_daily (day, users) VALUES (date(NEW.last_active), 1)
+            ON CONFLICT(day) DO UPDATE SET users = users + 1;
+            INSERT INTO activity_weekly (week, users)
+            VALUES (strftime('%Y-%W', NEW.last_active), 1)
+            ON CONFLICT(week) DO UPDATE SET users = users + 1;
+        END
+    """)
+    return False
+
+
+def schema_v6(conn):
+    """Версия профилей: массовые правки её повышают, процессы по ней сбрасывают кэш"""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS cache_versions (
+            name TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    conn.execute("INSERT OR IGNORE INTO cache_versions (name) VALUES ('users')")
+    return False
+
+
+def schema_v7(conn):
+    """Обновления, не обработанные к остановке: после запуска их обработка продолжается"""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS pending_updates (
+            update_id INTEGER PRIMARY KEY,
+            payload TEXT NOT NULL
+        )
+    """)
+    return False
+
+
+# Новые изменения схемы — только новыми записями в конце списка
+MIGRATIONS = [
+    Migration(1, "исходная схема", schema_v1, backfill_stats),
+    Migration(2, "несколько админов", schema_v2, backfill_ticket_admins),
+    Migration(3, "сегменты рассылок", schema_v3),
+    Migration(4, "медиа в рассылках", schema_v4),
+    Migration(5, "импорт без даты активности", schema_v5),
+    Migration(6, "версия кэша профилей", schema_v6),
+    Migration(7, "необработанные обновления", schema_v7),
+]
+
+
+class UserCache:
+    """LRU-кэш профилей (name, workplace, is_blocked) со сроком жизни записей.
+
+    Все изменения профилей в этом процессе сразу обновляют кэш. О массовых
+    правках из других процессов Database узнаёт по номеру версии в БД и
+    сбрасывает кэш целиком (см. Database.sync_user_cache), так что TTL
+    нужен только на случай правок базы совсем извне.
+    """
+
+    def __init__(self, max_size=USER_CACHE_SIZE, ttl=USER_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        # user_id -> метка чтения после промаха. Изменение профиля снимает
+        # метку, и результат чтения, начатого до изменения, в кэш не попадёт
+        self._fills = {}
+        self._entries = OrderedDict()  # user_id -> (expires_at, user)
+
+    def get(self, user_id):
+        """Возвращает (найдено, профиль); профиль None — пользователя нет в базе"""
+        entry = self._entries.get(user_id)
+        if entry is not None and entry[0] > time.monotonic():
+            self._entries.move_to_end(user_id)
+            self.hits += 1
+            return True, entry[1]
+        self.misses += 1
+        return False, None
+
+    def fill_token(self, user_id):
+        """Метка для put после промаха; одновременные промахи по одному user_id делят её"""
+        return self._fills.setdefault(user_id, object())
+
+    def put(self, user_id, user, token=None):
+        if token is not None:
+            if self._fills.get(user_id) is not token:
+                return
+        self._fills.pop(user_id, None)
+        self._entries[user_id] = (time.monotonic() + self.ttl, user)
+        self._entries.move_to_end(user_id)
+        if len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def set_blocked(self, user_id, is_blocked):
+        self._fills.pop(user_id, None)
+        entry = self._entries.get(user_id)
+        if entry is not None and entry[1] is not None:
+            name, workplace, _ = entry[1]
+            self._entries[user_id] = (entry[0], (name, workplace, is_blocked))
+
+    def invalidate(self, user_id):
+        self._fills.pop(user_id, None)
+        self._entries.pop(user_id, None)
+
+    def clear(self):
+        self._fills.clear()
+        self._entries.clear()
+
+    def stats(self):
+        requests = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / requests if requests else 0.0
+        }
+
+
+
+@instrument_database
+class Database:
+    """Запросы бота к БД; кэш профилей и буфер активности держит в согласии с ней"""
+
+    def __init__(self, engine, user_cache, activity_buffer, metrics, sync_interval=None):
+        self.engine = engine
+        self.user_cache = user_cache
+        self.activity_buffer = activity_buffer
+        self.metrics = metrics
+        # Раз в sync_interval кэш сверяется с версией профилей в БД (None — процесс один)
+        self.sync_interval = sync_interval
+        self._user_version = None
+        self._synced_at = 0.0
+
+    async def init_db(self):
+        """Приводит схему к последней версии (см. MIGRATIONS)"""
+        version = await Migrator(self.engine).migrate()
+        logger.info(f"✅ База данных сотрудников готова (версия схемы {version})")
+
+    async def sync_user_cache(self):
+        """Сбрасывает кэш профилей, если их массово правил другой процесс"""
+        self._synced_at = time.monotonic()
+        row = await self.engine.fetchone("SELECT version FROM cache_versions WHERE name = 'users'")
+        if row[0] != self._user_version:
+            self.user_cache.clear()
+            self._user_version = row[0]
+
+    @staticmethod
+    def _bump_user_version(conn):
+        """В транзакции массовой правки профилей: их кэши в других процессах устарели"""
+        conn.execute("UPDATE cache_versions SET version = version + 1 WHERE name = 'users'")
+        return conn.execute("SELECT version FROM cache_versions WHERE name = 'users'").fetchone()[0]
+
+    def _own_user_version(self, version):
+        """Версию повысил этот процесс — его кэш уже исправлен, сбрасывать не нужно"""
+        if self._user_version is not None and version == self._user_version + 1:
+            self._user_version = version
+
+    async def get_user(self, user_id):
+        if self.sync_interval is not None and time.monotonic() - self._synced_at >= self.sync_interval:
+            await self.sync_user_cache()
+        found, user = self.user_cache.get(user_id)
+        if found:
+            return user
+        token = self.user_cache.fill_token(user_id)
+        user = await self.engine.fetchone(
+            "SELECT name, workplace, is_blocked FROM users WHERE user_id = ?",
+            (user_id,)
+        )
+        self.user_cache.put(user_id, user, token)
+        return user
+
+    async def save_user(self, user_id, name, workplace):
+        await self.engine.execute("""
+            INSERT INTO users (user_id, name, workplace, last_active) 
+            VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+            ON CONFLICT(user_id) DO UPDATE SET 
+                name = excluded.name,
+                workplace = excluded.workplace,
+                is_blocked = 0,
+                last_active = CURRENT_TIMESTAMP
+        """, (user_id, name, workplace))
+        self.user_cache.put(user_id, (name, workplace, 0))
+        return True
+
+    async def mark_user_blocked(self, user_id):
+        self.activity_buffer.discard_unblock(user_id)
+        self.user_cache.set_blocked(user_id, 1)
+        await self.engine.execute(
+            "UPDATE users SET is_blocked = 1 WHERE user_id = ?", 
+            (user_id,)
+        )
+
+    async def mark_users_blocked(self, user_ids):
+        """Помечает заблокировавшими бота сразу многих пользователей"""
+        for user_id in user_ids:
+            self.activity_buffer.discard_unblock(user_id)
+            self.user_cache.set_blocked(user_id, 1)
+        if not user_ids:
+            return 0
+
+        def block(conn):
+            cursor = conn.executemany(
+                "UPDATE users SET is_blocked = 1 WHERE user_id = ?",
+                [(user_id,) for user_id in user_ids]
+            )
+            return cursor.rowcount, self._bump_user_version(conn)
+
+        count, version = await self.engine.write(block)
+        self._own_user_version(version)
+        return count
+
+    def mark_user_unblocked(self, user_id):
+        """Снимает блокировку (отложенная запись вместе с last_active)"""
+        self.user_cache.set_blocked(user_id, 0)
+        self.activity_buffer.touch(user_id, unblock=True)
+
+    async def get_all_users(self, include_blocked=False):
+        if include_blocked:
+            return await self.engine.fetchall(
+                "SELECT user_id, name FROM users ORDER BY registered_at DESC"
+            )
+        return await self.engine.fetchall(
+            "SELECT user_id, name FROM users WHERE is_blocked = 0 ORDER BY registered_at DESC"
+        )
+
+    async def get_users_page(self, after=None, before=None, workplace=None, is_blocked=None,
+                             limit=USERS_PAGE_SIZE):
+        """Keyset-пагинация по user_id.
+
+        Возвращает (строки, есть предыдущая страница, есть следующая).
+        Фильтры по месту и статусу идут по индексам idx_workplace и idx_is_blocked.
+        """
+        conditions = []
+        params = []
+        if workplace is not None:
+            conditions.append("workplace = ?")
+            params.append(workplace)
+        if is_blocked is not None:
+            conditions.append("is_blocked = ?")
+            params.append(is_blocked)
+        if before is not None:
+            conditions.append("user_id < ?")
+            params.append(before)
+            order = "DESC"
+        else:
+            if after is not None:
+                conditions.append("user_id > ?")
+                params.append(after)
+            order = "ASC"
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        rows = await self.engine.fetchall(
+            f"SELECT user_id, name, workplace, is_blocked FROM users {where} "
+            f"ORDER BY user_id {order} LIMIT ?",
+            (*params, limit + 1)
+        )
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        if before is not None:
+            rows.reverse()
+            return rows, has_more, True
+        return rows, after is not None, has_more
+
+    async def get_user_workplaces(self):
+        """Места работы, которые есть у сотрудников (из сводки, без сканирования users)"""
+        rows = await self.engine.fetchall("SELECT workplace FROM workplace_stats WHERE total > 0")
+        return [row[0] for row in rows]
+
+    async def get_stats(self):
+        """Статистика из таблиц-сводок — без сканирования users"""
+        def collect(conn):
+            workplaces = conn.execute(
+                "SELECT workplace, total, blocked FROM workplace_stats WHERE total > 0 "
+                "ORDER BY total DESC"
+            ).fetchall()
+            problems = conn.execute(
+                "SELECT problem, tickets FROM problem_stats ORDER BY tickets DESC"
+            ).fetchall()
+            daily = conn.execute(
+                "SELECT day, users FROM activity_daily ORDER BY day DESC LIMIT 7"
+            ).fetchall()
+            weekly = conn.execute(
+                "SELECT week, users FROM activity_weekly ORDER BY week DESC LIMIT 4"
+            ).fetchall()
+            return workplaces, problems, daily, weekly
+
+        workplaces, problems, daily, weekly = await self.engine.read(collect)
+        total_users = sum(total for _, total, _ in workplaces)
+        blocked_users = sum(blocked for _, _, blocked in workplaces)
+        return {
+            "total_users": total_users,
+            "blocked_users": blocked_users,
+            "active_users": total_users - blocked_users,
+            "workplaces": workplaces,
+            "problems": problems,
+            "daily_activity": daily,
+            "weekly_activity": weekly
+        }
+
+    # ----- Заявки -----
+    async def create_ticket(self, user_id, name, workplace, problem, admin_id):
+        return await self.engine.write(lambda conn: conn.execute(
+            "INSERT INTO tickets (user_id, name, workplace, problem, assigned_admin) VALUES (?, ?, ?, ?, ?)",
+            (user_id, name, workplace, problem, admin_id)
+        ).lastrowid)
+
+    async def claim_due_tickets(self, limit):
+        """Захватывает заявки, которые пора доставить.
+
+        Захват продлевает next_attempt_at на TICKET_CLAIM_TIMEOUT: если процесс
+        упадёт посреди отправки, заявка снова станет доступной сама.
+        """
+        def claim(conn):
+            now = time.time()
+            rows = conn.execute("""
+                SELECT id, user_id, name, workplace, problem, attempts, assigned_admin FROM tickets
+                WHERE status IN ('pending', 'sending') AND next_attempt_at <= ?
+                ORDER BY next_attempt_at LIMIT ?
+            """, (now, limit)).fetchall()
+            conn.executemany(
+                "UPDATE tickets SET status = 'sending', next_attempt_at = ? WHERE id = ?",
+                [(now + TICKET_CLAIM_TIMEOUT, row[0]) for row in rows]
+            )
+            return rows
+
+        return await self.engine.write(claim)
+
+    async def next_ticket_attempt(self):
+        row = await self.engine.fetchone(
+            "SELECT MIN(next_attempt_at) FROM tickets WHERE status IN ('pending', 'sending')"
+        )
+        return row[0]
+
+    async def mark_tickets_delivered(self, ticket_ids, admin_message_id):
+        """Заявки попали в сообщение admin_message_id"""
+        await self.engine.executemany("""
+            UPDATE tickets SET
+                status = 'delivered',
+                attempts = attempts + 1,
+                delivered_at = CURRENT_TIMESTAMP,
+                admin_message_id = ?,
+                last_error = NULL
+            WHERE id = ?
+        """, [(admin_message_id, ticket_id) for ticket_id in ticket_ids])
+
+    async def retry_tickets(self, ticket_ids, delay, error, count_attempt=True):
+        next_attempt_at = time.time() + delay
+        await self.engine.executemany("""
+            UPDATE tickets SET
+                status = 'pending',
+                attempts = attempts + ?,
+                next_attempt_at = ?,
+                last_error = ?
+            WHERE id = ?
+        """, [(int(count_attempt), next_attempt_at, error, ticket_id) for ticket_id in ticket_ids])
+
+    async def fail_ticket(self, ticket_id, error):
+        await self.engine.execute(
+            "UPDATE tickets SET status = 'failed', attempts = attempts + 1, last_error = ? WHERE id = ?",
+            (error, ticket_id)
+        )
+
+    async def get_open_tickets(self, ttl):
+        """Назначенные незакрытые заявки не старше ttl секунд: (id, админ, время создания)"""
+        return await self.engine.fetchall("""
+            SELECT id, assigned_admin, CAST(strftime('%s', created_at) AS REAL) FROM tickets
+            WHERE closed_at IS NULL AND created_at >= datetime('now', ?)
+                AND assigned_admin IS NOT NULL AND status != 'failed'
+        """, (f"-{int(ttl)} seconds",))
+
+    async def ack_tickets(self, admin_message_id, admin_id):
+        """Админ взял в работу заявки из своего сообщения; возвращает их число"""
+        return await self.engine.execute("""
+            UPDATE tickets SET acked_at = CURRENT_TIMESTAMP
+            WHERE admin_message_id = ? AND assigned_admin = ? AND acked_at IS NULL AND closed_at IS NULL
+        """, (admin_message_id, admin_id))
+
+    async def close_tickets(self, admin_message_id, admin_id):
+        """Закрывает заявки из сообщения админа; возвращает их ID"""
+        def close(conn):
+            ticket_ids = conn.execute(
+                "SELECT id FROM tickets WHERE admin_message_id = ? AND assigned_admin = ? AND closed_at IS NULL",
+                (admin_message_id, admin_id)
+            ).fetchall()
+            conn.executemany("""
+                UPDATE tickets SET
+                    closed_at = CURRENT_TIMESTAMP,
+                    acked_at = COALESCE(acked_at, CURRENT_TIMESTAMP)
+                WHERE id = ?
+            """, ticket_ids)
+            return [ticket_id for ticket_id, in ticket_ids]
+
+        return await self.engine.write(close)
+
+    async def get_unacked_tickets(self, timeout):
+        """Доставленные, но не взятые в работу дольше timeout секунд: (id, место, проблема, админ)"""
+        return await self.engine.fetchall("""
+            SELECT id, workplace, problem, assigned_admin FROM tickets
+            WHERE status = 'delivered' AND acked_at IS NULL AND closed_at IS NULL
+                AND delivered_at < datetime('now', ?)
+        """, (f"-{int(timeout)} seconds",))
+
+    async def get_admin_waiting_tickets(self, admin_id):
+        """Заявки админа, которые он ещё не взял в работу: (id, место, проблема, админ)"""
+        return await self.engine.fetchall("""
+            SELECT id, workplace, problem, assigned_admin FROM tickets
+            WHERE assigned_admin = ? AND acked_at IS NULL AND closed_at IS NULL
+                AND status IN ('pending', 'delivered')
+        """, (admin_id,))
+
+    async def reassign_ticket(self, ticket_id, from_admin, to_admin):
+        """Передаёт заявку другому админу, если её ещё не взяли; True — передана"""
+        return await self.engine.execute("""
+            UPDATE tickets SET
+                assigned_admin = ?,
+                status = 'pending',
+                next_attempt_at = 0,
+                delivered_at = NULL,
+                admin_message_id = NULL
+            WHERE id = ? AND assigned_admin = ? AND acked_at IS NULL AND closed_at IS NULL
+                AND status IN ('pending', 'delivered')
+        """, (to_admin, ticket_id, from_admin)) > 0
+
+    def update_last_active(self, user_id):
+        """Обновляет активность (отложенная запись, см. ActivityBuffer)"""
+        self.activity_buffer.touch(user_id)
+
+    async def delete_blocked_users(self):
+        deleted = 0
+        while True:
+            keys = await self.purge_batch("users", ("user_id",), "is_blocked = 1", ())
+            deleted += len(keys)
+            if len(keys) < MAINTENANCE_BATCH_SIZE:
+                return deleted
+
+    # ----- Админы -----
+    async def get_admins(self):
+        return await self.engine.fetchall("SELECT admin_id, name, on_call FROM admins ORDER BY admin_id")
+
+    async def get_admin_routes(self):
+        return await self.engine.fetchall("SELECT admin_id, kind, value FROM admin_routes")
+
+    async def save_admin(self, admin_id, name=""):
+        """Добавляет админа; у существующего меняет имя, если оно передано"""
+        await self.engine.execute("""
+            INSERT INTO admins (admin_id, name) VALUES (?, ?)
+            ON CONFLICT(admin_id) DO UPDATE SET
+                name = CASE WHEN excluded.name != '' THEN excluded.name ELSE name END
+        """, (admin_id, name))
+
+    async def delete_admin(self, admin_id):
+        return await self.engine.execute("DELETE FROM admins WHERE admin_id = ?", (admin_id,))
+
+    async def set_admin_on_call(self, admin_id, on_call):
+        return await self.engine.execute(
+            "UPDATE admins SET on_call = ? WHERE admin_id = ?", (int(on_call), admin_id)
+        )
+
+    async def add_admin_route(self, admin_id, kind, value):
+        return await self.engine.execute(
+            "INSERT OR IGNORE INTO admin_routes (admin_id, kind, value) VALUES (?, ?, ?)",
+            (admin_id, kind, value)
+        )
+
+    async def delete_admin_route(self, admin_id, kind, value):
+        return await self.engine.execute(
+            "DELETE FROM admin_routes WHERE admin_id = ? AND kind = ? AND value = ?",
+            (admin_id, kind, value)
+        )
+
+    # ----- Обслуживание -----
+    async def purge_batch(self, table, key, where, params, limit=MAINTENANCE_BATCH_SIZE):
+        """Удаляет до limit строк table по условию where; возвращает ключи удалённых.
+
+        Большие чистки идут такими пачками, чтобы транзакция писателя
+        оставалась короткой и не задерживала запросы обработчиков.
+        """
+        def purge(conn):
+            keys = conn.execute(
+                f"SELECT {', '.join(key)} FROM {table} WHERE {where} LIMIT ?", (*params, limit)
+            ).fetchall()
+            conn.executemany(
+                f"DELETE FROM {table} WHERE {' AND '.join(f'{column} = ?' for column in key)}", keys
+            )
+            version = self._bump_user_version(conn) if table == "users" and keys else None
+            return keys, version
+
+        keys, version = await self.engine.write(purge)
+        if table == "users":
+            for user_id, in keys:
+                self.user_cache.invalidate(user_id)
+            if version is not None:
+                self._own_user_version(version)
+        return keys
+
+    async def optimize(self):
+        """Обновляет статистику индексов там, где она устарела"""
+        def optimize(conn):
+            conn.execute("PRAGMA analysis_limit = 1000")
+            conn.execute("PRAGMA optimize")
+
+        await self.engine.maintain(optimize)
+
+    async def incremental_vacuum(self, pages):
+        """Возвращает ОС свободные страницы; возвращает (освобождено, осталось свободных)"""
+        def vacuum(conn):
+            if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+                # База создана до включения auto_vacuum — один полный VACUUM
+                conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+                conn.execute("VACUUM")
+                logger.info("🧹 База переведена в режим auto_vacuum = INCREMENTAL")
+            before = conn.execute("PRAGMA freelist_count").fetchone()[0]
+            conn.execute(f"PRAGMA incremental_vacuum({int(pages)})").fetchall()
+            after = conn.execute("PRAGMA freelist_count").fetchone()[0]
+            return before - after, after
+
+        return await self.engine.maintain(vacuum)
+
+    async def checkpoint(self):
+        """Переносит WAL в основной файл и обрезает его; возвращает (занято, страниц в WAL, перенесено)"""
+        return await self.engine.maintain(
+            lambda conn: conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()
+        )
+
+    # ----- Выгрузка и загрузка -----
+    async def export_rows(self, table, fmt, path):
+        """Пишет таблицу в файл path (csv или jsonl); возвращает число строк.
+
+        Строки читаются с курсора пачками по EXPORT_CHUNK_SIZE и сразу
+        пишутся в файл — в памяти не бывает больше одной пачки.
+        """
+        columns = EXPORT_COLUMNS[table]
+
+        def export(conn):
+            cursor = conn.execute(
+                f"SELECT {', '.join(columns)} FROM {table} ORDER BY {columns[0]}"
+            )
+            count = 0
+            with open(path, "w", encoding="utf-8-sig" if fmt == "csv" else "utf-8", newline="") as f:
+                if fmt == "csv":
+                    writer = csv.writer(f)
+                    writer.writerow(columns)
+                    write = writer.writerows
+                else:
+                    def write(rows):
+                        f.writelines(
+                            json.dumps(dict(zip(columns, row)), ensure_ascii=False) + "\n" for row in rows
+                        )
+                while True:
+                    rows = cursor.fetchmany(EXPORT_CHUNK_SIZE)
+                    if not rows:
+                        return count
+                    write(rows)
+                    count += len(rows)
+
+        return await self.engine.read(export)
+
+    async def import_users(self, rows):
+        """Добавляет или обновляет сотрудников одной транзакцией.
+
+        rows — список (user_id, name, workplace, last_active) без повторов ID.
+        last_active берётся из файла (или NULL): импорт — не активность, и
+        новые строки не должны раздувать «активных» в /stats. У уже
+        известных сотрудников своя дата активности не трогается.
+        Возвращает (добавлено, обновлено).
+        """
+        def upsert(conn):
+            existing = 0
+            for start in range(0, len(rows), 500):
+                ids = [row[0] for row in rows[start:start + 500]]
+                existing += conn.execute(
+                    f"SELECT COUNT(*) FROM users WHERE user_id IN ({', '.join('?' * len(ids))})", ids
+                ).fetchone()[0]
+            conn.executemany("""
+                INSERT INTO users (user_id, name, workplace, last_active) VALUES (?, ?, ?, ?)
+                ON CONFLICT(user_id) DO UPDATE SET
+                    name = excluded.name,
+                    workplace = excluded.workplace
+            """, rows)
+            return len(rows) - existing, existing, self._bump_user_version(conn)
+
+        added, updated, version = await self.engine.write(upsert)
+        for user_id, *_ in rows:
+            self.user_cache.invalidate(user_id)
+        self._own_user_version(version)
+        return added, updated
+
+    # ----- Рассылки -----
+    async def create_broadcast(self, text, admin_chat_id, audience, media=None):
+        """Создаёт рассылку и фиксирует список получателей по фильтрам audience.
+
+        Получатели отбираются одним INSERT … SELECT внутри SQLite — список
+        не проходит через Python, сколько бы сотрудников ни было.
+        Возвращает (id, число получателей) или (None, 0), если слать некому.
+        """
+        where, params = audience.where()
+
+        def create(conn):
+            job_id = conn.execute(
+                "INSERT INTO broadcasts (text, admin_chat_id, audience, media) VALUES (?, ?, ?, ?)",
+                (text, admin_chat_id, audience.describe(), json.dumps(media) if media else None)
+            ).lastrowid
+            total = conn.execute(f"""
+                INSERT INTO broadcast_recipients (broadcast_id, user_id)
+                SELECT ?, user_id FROM users WHERE {where}
+            """, (job_id, *params)).rowcount
+            if not total:
+                conn.execute("DELETE FROM broadcasts WHERE id = ?", (job_id,))
+                return None, 0
+            return job_id, total
+
+        return await self.engine.write(create)
+
+    async def set_broadcast_message(self, job_id, message_id):
+        await self.engine.execute(
+            "UPDATE broadcasts SET status_message_id = ? WHERE id = ?",
+            (message_id, job_id)
+        )
+
+    async def get_broadcast(self, job_id):
+        return await self.engine.fetchone(
+            "SELECT id, text, status, admin_chat_id, status_message_id, media FROM broadcasts WHERE id = ?",
+            (job_id,)
+        )
+
+    async def get_broadcast_status(self, job_id):
+        row = await self.engine.fetchone("SELECT status FROM broadcasts WHERE id = ?", (job_id,))
+        return row[0] if row else None
+
+    async def set_broadcast_status(self, job_id, status):
+        """Меняет статус; завершённую или отменённую рассылку не трогает"""
+        finished = status in (BROADCAST_DONE, BROADCAST_CANCELLED)
+        return await self.engine.execute("""
+            UPDATE broadcasts SET
+                status = ?,
+                finished_at = CASE WHEN ? THEN CURRENT_TIMESTAMP ELSE finished_at END
+            WHERE id = ? AND status NOT IN (?, ?)
+        """, (status, int(finished), job_id, BROADCAST_DONE, BROADCAST_CANCELLED))
+
+    async def get_unfinished_broadcasts(self):
+        return await self.engine.fetchall(
+            "SELECT id, text, status, admin_chat_id, status_message_id, media FROM broadcasts "
+            "WHERE status IN (?, ?) ORDER BY id",
+            (BROADCAST_RUNNING, BROADCAST_PAUSED)
+        )
+
+    async def get_recent_broadcasts(self, limit=10):
+        return await self.engine.fetchall(
+            "SELECT id, status, created_at, audience FROM broadcasts ORDER BY id DESC LIMIT ?",
+            (limit,)
+        )
+
+    async def recover_interrupted_broadcasts(self):
+        """Получателей, захваченных до падения процесса, повторно не отправляем.
+
+        Доставлено ли им сообщение — неизвестно, поэтому они считаются ошибкой:
+        лучше пропустить одного, чем прислать дубль.
+        """
+        return await self.engine.execute("""
+            UPDATE broadcast_recipients SET state = ?, error = 'interrupted'
+            WHERE state = ? AND broadcast_id IN (
+                SELECT id FROM broadcasts WHERE status IN (?, ?)
+            )
+        """, (RECIPIENT_FAILED, RECIPIENT_SENDING, BROADCAST_RUNNING, BROADCAST_PAUSED))
+
+    async def claim_broadcast_batch(self, job_id, limit):
+        """Захватывает очередную пачку получателей (state → «отправляется»).
+
+        Возвращает (user_id, имя, место работы) — для подстановок в шаблон.
+        """
+        def claim(conn):
+            rows = conn.execute("""
+                SELECT r.user_id, COALESCE(u.name, ''), COALESCE(u.workplace, '')
+                FROM broadcast_recipients r LEFT JOIN users u ON u.user_id = r.user_id
+                WHERE r.broadcast_id = ? AND r.state = ?
+                ORDER BY r.user_id LIMIT ?
+            """, (job_id, RECIPIENT_PENDING, limit)).fetchall()
+            conn.executemany(
+                "UPDATE broadcast_recipients SET state = ? WHERE broadcast_id = ? AND user_id = ?",
+                [(RECIPIENT_SENDING, job_id, user_id) for user_id, _, _ in rows]
+            )
+            return rows
+
+        return await self.engine.write(claim)
+
+    async def save_broadcast_results(self, job_id, results):
+        """results — список (state, error, user_id)"""
+        if not results:
+            return
+        await self.engine.executemany(
+            f"UPDATE broadcast_recipients SET state = ?, error = ? "
+            f"WHERE broadcast_id = {int(job_id)} AND user_id = ?",
+            results
+        )
+
+    async def get_broadcast_counts(self, job_id):
+        rows = await self.engine.fetchall(
+            "SELECT state, COUNT(*) FROM broadcast_recipients WHERE broadcast_id = ? GROUP BY state",
+            (job_id,)
+        )
+        return dict(rows)
+
+    # ----- Обновления -----
+    async def save_pending_updates(self, payloads):
+        """Сохраняет JSON обновлений, принятых, но не обработанных к остановке"""
+        if not payloads:
+            return
+        await self.engine.executemany(
+            "INSERT OR REPLACE INTO pending_updates (update_id, payload) VALUES (?, ?)",
+            [(json.loads(payload)["update_id"], payload) for payload in payloads]
+        )
+        logger.info(f"💾 Сохранено необработанных обновлений: {len(payloads)}")
+
+    async def take_pending_updates(self):
+        """Забирает сохранённые обновления по порядку и удаляет их из БД"""
+        def take(conn):
+            rows = conn.execute("SELECT payload FROM pending_updates ORDER BY update_id").fetchall()
+            conn.execute("DELETE FROM pending_updates")
+            return [payload for payload, in rows]
+
+        return await self.engine.write(take)
+
+
+class ActivityBuffer:
+    """Отложенная запись активности сотрудников.
+
+    Обновления last_active и снятие блокировки копятся в памяти (по одной
+    записи на пользователя) и сбрасываются одной транзакцией executemany
+    по таймеру, при заполнении буфера и при остановке бота.
+    """
+
+    def __init__(self, engine, interval=ACTIVITY_FLUSH_INTERVAL, max_size=ACTIVITY_BUFFER_SIZE):
+        self.engine = engine
+        self.interval = interval
+        self.max_size = max_size
+        self._pending = {}  # user_id -> (last_active, unblock)
+        self._full = asyncio.Event()
+        self._task = None
+
+    def touch(self, user_id, unblock=False):
+        now = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())
+        previous = self._pending.get(user_id)
+        if previous is not None and previous[1]:
+            unblock = True
+        self._pending[user_id] = (now, unblock)
+        if len(self._pending) >= self.max_size:
+            self._full.set()
+
+    def discard_unblock(self, user_id):
+        """Отменяет ещё не записанное снятие блокировки"""
+        previous = self._pending.get(user_id)
+        if previous is not None and previous[1]:
+            self._pending[user_id] = (previous[0], False)
+
+    async def flush(self):
+        if not self._pending:
+            return 0
+        batch, self._pending = self._pending, {}
+        rows = [
+            (last_active, int(unblock), user_id)
+            for user_id, (last_active, unblock) in batch.items()
+        ]
+        try:
+            await self.engine.executemany("""
+                UPDATE users SET
+                    last_active = ?,
+                    is_blocked = CASE WHEN ? THEN 0 ELSE is_blocked END
+                WHERE user_id = ?
+            """, rows)
+        except Exception as e:
+            logger.error(f"❌ Ошибка записи активности: {e}")
+            # Возвращаем в буфер то, что не перезаписано более свежими данными
+            for user_id, value in batch.items():
+                self._pending.setdefault(user_id, value)
+            return 0
+        return len(rows)
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._full.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._full.clear()
+            await self.flush()
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+
+# ===== ХРАНИЛИЩЕ СОСТОЯНИЙ =====
+class SQLiteStorage(BaseStorage):
+    """FSM-хранилище в SQLite с горячим кэшем в памяти.
+
+    Чтение и запись состояния идут только в память; изменённые сессии
+    сбрасываются в таблицу fsm_sessions пачкой в фоне. После перезапуска
+    сессия подгружается из БД при первом обращении, так что незаконченная
+    регистрация или заявка не теряется. Сессии, к которым давно не
+    обращались, удаляются по FSM_SESSION_TTL.
+
+    Кэш ограничен: данные сессии лежат одной JSON-строкой (в том же виде,
+    что и в БД), а сессии упорядочены по последнему обращению. Простаивающие
+    дольше FSM_IDLE_TTL и самые старые сверх FSM_MEMORY_LIMIT выгружаются
+    из памяти — в БД они остаются и подгружаются при следующем обращении.
+    """
+
+    ENTRY_OVERHEAD = 200  # Байт на запись кроме ключа и данных: список, float, место в словаре
+
+    def __init__(self, engine, metrics, flush_interval=FSM_FLUSH_INTERVAL, ttl=FSM_SESSION_TTL,
+                 idle_ttl=FSM_IDLE_TTL, memory_limit=FSM_MEMORY_LIMIT):
+        self.engine = engine
+        self.metrics = metrics
+        self.flush_interval = flush_interval
+        self.ttl = ttl
+        self.idle_ttl = idle_ttl
+        self.memory_limit = memory_limit
+        self.key_builder = DefaultKeyBuilder(
+            with_bot_id=True,
+            with_business_connection_id=True,
+            with_destiny=True
+        )
+        # ключ -> [state, data (JSON, "" — пусто), время последнего обращения, размер]
+        self._sessions = OrderedDict()
+        self._dirty = set()
+        self._flushing = set()  # Записываются в БД прямо сейчас
+        self.memory = 0  # Оценка байт, занятых сессиями в памяти
+        self._task = None
+
+    async def _session(self, key):
+        key = self.key_builder.build(key)
+        session = self._sessions.get(key)
+        if session is None:
+            row = await self.engine.fetchone(
+                "SELECT state, data FROM fsm_sessions WHERE key = ? AND updated_at >= ?",
+                (key, time.time() - self.ttl)
+            )
+            # Пока шло чтение, сессию могли уже создать — её не затираем
+            session = self._sessions.get(key)
+            if session is None:
+                state, data = row or (None, "")
+                session = [sys.intern(state) if state else None, data, time.monotonic(), 0]
+                self._sessions[key] = session
+                self._resize(key, session)
+                self.evict(exclude=key)
+        else:
+            self._sessions.move_to_end(key)
+        session[2] = time.monotonic()
+        return key, session
+
+    def _resize(self, key, session):
+        # Строки состояний общие (интернированы), поэтому в размер не входят
+        size = self.ENTRY_OVERHEAD + sys.getsizeof(key) + sys.getsizeof(session[1])
+        self.memory += size - session[3]
+        session[3] = size
+
+    async def set_state(self, key, state=None):
+        key, session = await self._session(key)
+        state = state.state if isinstance(state, State) else state
+        session[0] = sys.intern(state) if state else None
+        self._dirty.add(key)
+
+    async def get_state(self, key):
+        _, session = await self._session(key)
+        return session[0]
+
+    async def set_data(self, key, data):
+        if not isinstance(data, dict):
+            raise DataNotDictLikeError(
+                f"Data must be a dict or dict-like object, got {type(data).__name__}"
+            )
+        key, session = await self._session(key)
+        session[1] = json.dumps(data, ensure_ascii=False) if data else ""
+        self._resize(key, session)
+        self._dirty.add(key)
+
+    async def get_data(self, key):
+        _, session = await self._session(key)
+        return json.loads(session[1]) if session[1] else {}
+
+    def evict(self, exclude=None):
+        """Выгружает из памяти простаивающие сессии и самые старые сверх лимита.
+
+        Несохранённые сессии не трогаются: их изменения есть только в памяти.
+        Сессия exclude тоже остаётся — к ней обращаются прямо сейчас.
+        """
+        deadline = time.monotonic() - self.idle_ttl
+        memory = self.memory
+        victims = []
+        for key, session in self._sessions.items():
+            if session[2] >= deadline and memory <= self.memory_limit:
+                break
+            if key == exclude or key in self._dirty or key in self._flushing:
+                continue
+            victims.append((key, "idle" if session[2] < deadline else "memory"))
+            memory -= session[3]
+        for key, reason in victims:
+            self.memory -= self._sessions.pop(key)[3]
+            self.metrics.inc("bot_fsm_evicted_total", (("reason", reason),))
+        return len(victims)
+
+    async def flush(self):
+        """Записывает изменённые сессии одной транзакцией"""
+        if not self._dirty:
+            return
+        dirty, self._dirty = self._dirty, set()
+        now = time.time()
+        upserts = []
+        deletes = []
+        for key in dirty:
+            session = self._sessions.get(key)
+            if session is None or (session[0] is None and not session[1]):
+                deletes.append((key,))
+            else:
+                upserts.append((key, session[0], session[1], now))
+
+        def write(conn):
+            conn.executemany("DELETE FROM fsm_sessions WHERE key = ?", deletes)
+            conn.executemany("""
+                INSERT INTO fsm_sessions (key, state, data, updated_at) VALUES (?, ?, ?, ?)
+                ON CONFLICT(key) DO UPDATE SET
+                    state = excluded.state,
+                    data = excluded.data,
+                    updated_at = excluded.updated_at
+            """, upserts)
+
+        self._flushing = dirty
+        try:
+            await self.engine.write(write)
+        except Exception as e:
+            logger.error(f"❌ Ошибка записи состояний FSM: {e}")
+            self._dirty |= dirty
+        finally:
+            self._flushing = set()
+
+    async def expire(self):
+        """Удаляет из БД сессии, не менявшиеся дольше TTL (брошенные регистрации и т. п.)"""
+        return await self.engine.execute(
+            "DELETE FROM fsm_sessions WHERE updated_at < ?",
+            (time.time() - self.ttl,)
+        )
+
+    async def _run(self):
+        last_expire = time.monotonic()
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+            self.evict()
+            if time.monotonic() - last_expire > FSM_EXPIRE_INTERVAL:
+                last_expire = time.monotonic()
+                expired = await self.expire()
+                if expired:
+                    logger.info(f"🧹 Удалено устаревших сессий: {expired}")
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+
+# ===== БОТ И ДИСПЕТЧЕР =====
+class HandlerRegistry:
+    """Обработчики модуля; каждый экземпляр бота собирает из них свой Router.
+
+    Декораторы только запоминают обработчик с фильтрами, create_router
+    регистрирует их на новом роутере в том же порядке. Сервисы экземпляра
+    обработчики получают аргументом app (workflow_data диспетчера).
+    """
+
+    def __init__(self):
+        self._handlers = []  # (тип события, обработчик, фильтры)
+
+    def _register(self, event, filters):
+        def decorator(func):
+            self._handlers.append((event, func, filters))
+            return func
+        return decorator
+
+    def message(self, *filters):
+        return self._register("message", filters)
+
+    def callback_query(self, *filters):
+        return self._register("callback_query", filters)
+
+    def my_chat_member(self, *filters):
+        return self._register("my_chat_member", filters)
+
+    def create_router(self):
+        router = Router(name="bot")
+        for event, func, filters in self._handlers:
+            getattr(router, event).register(func, *filters)
+        return router
+
+
+handlers = HandlerRegistry()
+
+# ===== ЗАЩИТА ОТ ФЛУДА =====
+class FloodControl(BaseMiddleware):
+    """Ограничение частоты сообщений от одного пользователя.
+
+    У каждого своё ведро токенов: FLOOD_RATE сообщений в секунду, не больше
+    FLOOD_BURST подряд. Лишние сообщения отбрасываются до хендлеров и
+    обращений к БД, а пользователь один раз за серию получает предупреждение.
+    Здесь же кулдауны отдельных действий (например, отправки заявки).
+    Таблицы ограничены FLOOD_TRACKED_USERS записями.
+    """
+
+    def __init__(self, metrics, rate=FLOOD_RATE, burst=FLOOD_BURST, max_users=FLOOD_TRACKED_USERS):
+        self.metrics = metrics
+        self.rate = rate
+        self.burst = burst
+        self.max_users = max_users
+        self._buckets = OrderedDict()  # user_id -> [токены, время обновления, предупреждён]
+        self._cooldowns = OrderedDict()  # (user_id, действие) -> monotonic время окончания
+        self.cooldown_scale = 1.0  # Множитель длительности кулдаунов (bench/replay их сжимают)
+
+    def allow(self, user_id):
+        """Возвращает (пропустить, предупредить)"""
+        now = time.monotonic()
+        bucket = self._buckets.pop(user_id, None)
+        if bucket is None:
+            bucket = [self.burst, now, False]
+        else:
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+        self._buckets[user_id] = bucket
+        if len(self._buckets) > self.max_users:
+            self._buckets.popitem(last=False)
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            bucket[2] = False
+            return True, False
+        warn = not bucket[2]
+        bucket[2] = True
+        return False, warn
+
+    def cooldown_left(self, user_id, action):
+        """0 — действие разрешено, иначе сколько секунд ждать"""
+        left = self._cooldowns.get((user_id, action), 0.0) - time.monotonic()
+        if left > 0:
+            self.metrics.inc("bot_throttled_total", (("reason", action),))
+            return left
+        return 0.0
+
+    def start_cooldown(self, user_id, action, seconds):
+        """Начинает кулдаун — вызывается, когда действие действительно выполнено"""
+        key = (user_id, action)
+        self._cooldowns[key] = time.monotonic() + seconds * self.cooldown_scale
+        self._cooldowns.move_to_end(key)
+        if len(self._cooldowns) > self.max_users:
+            self._cooldowns.popitem(last=False)
+
+    async def __call__(self, handler, event, data):
+        user = event.from_user
+        if user is None or data["app"].is_admin(user.id):
+            return await handler(event, data)
+        allowed, warn = self.allow(user.id)
+        if allowed:
+            return await handler(event, data)
+        self.metrics.inc("bot_throttled_total", (("reason", "flood"),))
+        if warn:
+            await event.answer("⏳ Слишком много сообщений подряд. Подождите пару секунд.")
+        # Обработчики не вызывались — feed_update так и сообщит
+        return UNHANDLED
+
+
+# ===== РАССЫЛКА =====
+class TokenBucket:
+    """Ведро токенов: rate токенов в секунду, не больше capacity подряд"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds):
+        """Останавливает выдачу токенов (например, после RetryAfter)"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class RateLimiter:
+    """Общий лимит Telegram на отправку плюс лимит на один чат"""
+
+    def __init__(self, global_rate=TELEGRAM_GLOBAL_RATE, chat_interval=TELEGRAM_CHAT_INTERVAL,
+                 max_chats=10000):
+        self.bucket = TokenBucket(global_rate)
+        self.chat_interval = chat_interval
+        self.max_chats = max_chats
+        self._next_chat_send = OrderedDict()  # chat_id -> monotonic время следующей отправки
+
+    async def wait(self, chat_id):
+        now = time.monotonic()
+        next_send = self._next_chat_send.pop(chat_id, 0.0)
+        self._next_chat_send[chat_id] = max(now, next_send) + self.chat_interval
+        if len(self._next_chat_send) > self.max_chats:
+            self._next_chat_send.popitem(last=False)
+        if next_send > now:
+            await asyncio.sleep(next_send - now)
+        await self.bucket.acquire()
+
+    def pause(self, seconds):
+        self.bucket.pause(seconds)
+
+
+SEND_OK = "sent"
+SEND_FAILED = "failed"
+SEND_BLOCKED = "blocked"
+SEND_SKIPPED = "skipped"
+
+# Статусы рассылки
+BROADCAST_RUNNING = "running"
+BROADCAST_PAUSED = "paused"
+BROADCAST_CANCELLED = "cancelled"
+BROADCAST_DONE = "done"
+
+# Состояние доставки одному получателю
+RECIPIENT_PENDING = 0
+RECIPIENT_SENDING = 1
+RECIPIENT_SENT = 2
+RECIPIENT_FAILED = 3
+RECIPIENT_BLOCKED = 4
+
+RECIPIENT_STATES = {
+    SEND_OK: RECIPIENT_SENT,
+    SEND_FAILED: RECIPIENT_FAILED,
+    SEND_BLOCKED: RECIPIENT_BLOCKED,
+    SEND_SKIPPED: RECIPIENT_PENDING,
+}
+
+
+class BroadcastResult:
+    def __init__(self):
+        self.total = 0
+        self.sent = 0
+        self.failed = 0
+        self.blocked_ids = []
+
+    @property
+    def blocked(self):
+        return len(self.blocked_ids)
+
+
+class Broadcaster:
+    """Рассылка с несколькими одновременными запросами в пределах лимитов Telegram.
+
+    recipients — обычный или асинхронный итератор кортежей, первый элемент
+    которых chat_id; send(recipient) — корутина отправки одному получателю.
+    """
+
+    def __init__(self, limiter, concurrency=BROADCAST_CONCURRENCY,
+                 max_retries=BROADCAST_MAX_RETRIES):
+        self.limiter = limiter
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+
+    async def run(self, recipients, send, on_result=None, is_stopped=None):
+        result = BroadcastResult()
+        queue = asyncio.Queue(maxsize=self.concurrency * 2)
+
+        async def produce():
+            if hasattr(recipients, "__aiter__"):
+                async for recipient in recipients:
+                    await queue.put(recipient)
+            else:
+                for recipient in recipients:
+                    await queue.put(recipient)
+            for _ in range(self.concurrency):
+                await queue.put(None)
+
+        async def process(recipient):
+            if is_stopped is not None and is_stopped():
+                # Рассылку остановили — остаток очереди не отправляем
+                if on_result is not None:
+                    on_result(recipient, SEND_SKIPPED, None)
+                return
+            try:
+                outcome, error = await self.deliver(recipient, send)
+            except Exception as e:
+                # Ошибка не от Telegram (например, в самом send) — это сбой одного получателя
+                logger.error(f"❌ Ошибка отправки {recipient[0]}: {e!r}")
+                outcome, error = SEND_FAILED, repr(e)
+            result.total += 1
+            if outcome == SEND_OK:
+                result.sent += 1
+            else:
+                result.failed += 1
+                if outcome == SEND_BLOCKED:
+                    result.blocked_ids.append(recipient[0])
+                logger.info(f"Не доставлено {recipient[0]}: {error}")
+            if on_result is not None:
+                on_result(recipient, outcome, error)
+
+        async def work():
+            while True:
+                recipient = await queue.get()
+                if recipient is None:
+                    return
+                try:
+                    await process(recipient)
+                except Exception as e:
+                    # Сломался учёт результата — рассылка продолжается
+                    logger.error(f"❌ Ошибка обработки получателя {recipient[0]}: {e!r}")
+
+        # Производитель и обработчики ждутся вместе: упади что-то одно,
+        # остальное отменяется, а не висит на заполненной очереди
+        tasks = [asyncio.create_task(produce())]
+        tasks += [asyncio.create_task(work()) for _ in range(self.concurrency)]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        return result
+
+    async def deliver(self, recipient, send):
+        """Отправляет одно сообщение; возвращает (исход, текст ошибки)"""
+        chat_id = recipient[0]
+        attempt = 0
+        while True:
+            await self.limiter.wait(chat_id)
+            try:
+                await send(recipient)
+                return SEND_OK, None
+            except TelegramRetryAfter as e:
+                # Флуд-контроль действует на весь бот — притормаживаем всех
+                self.limiter.pause(e.retry_after)
+                logger.warning(f"⏳ Флуд-контроль Telegram, пауза {e.retry_after} с")
+            except TelegramForbiddenError as e:
+                return SEND_BLOCKED, e.message
+            except TelegramMigrateToChat as e:
+                chat_id = e.migrate_to_chat_id
+                recipient = (chat_id,) + tuple(recipient[1:])
+            except (TelegramNetworkError, TelegramServerError) as e:
+                attempt += 1
+                if attempt > self.max_retries:
+                    return SEND_FAILED, e.message
+                await asyncio.sleep(min(2 ** attempt, 30) * (0.5 + random.random()))
+            except TelegramAPIError as e:
+                return SEND_FAILED, e.message
+
+
+
+class Audience:
+    """Фильтры получателей рассылки.
+
+    Каждое условие ложится на свой индекс users: место работы — idx_workplace,
+    активность — idx_last_active, дата регистрации — idx_registered_at.
+    """
+
+    ACTIVE_KEYS = ("активные", "active")
+    SINCE_KEYS = ("после", "since")
+    DATE_FORMATS = ("%Y-%m-%d", "%d.%m.%Y")
+
+    def __init__(self, workplaces=(), active_days=None, registered_after=None):
+        self.workplaces = list(workplaces)
+        self.active_days = active_days
+        self.registered_after = registered_after
+
+    @classmethod
+    def parse(cls, text, workplaces):
+        """Снимает фильтры с начала текста /send; возвращает (Audience, остаток).
+
+        workplaces — места работы из справочника.
+        @Место — место работы из справочника (можно несколько),
+        активные:N — заходили за последние N дней,
+        после:ДД.ММ.ГГГГ — зарегистрировались с этой даты.
+        """
+        audience = cls()
+        rest = text.strip()
+        while rest:
+            if rest.startswith("@"):
+                workplace = cls._match_workplace(rest[1:], workplaces)
+                if workplace is None:
+                    raise ValueError("после @ должно идти место работы из справочника")
+                audience.workplaces.append(workplace)
+                rest = rest[1 + len(workplace):].lstrip()
+                continue
+            word = rest.split(maxsplit=1)[0]
+            key, _, value = word.partition(":")
+            key = key.lower()
+            if key in cls.ACTIVE_KEYS and value:
+                if not value.isdigit() or int(value) == 0:
+                    raise ValueError("активные:N — N это число дней, например активные:7")
+                audience.active_days = int(value)
+            elif key in cls.SINCE_KEYS and value:
+                audience.registered_after = cls._parse_date(value)
+            else:
+                break
+            rest = rest[len(word):].lstrip()
+        return audience, rest
+
+    @staticmethod
+    def _match_workplace(text, workplaces):
+        """Самое длинное место работы, с которого начинается text (в названиях бывают пробелы)"""
+        matches = [
+            workplace for workplace in workplaces
+            if text.startswith(workplace) and text[len(workplace):len(workplace) + 1] in ("", " ", "\n")
+        ]
+        return max(matches, key=len, default=None)
+
+    @classmethod
+    def _parse_date(cls, value):
+        for fmt in cls.DATE_FORMATS:
+            try:
+                return datetime.datetime.strptime(value, fmt).date()
+            except ValueError:
+                pass
+        raise ValueError("после:ДД.ММ.ГГГГ — дата регистрации, например после:01.09.2024")
+
+    def where(self):
+        """Условие WHERE для users и его параметры.
+
+        При любом фильтре is_blocked пишется как +is_blocked: так SQLite
+        не берёт малоизбирательный idx_is_blocked вместо индекса фильтра.
+        """
+        filtered = self.workplaces or self.active_days or self.registered_after
+        conditions = ["+is_blocked = 0" if filtered else "is_blocked = 0"]
+        params = []
+        if self.workplaces:
+            conditions.append(f"workplace IN ({', '.join('?' * len(self.workplaces))})")
+            params.extend(self.workplaces)
+        if self.active_days:
+            conditions.append("last_active >= datetime('now', ?)")
+            params.append(f"-{self.active_days} days")
+        if self.registered_after:
+            conditions.append("registered_at >= ?")
+            params.append(self.registered_after.isoformat())
+        return " AND ".join(conditions), params
+
+    def describe(self):
+        parts = []
+        if self.workplaces:
+            parts.append(", ".join(self.workplaces))
+        if self.active_days:
+            parts.append(f"активные за {self.active_days} дн.")
+        if self.registered_after:
+            parts.append(f"с {self.registered_after:%d.%m.%Y}")
+        return "; ".join(parts) or "все сотрудники"
+
+
+class MessageTemplate:
+    """Текст рассылки с подстановками {name} и {workplace}; {{ и }} — сами скобки.
+
+    Шаблон разбирается один раз: дальше подстановка для каждого получателя —
+    одна склейка готовых кусков. Текст без подстановок собирается сразу
+    и отдаётся всем как есть.
+    """
+
+    FIELDS = ("name", "workplace")
+    FIELD_MAX_LENGTH = 64  # имя — до 50 символов, место работы — до 64
+
+    def __init__(self, text):
+        self.parts = []
+        fields = 0
+        try:
+            parsed = list(string.Formatter().parse(text))
+        except ValueError:
+            raise ValueError("непарная фигурная скобка — для самой скобки пишите {{ или }}") from None
+        for literal, field, spec, conversion in parsed:
+            if literal:
+                self.parts.append(literal)
+            if field is None:
+                continue
+            if field not in self.FIELDS:
+                raise ValueError(f"неизвестная подстановка {{{field}}} — доступны {{name}} и {{workplace}}")
+            if spec or conversion:
+                raise ValueError(f"пишите подстановку без формата: {{{field}}}")
+            self.parts.append(self.FIELDS.index(field))
+            fields += 1
+        self.static = None if fields else "".join(self.parts)
+        self.max_length = sum(len(part) for part in self.parts if isinstance(part, str)) \
+            + fields * self.FIELD_MAX_LENGTH
+
+    def render(self, values):
+        """values — (имя, место работы) получателя"""
+        if self.static is not None:
+            return self.static
+        return "".join(part if isinstance(part, str) else values[part] for part in self.parts)
+
+
+# animation раньше document: у GIF Telegram заполняет оба поля
+MEDIA_KINDS = ("photo", "video", "animation", "audio", "document")
+ALBUM_MEDIA = {
+    "photo": InputMediaPhoto,
+    "video": InputMediaVideo,
+    "audio": InputMediaAudio,
+    "document": InputMediaDocument,
+}
+
+
+def message_media(message):
+    """(тип, file_id) вложения сообщения или None"""
+    for kind in MEDIA_KINDS:
+        content = getattr(message, kind)
+        if content:
+            # Фото приходит набором размеров — берём самый большой
+            return kind, (content[-1] if kind == "photo" else content).file_id
+    return None
+
+
+class AlbumCollector:
+    """Собирает альбом из отдельных сообщений с одним media_group_id.
+
+    Telegram присылает части альбома разными обновлениями, а обработчики
+    одного пользователя выполняются по очереди, поэтому ждать остальные
+    части внутри обработчика нельзя. Каждая часть перезапускает таймер;
+    когда MEDIA_GROUP_WAIT секунд новых частей нет, альбом целиком
+    передаётся в on_album.
+    """
+
+    def __init__(self, on_album, wait=MEDIA_GROUP_WAIT):
+        self.on_album = on_album
+        self.wait = wait
+        self.albums = {}  # media_group_id -> [сообщения]
+        self._timers = {}
+
+    def add(self, message):
+        group_id = message.media_group_id
+        self.albums.setdefault(group_id, []).append(message)
+        timer = self._timers.pop(group_id, None)
+        if timer is not None:
+            timer.cancel()
+        self._timers[group_id] = asyncio.create_task(self._flush(group_id))
+
+    async def close(self):
+        """Обрабатывает недособранные альбомы сразу, не дожидаясь таймеров"""
+        timers, self._timers = self._timers, {}
+        for timer in timers.values():
+            timer.cancel()
+        await asyncio.gather(*timers.values(), return_exceptions=True)
+        for group_id in list(self.albums):
+            await self._flush(group_id, wait=0)
+
+    async def _flush(self, group_id, wait=None):
+        await asyncio.sleep(self.wait if wait is None else wait)
+        self._timers.pop(group_id, None)
+        album = sorted(self.albums.pop(group_id, []), key=lambda message: message.message_id)
+        try:
+            await self.on_album(album)
+        except Exception as e:
+            logger.error(f"❌ Ошибка обработки альбома {group_id}: {e}")
+
+
+
+class BroadcastJob:
+    """Рассылка, сохранённая в БД, с состоянием доставки по каждому получателю.
+
+    Получатели захватываются пачками, результаты периодически сбрасываются
+    в БД, поэтому после перезапуска рассылка продолжается без дублей.
+    Статус рассылки читается из БД перед каждой пачкой — так пауза и отмена
+    работают, даже если команду принял другой процесс.
+    """
+
+    def __init__(self, app, job_id, text, admin_chat_id, status_message_id=None, media=None):
+        self.app = app
+        self.id = job_id
+        self.text = text
+        self.template = MessageTemplate(BROADCAST_HEADER + text)
+        self.media = media or []  # [(тип, file_id)]; текст тогда идёт подписью
+        self.admin_chat_id = admin_chat_id
+        self.status_message_id = status_message_id
+        self.status = BROADCAST_RUNNING
+        self.shutting_down = False
+        self.counts = {}
+        self._results = []
+        self._blocked_ids = []
+        self._wakeup = asyncio.Event()
+        self._last_report = None
+
+    @property
+    def total(self):
+        return sum(self.counts.values())
+
+    def request(self, status):
+        """Применяет новый статус сразу, не дожидаясь следующей пачки"""
+        self.status = status
+        self._wakeup.set()
+
+    def shutdown(self):
+        """Остановка процесса: новых отправок нет, рассылка остаётся «идёт».
+
+        Начатые отправки доходят, а получатели из очереди возвращаются
+        в «ожидает» — после перезапуска рассылка продолжится с них.
+        """
+        self.shutting_down = True
+        self._wakeup.set()
+
+    def is_stopped(self):
+        return self.shutting_down or self.status != BROADCAST_RUNNING
+
+    async def run(self):
+        self.counts = await self.app.db.get_broadcast_counts(self.id)
+        reporter = asyncio.create_task(self._report_loop())
+        try:
+            await self.app.broadcaster.run(
+                self._recipients(),
+                self.send,
+                on_result=self._record,
+                is_stopped=self.is_stopped
+            )
+            await self._flush()
+            if self.status == BROADCAST_RUNNING and not self.shutting_down:
+                await self.app.db.set_broadcast_status(self.id, BROADCAST_DONE)
+                self.status = BROADCAST_DONE
+        finally:
+            reporter.cancel()
+            await self._flush()
+            await self._report()
+
+    def render(self, values):
+        """Текст для получателя; values — (имя, место работы)"""
+        return self.template.render(values)
+
+    def send(self, recipient):
+        """Запрос к API для одного получателя.
+
+        Файлы уже лежат на серверах Telegram (их загрузил админ), поэтому
+        каждому получателю уходит только file_id — без повторной загрузки.
+        """
+        chat_id = recipient[0]
+        text = self.render(recipient[1:])
+        if not self.media:
+            return self.app.bot.send_message(chat_id, text)
+        if len(self.media) == 1:
+            kind, file_id = self.media[0]
+            return getattr(self.app.bot, f"send_{kind}")(chat_id, file_id, caption=text)
+        return self.app.bot.send_media_group(chat_id, [
+            ALBUM_MEDIA[kind](media=file_id, caption=text if index == 0 else None)
+            for index, (kind, file_id) in enumerate(self.media)
+        ])
+
+    async def _recipients(self):
+        while True:
+            if not await self._wait_running():
+                return
+            await self._flush()
+            batch = await self.app.db.claim_broadcast_batch(self.id, BROADCAST_BATCH_SIZE)
+            if not batch:
+                return
+            self._move(RECIPIENT_PENDING, RECIPIENT_SENDING, len(batch))
+            for recipient in batch:
+                yield recipient
+
+    def _move(self, from_state, to_state, count):
+        self.counts[from_state] = self.counts.get(from_state, 0) - count
+        self.counts[to_state] = self.counts.get(to_state, 0) + count
+
+    async def _wait_running(self):
+        """Ждёт, пока рассылка на паузе; False — если её отменили"""
+        while True:
+            self._wakeup.clear()
+            if self.shutting_down:
+                return False
+            self.status = await self.app.db.get_broadcast_status(self.id)
+            if self.status == BROADCAST_RUNNING:
+                return True
+            if self.status != BROADCAST_PAUSED:
+                return False
+            await self._flush()
+            await self._report()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), BROADCAST_PROGRESS_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+    def _record(self, recipient, outcome, error):
+        state = RECIPIENT_STATES[outcome]
+        self._results.append((state, error, recipient[0]))
+        if outcome == SEND_BLOCKED:
+            self._blocked_ids.append(recipient[0])
+        self._move(RECIPIENT_SENDING, state, 1)
+
+    async def _flush(self):
+        results, self._results = self._results, []
+        blocked_ids, self._blocked_ids = self._blocked_ids, []
+        await self.app.db.save_broadcast_results(self.id, results)
+        await self.app.db.mark_users_blocked(blocked_ids)
 
-if not BOT_TOKEN:
-    print("❌ Токен не найден!")
-    exit(1)
+    async def _report_loop(self):
+        while True:
+            await asyncio.sleep(BROADCAST_PROGRESS_INTERVAL)
+            await self._flush()
+            await self._report()
 
-# ===== НАСТРОЙКИ =====
-DB_PATH = "users.db"
+    def progress_text(self):
+        counts = self.counts
+        sent = counts.get(RECIPIENT_SENT, 0)
+        blocked = counts.get(RECIPIENT_BLOCKED, 0)
+        failed = counts.get(RECIPIENT_FAILED, 0) + blocked
+        done = sent + failed
+        if self.status == BROADCAST_DONE:
+            header = "✅ Рассылка завершена"
+        elif self.status == BROADCAST_CANCELLED:
+            header = "⛔ Рассылка отменена"
+        elif self.status == BROADCAST_PAUSED:
+            header = "⏸ Рассылка на паузе"
+        elif self.shutting_down:
+            header = "🔁 Бот перезапускается, продолжу рассылку"
+        else:
+            header = "📤 Идёт рассылка"
+        text = (
+            f"{header} #{self.id}\n\n"
+            f"📊 Всего: {self.total}\n"
+            f"📨 Обработано: {done}\n"
+            f"✅ Доставлено: {sent}\n"
+            f"❌ Ошибок: {failed}"
+        )
+        if blocked > 0:
+            text += f"\n🚫 Заблокировали бота: {blocked}"
+        if self.status in (BROADCAST_RUNNING, BROADCAST_PAUSED):
+            text += f"\n\n/pause_send {self.id} · /resume_send {self.id} · /cancel_send {self.id}"
+        return text
 
-# ===== ЛОГИРОВАНИЕ =====
-logging.basicConfig(level=logging.INFO)
-logger = logging.getLogger(__name__)
+    async def _report(self):
+        """Обновляет сообщение со статусом, если прогресс изменился"""
+        if not self.status_message_id:
+            # Рассылку из другого процесса могли подхватить раньше, чем он отправил это сообщение
+            row = await self.app.db.get_broadcast(self.id)
+            self.status_message_id = row[4] if row else None
+        if not self.status_message_id:
+            return
+        text = self.progress_text()
+        if text == self._last_report:
+            return
+        self._last_report = text
+        try:
+            await self.app.bot.edit_message_text(
+                text=text,
+                chat_id=self.admin_chat_id,
+                message_id=self.status_message_id
+            )
+        except TelegramAPIError as e:
+            logger.warning(f"Не удалось обновить статус рассылки #{self.id}: {e}")
 
-# ===== СОЗДАЁМ БОТА =====
-bot = Bot(token=BOT_TOKEN)
-dp = Dispatcher(storage=MemoryStorage())
 
-# ===== БАЗА ДАННЫХ =====
-class Database:
-    @staticmethod
-    def init_db():
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY,
-                name TEXT NOT NULL,
-                workplace TEXT NOT NULL,
-                registered_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                is_blocked INTEGER DEFAULT 0,
-                last_active TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+class BroadcastManager:
+    """Запущенные в этом процессе рассылки.
+
+    Если процессов несколько, рассылки выполняет только обработчик 0:
+    в остальных runs_jobs = False и рассылка лишь сохраняется в БД, а он
+    находит её там (watch).
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.runs_jobs = True
+        self.jobs = {}
+        self._tasks = {}
+        self._failed = set()  # упавшие рассылки не перезапускаются до рестарта
+        self._watcher = None
+
+    def launch(self, job):
+        if not self.runs_jobs:
+            return job
+        self.jobs[job.id] = job
+        task = asyncio.create_task(job.run())
+        self._tasks[job.id] = task
+        task.add_done_callback(lambda t: self._finished(job, t))
+        return job
+
+    def _finished(self, job, task):
+        self.jobs.pop(job.id, None)
+        self._tasks.pop(job.id, None)
+        if not task.cancelled() and task.exception():
+            self._failed.add(job.id)
+            logger.error(f"❌ Рассылка #{job.id} упала: {task.exception()}")
+
+    async def start(self, text, admin_chat_id, audience, media=None):
+        job_id, total = await self.app.db.create_broadcast(text, admin_chat_id, audience, media)
+        if job_id is None:
+            return None, 0
+        return BroadcastJob(self.app, job_id, text, admin_chat_id, media=media), total
+
+    async def resume_all(self, recover=True):
+        """Продолжает рассылки, прерванные перезапуском"""
+        if recover:
+            await self.app.db.recover_interrupted_broadcasts()
+        for job_id, text, status, admin_chat_id, status_message_id, media in \
+                await self.app.db.get_unfinished_broadcasts():
+            if job_id in self.jobs or job_id in self._failed:
+                continue
+            logger.info(f"🔁 Продолжаю рассылку #{job_id}")
+            self.launch(BroadcastJob(self.app, 
+                job_id, text, admin_chat_id, status_message_id, json.loads(media) if media else None
+            ))
+
+    async def set_status(self, job_id, status):
+        changed = await self.app.db.set_broadcast_status(job_id, status)
+        job = self.jobs.get(job_id)
+        if job and changed:
+            job.request(status)
+        elif changed and status == BROADCAST_RUNNING and self.runs_jobs:
+            # Рассылка могла остаться на паузе с прошлого запуска
+            row = await self.app.db.get_broadcast(job_id)
+            if row:
+                self.launch(BroadcastJob(self.app, row[0], row[1], row[3], row[4], json.loads(row[5]) if row[5] else None))
+        return changed
+
+    def watch(self, interval=WORKER_POLL_INTERVAL):
+        """Подхватывает рассылки, созданные или продолженные в других процессах"""
+        self._watcher = asyncio.create_task(self._watch(interval))
+
+    async def _watch(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.resume_all(recover=False)
+            except Exception as e:
+                logger.error(f"❌ Ошибка проверки новых рассылок: {e}")
+
+    async def stop(self, timeout=BROADCAST_STOP_TIMEOUT):
+        """Останавливает рассылки процесса с сохранением прогресса.
+
+        Кто не успел за timeout, прерывается: его захваченные получатели
+        после перезапуска считаются ошибкой (recover_interrupted_broadcasts),
+        так что дублей не будет.
+        """
+        if self._watcher is not None:
+            self._watcher.cancel()
+            await asyncio.gather(self._watcher, return_exceptions=True)
+            self._watcher = None
+        for job in self.jobs.values():
+            job.shutdown()
+        tasks = list(self._tasks.values())
+        if not tasks:
+            return
+        _, pending = await asyncio.wait(tasks, timeout=timeout)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if pending:
+            logger.warning(f"⚠️ Рассылок, прерванных по таймауту: {len(pending)}")
+
+
+# ===== ЗАЯВКИ =====
+class TicketGroup:
+    """Заявки с одной проблемой в одном чате админа, собранные в одно сообщение"""
+
+    def __init__(self, chat_id, problem):
+        self.chat_id = chat_id
+        self.problem = problem
+        self.opened_at = time.monotonic()
+        self.message_id = None  # None — первая заявка ещё отправляется
+        self.shown = OrderedDict()  # ticket_id -> (name, workplace, user_id), уже в сообщении
+        self.pending = {}  # ticket_id -> (name, workplace, user_id), ждут правки сообщения
+        self.last_edit = 0.0
+        self.task = None
+
+    def render(self):
+        minutes = max(1, round((time.monotonic() - self.opened_at) / 60))
+        text = f"🚨 {self.problem} — заявок: {len(self.shown)} за {minutes} мин\n\n"
+        hidden = len(self.shown) - TICKET_GROUP_SHOWN
+        if hidden > 0:
+            text += f"… и ещё {hidden} раньше\n"
+        for ticket_id, (name, workplace, user_id) in list(self.shown.items())[-TICKET_GROUP_SHOWN:]:
+            text += f"• {name} — {workplace} (#{ticket_id}, ID: {user_id})\n"
+        return text
+
+
+class TicketAggregator:
+    """Сводные сообщения о заявках во время наплыва.
+
+    Первая заявка с проблемой уходит админу сразу отдельным сообщением.
+    Следующие с той же проблемой в течение TICKET_GROUP_WINDOW дописываются
+    в это сообщение через edit_message_text — не чаще раза в
+    TICKET_EDIT_INTERVAL. Заявка отмечается доставленной, только когда
+    попала в отправленный текст; при ошибке она возвращается в очередь.
+    """
+
+    def __init__(self, app, window=TICKET_GROUP_WINDOW, edit_interval=TICKET_EDIT_INTERVAL):
+        self.app = app
+        self.window = window
+        self.edit_interval = edit_interval
+        self.groups = {}  # (chat_id, problem) -> TicketGroup
+
+    def _open_group(self, chat_id, problem):
+        group = self.groups.get((chat_id, problem))
+        if group is not None and time.monotonic() - group.opened_at > self.window:
+            # Правка старого сообщения не даёт уведомления — пора начать новое
+            self._close(group)
+            group = None
+        return group
+
+    def _close(self, group):
+        if self.groups.get((group.chat_id, group.problem)) is group:
+            del self.groups[(group.chat_id, group.problem)]
+
+    async def deliver(self, chat_id, ticket):
+        ticket_id, user_id, name, workplace, problem, attempts = ticket
+        group = self._open_group(chat_id, problem)
+        if group is not None:
+            if ticket_id not in group.shown:
+                group.pending[ticket_id] = (name, workplace, user_id)
+                self._schedule(group)
+            return
+
+        group = self.groups[(chat_id, problem)] = TicketGroup(chat_id, problem)
+        group.shown[ticket_id] = (name, workplace, user_id)
+        try:
+            await self.app.send_limiter.wait(chat_id)
+            sent = await self.app.bot.send_message(
+                chat_id,
+                f"🚨 Новая заявка #{ticket_id}!\n\n"
+                f"👤 Имя: {name}\n"
+                f"📍 Место: {workplace}\n"
+                f"❓ Проблема: {problem}\n"
+                f"🆔 ID: {user_id}",
+                reply_markup=TICKET_KEYBOARD
             )
-        """)
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_is_blocked ON users(is_blocked)")
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_last_active ON users(last_active)")
-        conn.commit()
-        conn.close()
-        logger.info("✅ База данных сотрудников создана")
+        except TelegramAPIError as e:
+            self._close(group)
+            # Присоединившиеся, пока шла отправка, подождут вместе с первой заявкой
+            joined = list(group.pending)
+            if isinstance(e, TelegramRetryAfter):
+                self.app.send_limiter.pause(e.retry_after)
+                await self.app.db.retry_tickets([ticket_id] + joined, e.retry_after, e.message, count_attempt=False)
+            elif isinstance(e, TelegramBadRequest):
+                # Повтор не поможет — запрос некорректен
+                logger.error(f"❌ Заявка #{ticket_id} не может быть доставлена: {e}")
+                await self.app.db.fail_ticket(ticket_id, e.message)
+                await self.app.db.retry_tickets(joined, 0, None, count_attempt=False)
+            else:
+                delay = min(TICKET_RETRY_BASE * 2 ** attempts, TICKET_RETRY_MAX)
+                delay *= 0.5 + random.random()
+                logger.error(f"❌ Ошибка отправки заявки #{ticket_id} админу: {e}, повтор через {delay:.0f} с")
+                await self.app.db.retry_tickets([ticket_id], delay, e.message)
+                await self.app.db.retry_tickets(joined, delay, e.message, count_attempt=False)
+            return
 
-    @staticmethod
-    def get_user(user_id):
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute(
-            "SELECT name, workplace, is_blocked FROM users WHERE user_id = ?", 
-            (user_id,)
-        )
-        user = cursor.fetchone()
-        conn.close()
-        return user
+        group.message_id = sent.message_id
+        group.last_edit = time.monotonic()
+        await self.app.db.mark_tickets_delivered([ticket_id], sent.message_id)
+        logger.info(f"✅ Заявка #{ticket_id} отправлена админу от {name}")
+        self._schedule(group)
 
-    @staticmethod
-    def save_user(user_id, name, workplace):
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute("""
-            INSERT INTO users (user_id, name, workplace, last_active) 
-            VALUES (?, ?, ?, CURRENT_TIMESTAMP)
-            ON CONFLICT(user_id) DO UPDATE SET 
-                name = excluded.name,
-                workplace = excluded.workplace,
-                is_blocked = 0,
-                last_active = CURRENT_TIMESTAMP
-        """, (user_id, name, workplace))
-        conn.commit()
-        conn.close()
-        return True
+    def _schedule(self, group):
+        if group.pending and group.message_id is not None and group.task is None:
+            group.task = asyncio.create_task(self._flush_loop(group))
 
-    @staticmethod
-    def mark_user_blocked(user_id):
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute(
-            "UPDATE users SET is_blocked = 1 WHERE user_id = ?", 
-            (user_id,)
-        )
-        conn.commit()
-        conn.close()
+    async def _flush_loop(self, group):
+        try:
+            while group.pending:
+                await asyncio.sleep(max(group.last_edit + self.edit_interval - time.monotonic(), 0))
+                await self._flush(group)
+        except Exception as e:
+            # Неотмеченные заявки снова станут доступны по TICKET_CLAIM_TIMEOUT
+            logger.error(f"❌ Ошибка обновления сводки «{group.problem}»: {e}")
+        finally:
+            group.task = None
 
-    @staticmethod
-    def mark_user_unblocked(user_id):
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute(
-            "UPDATE users SET is_blocked = 0, last_active = CURRENT_TIMESTAMP WHERE user_id = ?", 
-            (user_id,)
+    async def _flush(self, group):
+        """Дописывает накопившиеся заявки в сводное сообщение"""
+        pending, group.pending = group.pending, {}
+        group.shown.update(pending)
+        ticket_ids = list(pending)
+        try:
+            await self.app.send_limiter.wait(group.chat_id)
+            await self.app.bot.edit_message_text(
+                text=group.render(),
+                chat_id=group.chat_id,
+                message_id=group.message_id,
+                reply_markup=TICKET_KEYBOARD
+            )
+        except TelegramAPIError as e:
+            for ticket_id in ticket_ids:
+                group.shown.pop(ticket_id, None)
+            if isinstance(e, TelegramRetryAfter):
+                self.app.send_limiter.pause(e.retry_after)
+                await self.app.db.retry_tickets(ticket_ids, e.retry_after, e.message, count_attempt=False)
+                return
+            # Сообщение удалено или его нельзя править — заявки откроют новую группу
+            logger.warning(f"⚠️ Не удалось обновить сводку «{group.problem}»: {e}")
+            self._close(group)
+            joined, group.pending = list(group.pending), {}
+            await self.app.db.retry_tickets(joined, 0, None, count_attempt=False)
+            if isinstance(e, TelegramBadRequest):
+                await self.app.db.retry_tickets(ticket_ids, 0, e.message, count_attempt=False)
+            else:
+                await self.app.db.retry_tickets(ticket_ids, TICKET_RETRY_BASE, e.message)
+            return
+        group.last_edit = time.monotonic()
+        await self.app.db.mark_tickets_delivered(ticket_ids, group.message_id)
+        logger.info(f"✅ Заявки {', '.join(f'#{i}' for i in ticket_ids)} добавлены в сводку «{group.problem}»")
+
+    async def stop(self):
+        """Останавливает правки; неотмеченные заявки вернутся в очередь по TICKET_CLAIM_TIMEOUT"""
+        tasks = [group.task for group in self.groups.values() if group.task]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.groups.clear()
+
+
+class TicketDispatcher:
+    """Фоновая доставка заявок админу из очереди в таблице tickets.
+
+    Заявка сначала сохраняется в БД и подтверждается сотруднику, а эта
+    задача доставляет её с повторами и нарастающей паузой между попытками.
+    Если процессов несколько, задача работает только в обработчике 0;
+    о заявках других процессов она узнаёт, проверяя БД раз в poll_interval.
+    """
+
+    def __init__(self, app, batch_size=TICKET_BATCH_SIZE):
+        self.app = app
+        self.batch_size = batch_size
+        self.aggregator = TicketAggregator(app)
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._poll_interval = None
+
+    def notify(self):
+        """Появилась новая заявка — не ждать следующего опроса"""
+        self._wakeup.set()
+
+    def start(self, poll_interval=None):
+        self._poll_interval = poll_interval
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.aggregator.stop()
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            try:
+                delay = await self.dispatch_due()
+            except Exception as e:
+                logger.error(f"❌ Ошибка очереди заявок: {e}")
+                delay = TICKET_POLL_INTERVAL
+            await self._sleep(delay)
+
+    async def _sleep(self, delay):
+        """Ждёт notify, delay секунд или заявку, созданную другим процессом"""
+        deadline = time.monotonic() + delay
+        while True:
+            timeout = deadline - time.monotonic()
+            if self._poll_interval is not None:
+                timeout = min(timeout, self._poll_interval)
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), max(timeout, 0))
+                return
+            except asyncio.TimeoutError:
+                pass
+            if time.monotonic() >= deadline:
+                return
+            try:
+                next_attempt = await self.app.db.next_ticket_attempt()
+            except Exception:
+                return  # ошибку покажет dispatch_due
+            if next_attempt is not None and next_attempt <= time.time():
+                return
+
+    async def dispatch_due(self):
+        """Доставляет созревшие заявки; возвращает паузу до следующей проверки"""
+        while True:
+            tickets = await self.app.db.claim_due_tickets(self.batch_size)
+            if not tickets:
+                break
+            await asyncio.gather(*(self.deliver(ticket) for ticket in tickets))
+        next_attempt = await self.app.db.next_ticket_attempt()
+        if next_attempt is None:
+            return TICKET_POLL_INTERVAL
+        return min(max(next_attempt - time.time(), 0.1), TICKET_POLL_INTERVAL)
+
+    async def deliver(self, ticket):
+        # Заявки, созданные до появления назначений, — главному админу
+        await self.aggregator.deliver(ticket[6] or ADMIN_ID, ticket[:6])
+
+
+
+class TicketRouter:
+    """Назначение заявок админам.
+
+    Админы и их маршруты (места работы и проблемы) хранятся в БД, в памяти —
+    их копия и индекс открытых заявок по админам. Заявка достаётся наименее
+    загруженному из подходящих админов на смене: сначала тем, за кем
+    закреплена её проблема, затем её место работы, затем админам без
+    маршрутов и, наконец, любому на смене; если на смене никого — ADMIN_ID.
+    Заявку, которую не взяли в работу за TICKET_ACK_TIMEOUT, основной
+    процесс передаёт следующему подходящему админу.
+
+    Каждый процесс перечитывает админов и нагрузку раз в
+    ADMIN_REFRESH_INTERVAL, так что назначения из других процессов
+    учитываются с этой задержкой.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.admins = {}  # admin_id -> (имя, на смене)
+        self.routes = {}  # (вид, название) -> множество admin_id
+        self.routed = set()  # админы, у которых есть хоть один маршрут
+        self.open = {}  # admin_id -> {ticket_id: время создания}
+        self._task = None
+
+    def is_admin(self, user_id):
+        return user_id == ADMIN_ID or user_id in self.admins
+
+    async def load(self):
+        admins = await self.app.db.get_admins()
+        routes = await self.app.db.get_admin_routes()
+        tickets = await self.app.db.get_open_tickets(TICKET_OPEN_TTL)
+        self.admins = {admin_id: (name, bool(on_call)) for admin_id, name, on_call in admins}
+        self.routes = {}
+        for admin_id, kind, value in routes:
+            self.routes.setdefault((kind, value), set()).add(admin_id)
+        self.routed = {admin_id for admin_id, _, _ in routes}
+        self.open = {}
+        for ticket_id, admin_id, created in tickets:
+            self.open.setdefault(admin_id, {})[ticket_id] = created
+
+    def load_of(self, admin_id):
+        """Открытые заявки админа (старше TICKET_OPEN_TTL не считаются)"""
+        tickets = self.open.get(admin_id)
+        if not tickets:
+            return 0
+        deadline = time.time() - TICKET_OPEN_TTL
+        for ticket_id in [ticket_id for ticket_id, created in tickets.items() if created < deadline]:
+            del tickets[ticket_id]
+        return len(tickets)
+
+    def choose(self, workplace, problem, exclude=()):
+        """Наименее загруженный подходящий админ на смене или None"""
+        on_call = {admin_id for admin_id, (_, active) in self.admins.items() if active} - set(exclude)
+        for group in (
+            self.routes.get(("problem", problem), set()),
+            self.routes.get(("workplace", workplace), set()),
+            on_call - self.routed,
+            on_call,
+        ):
+            eligible = on_call & group
+            if eligible:
+                return min(eligible, key=lambda admin_id: (self.load_of(admin_id), random.random()))
+        return None
+
+    def _track(self, admin_id, ticket_id):
+        self.open.setdefault(admin_id, {})[ticket_id] = time.time()
+
+    async def create_ticket(self, user_id, name, workplace, problem):
+        admin_id = self.choose(workplace, problem) or ADMIN_ID
+        ticket_id = await self.app.db.create_ticket(user_id, name, workplace, problem, admin_id)
+        self._track(admin_id, ticket_id)
+        return ticket_id
+
+    def closed(self, admin_id, ticket_ids):
+        tickets = self.open.get(admin_id, {})
+        for ticket_id in ticket_ids:
+            tickets.pop(ticket_id, None)
+
+    async def reassign(self, tickets, fallback=None):
+        """tickets — (id, место, проблема, текущий админ); возвращает число переданных"""
+        moved = 0
+        for ticket_id, workplace, problem, admin_id in tickets:
+            new_admin = self.choose(workplace, problem, exclude=(admin_id,)) or fallback
+            if new_admin is None or new_admin == admin_id:
+                continue
+            if await self.app.db.reassign_ticket(ticket_id, admin_id, new_admin):
+                self.closed(admin_id, (ticket_id,))
+                self._track(new_admin, ticket_id)
+                moved += 1
+                logger.info(f"🔀 Заявка #{ticket_id} передана от {admin_id} к {new_admin}")
+        if moved:
+            self.app.ticket_dispatcher.notify()
+        return moved
+
+    async def _run(self, primary):
+        while True:
+            await asyncio.sleep(ADMIN_REFRESH_INTERVAL)
+            try:
+                await self.load()
+                if primary:
+                    await self.reassign(await self.app.db.get_unacked_tickets(TICKET_ACK_TIMEOUT))
+            except Exception as e:
+                logger.error(f"❌ Ошибка маршрутизации заявок: {e}")
+
+    async def start(self, primary):
+        if primary:
+            await self.app.db.save_admin(ADMIN_ID)
+        await self.load()
+        self._task = asyncio.create_task(self._run(primary))
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+# ===== ОБСЛУЖИВАНИЕ БД =====
+RETENTION_RULES = (
+    # (что удаляется, таблица, ключ, условие с датой отсечения, срок хранения в днях)
+    ("заблокировавшие бота", "users", ("user_id",),
+     "is_blocked = 1 AND last_active < datetime('now', ?)", BLOCKED_RETENTION_DAYS),
+    ("неактивные сотрудники", "users", ("user_id",),
+     "last_active < datetime('now', ?)", INACTIVE_RETENTION_DAYS),
+    ("закрытые заявки", "tickets", ("id",),
+     "status IN ('delivered', 'failed') AND created_at < datetime('now', ?)", TICKET_RETENTION_DAYS),
+    # Сначала получатели пачками, потом сами рассылки — каскад не удаляет всё разом
+    ("получатели рассылок", "broadcast_recipients", ("broadcast_id", "user_id"),
+     f"broadcast_id IN (SELECT id FROM broadcasts WHERE status IN ('{BROADCAST_DONE}', "
+     f"'{BROADCAST_CANCELLED}') AND finished_at < datetime('now', ?))", BROADCAST_RETENTION_DAYS),
+    ("рассылки", "broadcasts", ("id",),
+     f"status IN ('{BROADCAST_DONE}', '{BROADCAST_CANCELLED}') AND finished_at < datetime('now', ?)",
+     BROADCAST_RETENTION_DAYS),
+)
+
+
+class MaintenanceScheduler(BaseMiddleware):
+    """Периодическое обслуживание БД в часы простоя.
+
+    Как middleware отмечает время последнего обновления. Работа выполняется,
+    когда подошёл её срок и бот MAINTENANCE_IDLE секунд ничего не получал;
+    если простоя нет дольше двух интервалов, работа выполняется всё равно.
+    Длительность каждой работы пишется в лог и в bot_maintenance_seconds.
+    """
+
+    def __init__(self, db, idle=MAINTENANCE_IDLE, check_interval=MAINTENANCE_CHECK_INTERVAL,
+                 batch_size=MAINTENANCE_BATCH_SIZE):
+        self.db = db
+        self.idle = idle
+        self.check_interval = check_interval
+        self.batch_size = batch_size
+        self.jobs = (
+            ("checkpoint", CHECKPOINT_INTERVAL, self.checkpoint),
+            ("retention", RETENTION_INTERVAL, self.retention),
+            ("vacuum", VACUUM_INTERVAL, self.vacuum),
+            ("optimize", OPTIMIZE_INTERVAL, self.optimize),
         )
-        conn.commit()
-        conn.close()
+        self.last_update = time.monotonic()
+        self._last_run = {}
+        self._task = None
 
-    @staticmethod
-    def get_all_users(include_blocked=False):
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        if include_blocked:
-            cursor.execute("SELECT user_id, name FROM users ORDER BY registered_at DESC")
+    async def __call__(self, handler, event, data):
+        self.last_update = time.monotonic()
+        return await handler(event, data)
+
+    async def retention(self):
+        removed = []
+        for title, table, key, where, days in RETENTION_RULES:
+            if not days:
+                continue
+            total = 0
+            while True:
+                keys = await self.db.purge_batch(table, key, where, (f"-{days} days",), self.batch_size)
+                total += len(keys)
+                if len(keys) < self.batch_size:
+                    break
+                await asyncio.sleep(0)
+            if total:
+                removed.append(f"{title}: {total}")
+        return "удалено " + ", ".join(removed) if removed else "удалять нечего"
+
+    async def checkpoint(self):
+        busy, wal_pages, moved = await self.db.checkpoint()
+        if busy:
+            return f"WAL занят читателями, перенесено страниц: {moved} из {wal_pages}"
+        return f"перенесено страниц: {moved}"
+
+    async def vacuum(self):
+        freed, left = await self.db.incremental_vacuum(MAINTENANCE_VACUUM_PAGES)
+        return f"освобождено страниц: {freed}, свободных осталось: {left}"
+
+    async def optimize(self):
+        await self.db.optimize()
+        return "статистика индексов обновлена"
+
+    async def run_job(self, name, job):
+        started = time.perf_counter()
+        try:
+            result = await job()
+        except Exception as e:
+            self.db.metrics.inc("bot_maintenance_errors_total", (("job", name),))
+            logger.error(f"❌ Обслуживание БД, {name}: {e}")
         else:
-            cursor.execute("SELECT user_id, name FROM users WHERE is_blocked = 0 ORDER BY registered_at DESC")
-        users = cursor.fetchall()
-        conn.close()
-        return users
+            logger.info(f"🧹 Обслуживание БД, {name}: {result} за {time.perf_counter() - started:.2f} с")
+        finally:
+            self.db.metrics.observe("bot_maintenance_seconds", (("job", name),), time.perf_counter() - started)
+            self._last_run[name] = time.monotonic()
 
-    @staticmethod
-    def get_stats():
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute("SELECT COUNT(*) FROM users")
-        total_users = cursor.fetchone()[0]
-        cursor.execute("SELECT COUNT(*) FROM users WHERE is_blocked = 1")
-        blocked_users = cursor.fetchone()[0]
-        conn.close()
-        return {
-            "total_users": total_users,
-            "blocked_users": blocked_users,
-            "active_users": total_users - blocked_users
-        }
+    async def run_due(self):
+        """Выполняет работы, которым пора; возвращает их имена"""
+        done = []
+        for name, interval, job in self.jobs:
+            now = time.monotonic()
+            elapsed = now - self._last_run.setdefault(name, now)
+            idle = now - self.last_update >= self.idle
+            if elapsed >= interval and (idle or elapsed >= 2 * interval):
+                await self.run_job(name, job)
+                done.append(name)
+        return done
 
-    @staticmethod
-    def update_last_active(user_id):
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute(
-            "UPDATE users SET last_active = CURRENT_TIMESTAMP WHERE user_id = ?", 
-            (user_id,)
-        )
-        conn.commit()
-        conn.close()
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.check_interval)
+            await self.run_due()
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
 
-# Создаём базу
-Database.init_db()
 
 # ===== СОСТОЯНИЯ =====
 class Form(StatesGroup):
@@ -160,63 +3142,158 @@ class Form(StatesGroup):
     edit_name = State()
     edit_workplace = State()
 
+class TicketAction(CallbackData, prefix="ticket"):
+    """Кнопки под уведомлением о заявках: ack — взять в работу, done — решено"""
+    action: str
+
+class UsersPage(CallbackData, prefix="users"):
+    """Кнопки листания /users: action n — вперёд, p — назад, f — смена фильтра.
+
+    Место работы передаётся ключом workplace_key: название целиком
+    не помещается в 64 байта callback_data и может содержать «:».
+    """
+    action: str
+    cursor: int
+    status: str
+    place: str
+
+
+def workplace_key(workplace):
+    """Короткий стабильный ключ места работы; "" — без фильтра"""
+    if not workplace:
+        return ""
+    return hashlib.blake2s(workplace.encode(), digest_size=4).hexdigest()
+
 # ===== КЛАВИАТУРЫ =====
-def get_main_menu_keyboard():
-    keyboard = ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text="📝 Новая заявка")],
-            [KeyboardButton(text="⚙️ Изменить профиль")]
-        ],
-        resize_keyboard=True
+# Клавиатуры собираются один раз и переиспользуются во всех ответах —
+# объекты общие, изменять их нельзя
+def build_reply_keyboard(rows, placeholder=None):
+    return ReplyKeyboardMarkup(
+        keyboard=[[KeyboardButton(text=text) for text in row] for row in rows],
+        resize_keyboard=True,
+        input_field_placeholder=placeholder
     )
-    return keyboard
+
+MAIN_MENU_KEYBOARD = build_reply_keyboard([
+    ["📝 Новая заявка"],
+    ["⚙️ Изменить профиль"]
+])
+EDIT_PROFILE_KEYBOARD = build_reply_keyboard([
+    ["✏️ Изменить имя", "📍 Изменить место"],
+    ["◀️ Назад"]
+])
+CONFIRM_KEYBOARD = build_reply_keyboard([["✅ Да", "❌ Нет"]])
+REMOVE_KEYBOARD = ReplyKeyboardRemove()
+TICKET_KEYBOARD = InlineKeyboardMarkup(inline_keyboard=[[
+    InlineKeyboardButton(text="✅ Беру", callback_data=TicketAction(action="ack").pack()),
+    InlineKeyboardButton(text="✔️ Решено", callback_data=TicketAction(action="done").pack())
+]])
+
+DEFAULT_WORKPLACES = [
+    ["Офис1", "Офис2"],
+    ["Ресепшен", "Менеджеры"],
+    ["Касса", "РОП,РКС,Приемка"],
+    ["Логистика", "Салон б/у"],
+    ["Сервис", "Склад"]
+]
+DEFAULT_PROBLEMS = [
+    ["1С", "Принтер"],
+    ["Сильвер", "ВПН"],
+    ["Проблемы с ПК", "Картридж"],
+    ["Камеры", "ПАМАГИТИ"]
+]
+
+
+class CatalogError(ValueError):
+    pass
+
+
+class Catalog:
+    """Справочник мест работы и проблем.
+
+    Списки берутся из JSON-файла CATALOG_PATH (если он есть) в виде рядов
+    кнопок: {"workplaces": [["Офис1", "Офис2"], ...], "problems": [...]}.
+    Клавиатуры собираются при загрузке, проверка ввода — поиск в frozenset.
+    """
+
+    def __init__(self, workplaces, problems):
+        self.workplace_rows = self._validate("workplaces", workplaces)
+        self.problem_rows = self._validate("problems", problems)
+        self.workplaces = frozenset(text for row in self.workplace_rows for text in row)
+        self.problems = frozenset(text for row in self.problem_rows for text in row)
+        self.mtime = None
+        self.workplace_keyboard = build_reply_keyboard(self.workplace_rows, "Выберите рабочее место")
+        self.problem_keyboard = build_reply_keyboard(self.problem_rows, "Выберите проблему")
+
+    @staticmethod
+    def _validate(name, rows):
+        if not isinstance(rows, list) or not rows:
+            raise CatalogError(f"{name}: нужен непустой список рядов кнопок")
+        seen = set()
+        result = []
+        for row in rows:
+            if not isinstance(row, list) or not row:
+                raise CatalogError(f"{name}: каждый ряд — непустой список")
+            for text in row:
+                if not isinstance(text, str) or not text.strip() or len(text) > 64:
+                    raise CatalogError(f"{name}: некорректное название {text!r}")
+                if text in seen:
+                    raise CatalogError(f"{name}: повторяется {text!r}")
+                seen.add(text)
+            result.append(tuple(row))
+        return tuple(result)
+
+    @classmethod
+    def load(cls, path=CATALOG_PATH):
+        mtime = catalog_mtime(path)
+        if mtime is None:
+            return cls(DEFAULT_WORKPLACES, DEFAULT_PROBLEMS)
+        try:
+            with open(path, encoding="utf-8") as f:
+                config = json.load(f)
+        except (OSError, ValueError) as e:
+            raise CatalogError(f"не удалось прочитать {path}: {e}") from e
+        if not isinstance(config, dict):
+            raise CatalogError(f"{path}: ожидается JSON-объект")
+        loaded = cls(
+            config.get("workplaces", DEFAULT_WORKPLACES),
+            config.get("problems", DEFAULT_PROBLEMS)
+        )
+        loaded.mtime = mtime
+        return loaded
+
+
+def catalog_mtime(path=CATALOG_PATH):
+    """Время изменения файла справочника (None — файла нет)"""
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+def load_catalog():
+    """Справочник из файла, а если он некорректен — встроенный"""
+    try:
+        return Catalog.load()
+    except CatalogError as e:
+        logger.error(f"❌ Справочник: {e}, использую встроенный")
+        return Catalog(DEFAULT_WORKPLACES, DEFAULT_PROBLEMS)
+
+
+def get_main_menu_keyboard():
+    return MAIN_MENU_KEYBOARD
 
 def get_edit_profile_keyboard():
-    keyboard = ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text="✏️ Изменить имя"), 
-             KeyboardButton(text="📍 Изменить место")],
-            [KeyboardButton(text="◀️ Назад")]
-        ],
-        resize_keyboard=True
-    )
-    return keyboard
+    return EDIT_PROFILE_KEYBOARD
 
 def get_confirm_keyboard():
-    keyboard = ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text="✅ Да"), KeyboardButton(text="❌ Нет")]
-        ],
-        resize_keyboard=True
-    )
-    return keyboard
-
-def get_workplace_keyboard():
-    keyboard = ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text="Офис1"), KeyboardButton(text="Офис2")],
-            [KeyboardButton(text="Ресепшен"), KeyboardButton(text="Менеджеры")],
-            [KeyboardButton(text="Касса"), KeyboardButton(text="РОП,РКС,Приемка")],
-            [KeyboardButton(text="Логистика"), KeyboardButton(text="Салон б/у")],
-            [KeyboardButton(text="Сервис"), KeyboardButton(text="Склад")]
-        ],
-        resize_keyboard=True,
-        input_field_placeholder="Выберите рабочее место"
-    )
-    return keyboard
-
-def get_problem_keyboard():
-    keyboard = ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text="1С"), KeyboardButton(text="Принтер")],
-            [KeyboardButton(text="Сильвер"), KeyboardButton(text="ВПН")],
-            [KeyboardButton(text="Проблемы с ПК"), KeyboardButton(text="Картридж")],
-            [KeyboardButton(text="Камеры"), KeyboardButton(text="ПАМАГИТИ")]
-        ],
-        resize_keyboard=True,
-        input_field_placeholder="Выберите проблему"
-    )
-    return keyboard
+    return CONFIRM_KEYBOARD
+
+def get_workplace_keyboard(catalog):
+    return catalog.workplace_keyboard
+
+def get_problem_keyboard(catalog):
+    return catalog.problem_keyboard
 
 # ===== ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ =====
 async def show_main_menu(message: types.Message, state: FSMContext, user_data=None):
@@ -246,175 +3323,746 @@ async def start_registration(message: types.Message, state: FSMContext):
         "Как вас зовут?"
     )
 
-# ===== ОБРАБОТЧИК СТАТУСА ЧАТА =====
-@dp.my_chat_member()
-async def handle_chat_member_update(update: ChatMemberUpdated):
-    user_id = update.from_user.id
-    if update.new_chat_member.status == "kicked":
-        Database.mark_user_blocked(user_id)
-        logger.info(f"🚫 Пользователь {user_id} заблокировал бота")
-    elif update.new_chat_member.status == "member":
-        user = Database.get_user(user_id)
-        if user:
-            Database.mark_user_unblocked(user_id)
-            logger.info(f"✅ Пользователь {user_id} снова начал чат с ботом")
+# ===== ОБРАБОТЧИК СТАТУСА ЧАТА =====
+@handlers.my_chat_member()
+async def handle_chat_member_update(update: ChatMemberUpdated, app: "App"):
+    user_id = update.from_user.id
+    if update.new_chat_member.status == "kicked":
+        await app.db.mark_user_blocked(user_id)
+        logger.info(f"🚫 Пользователь {user_id} заблокировал бота")
+    elif update.new_chat_member.status == "member":
+        user = await app.db.get_user(user_id)
+        if user:
+            app.db.mark_user_unblocked(user_id)
+            logger.info(f"✅ Пользователь {user_id} снова начал чат с ботом")
+
+# ===== ОБРАБОТЧИКИ КОМАНД =====
+@handlers.message(Command("start"))
+async def cmd_start(message: types.Message, state: FSMContext, app: "App"):
+    user_id = message.from_user.id
+    current_state = await state.get_state()
+    
+    if current_state:
+        await state.clear()
+        await message.answer("🔄 Перезапускаю бота...")
+    
+    user = await app.db.get_user(user_id)
+    
+    if user:
+        if user[2]:
+            app.db.mark_user_unblocked(user_id)
+        await state.update_data(name=user[0], workplace=user[1])
+        await show_main_menu(message, state, user)
+    else:
+        await start_registration(message, state)
+
+@handlers.message(Command("cancel"))
+async def cmd_cancel(message: types.Message, state: FSMContext, app: "App"):
+    await state.clear()
+    await message.answer(
+        "❌ Действие отменено.\n"
+        "Чтобы начать заново, нажмите /start",
+        reply_markup=REMOVE_KEYBOARD
+    )
+
+@handlers.message(Command("help"))
+async def cmd_help(message: types.Message, app: "App"):
+    help_text = (
+        f"{hbold('🤖 Помощь по боту')}\n\n"
+        f"{hbold('Основные команды:')}\n"
+        f"/start - начать работу\n"
+        f"/cancel - отменить текущее действие\n"
+        f"/help - показать эту справку\n\n"
+        f"{hbold('Как пользоваться:')}\n"
+        f"1. При первом запуске нужно зарегистрироваться\n"
+        f"2. В главном меню можно создать заявку или изменить профиль\n"
+        f"3. Для создания заявки выберите проблему из списка\n"
+        f"4. Сисадмин получит уведомление и свяжется с вами"
+    )
+    await message.answer(help_text, parse_mode="HTML")
+
+@handlers.message(Command("stats"))
+async def cmd_stats(message: types.Message, app: "App"):
+    if not app.is_admin(message.from_user.id):
+        await message.answer("⛔ У вас нет прав для этой команды")
+        return
+    
+    stats = await app.db.get_stats()
+    text = (
+        f"{hbold('📊 Статистика бота:')}\n\n"
+        f"👥 Всего сотрудников: {stats['total_users']}\n"
+        f"✅ Активных: {stats['active_users']}\n"
+        f"🚫 Заблокировали бота: {stats['blocked_users']}"
+    )
+    if stats['workplaces']:
+        text += f"\n\n{hbold('📍 По местам работы:')}\n"
+        for workplace, total, blocked in stats['workplaces']:
+            text += f"{html.escape(workplace)}: {total}" + (f" (🚫 {blocked})" if blocked else "") + "\n"
+    if stats['problems']:
+        text += f"\n{hbold('❓ Заявки по проблемам:')}\n"
+        for problem, tickets in stats['problems']:
+            text += f"{html.escape(problem)}: {tickets}\n"
+    if stats['daily_activity']:
+        text += f"\n{hbold('📅 Активность по дням:')}\n"
+        for day, users in stats['daily_activity']:
+            text += f"{day}: {users}\n"
+    if stats['weekly_activity']:
+        text += f"\n{hbold('🗓 Активность по неделям:')}\n"
+        for week, users in stats['weekly_activity']:
+            year, number = week.split("-")
+            text += f"{number}-я неделя {year}: {users}\n"
+    cache = app.user_cache.stats()
+    text += (
+        f"\n🗄 Кэш профилей: {cache['size']} записей, "
+        f"попаданий {cache['hits']}, промахов {cache['misses']} "
+        f"({cache['hit_rate']:.0%})"
+    )
+    await message.answer(text, parse_mode="HTML")
+
+def perf_section(metrics, title, histogram, errors):
+    """Строки /perf: самые затратные по суммарному времени метки гистограммы"""
+    failures = {}
+    for labels, count in metrics.counters(errors).items():
+        failures[labels[0][1]] = failures.get(labels[0][1], 0) + count
+    rows = sorted(metrics.histograms(histogram).items(), key=lambda item: item[1].sum, reverse=True)
+    if not rows:
+        return ""
+    text = f"\n{hbold(title)}\n"
+    for labels, h in rows[:PERF_TOP]:
+        name = " / ".join(str(value) for _, value in labels)
+        text += (
+            f"{name}: {h.count} шт., p50 {h.quantile(0.5) * 1000:.1f} мс, "
+            f"p99 {h.quantile(0.99) * 1000:.1f} мс"
+        )
+        if failures.get(labels[0][1]):
+            text += f", ошибок {failures.pop(labels[0][1])}"
+        text += "\n"
+    return text
+
+@handlers.message(Command("perf"))
+async def cmd_perf(message: types.Message, app: "App"):
+    if not app.is_admin(message.from_user.id):
+        await message.answer("⛔ У вас нет прав для этой команды")
+        return
+
+    text = f"{hbold('⏱ Производительность (с запуска процесса):')}\n"
+    metrics = app.metrics
+    text += perf_section(metrics, "🧩 Обработчики / состояние:", "bot_handler_seconds", "bot_handler_errors_total")
+    text += perf_section(metrics, "🗄 База данных:", "bot_db_seconds", "bot_db_errors_total")
+    text += perf_section(metrics, "📡 Bot API:", "bot_api_seconds", "bot_api_errors_total")
+    api_errors = sorted(metrics.counters("bot_api_errors_total").items(), key=lambda item: -item[1])
+    if api_errors:
+        text += f"\n{hbold('⚠️ Ошибки Bot API:')}\n"
+        for labels, count in api_errors[:PERF_TOP]:
+            text += f"{labels[0][1]} — {labels[1][1]}: {count}\n"
+    throttled = {labels[0][1]: count for labels, count in metrics.counters("bot_throttled_total").items()}
+    text += (
+        f"\n🚦 Отброшено флуда: {throttled.pop('flood', 0)}, "
+        f"отказов по кулдауну: {sum(throttled.values())}"
+    )
+    cache = app.user_cache.stats()
+    text += (
+        f"\n🗄 Кэш профилей: {cache['size']} записей ({cache['hit_rate']:.0%} попаданий)\n"
+        f"💾 Сессий FSM в памяти: {len(app.fsm_storage._sessions)} (~{app.fsm_storage.memory // 1024} КБ)"
+    )
+    await message.answer(text, parse_mode="HTML")
+
+def is_admin_album(message: types.Message, app: "App"):
+    return message.media_group_id is not None and app.is_admin(message.from_user.id)
+
+@handlers.message(is_admin_album)
+async def collect_album(message: types.Message, app: "App"):
+    """Часть альбома от админа; рассылка запустится в send_album, когда придут все части"""
+    app.album_collector.add(message)
+
+SEND_COMMAND = Command("send")
+
+async def send_album(app: "App", album):
+    """Альбом с подписью /send у одной из частей рассылается целиком"""
+    for part in album:
+        # Тот же фильтр, что у /send: подпись /send@ИмяБота тоже команда
+        found = await SEND_COMMAND(part, app.bot)
+        if found:
+            break
+    else:
+        return
+    media = [item for item in map(message_media, album) if item is not None]
+    await start_broadcast(app, part, found["command"].args, media)
+
+@handlers.message(SEND_COMMAND)
+async def cmd_send(message: types.Message, command: CommandObject, app: "App"):
+    if not app.is_admin(message.from_user.id):
+        await message.answer("⛔ Только админ может делать рассылку")
+        return
+    
+    # Файл — в самом сообщении (подпись /send) или в том, на которое ответили
+    media = message_media(message)
+    if media is None and message.reply_to_message is not None:
+        media = message_media(message.reply_to_message)
+    await start_broadcast(app, message, command.args, [media] if media else None)
+
+async def start_broadcast(app: "App", message: types.Message, args, media=None):
+    """Разбирает аргументы /send и запускает рассылку; media — [(тип, file_id)]"""
+    try:
+        audience, text = Audience.parse(args or "", app.catalog.workplaces)
+        # Проверяется текст в том виде, в каком его получат: с заголовком
+        template = MessageTemplate(BROADCAST_HEADER + text)
+    except ValueError as e:
+        await message.answer(f"❌ {e}")
+        return
+    
+    if not text and not media:
+        await message.answer(
+            "❌ Напишите текст после команды.\n"
+            "Пример: /send Завтра сервер перезагрузится в 23:00\n\n"
+            "Перед текстом можно указать, кому слать:\n"
+            "• @Склад — место работы (можно несколько)\n"
+            "• активные:7 — заходили за последние 7 дней\n"
+            "• после:01.09.2024 — зарегистрировались с этой даты\n"
+            "В тексте можно писать {name} и {workplace} — подставятся имя и место сотрудника.\n"
+            "Пример: /send @Склад активные:7 {name}, завтра инвентаризация\n\n"
+            "Фото, документ или альбом: пришлите их с подписью /send … "
+            "или ответьте /send … на сообщение с файлом."
+        )
+        return
+    
+    # Подпись к файлу в Telegram короче обычного сообщения
+    limit = BROADCAST_CAPTION_LIMIT if media else BROADCAST_TEXT_LIMIT
+    if template.max_length > limit:
+        await message.answer(
+            f"❌ Сообщение слишком длинное (макс. {limit - len(BROADCAST_HEADER)} символов "
+            f"с учётом подстановок)"
+        )
+        return
+    
+    job, total = await app.broadcast_manager.start(text, message.chat.id, audience, media)
+    if job is None:
+        await message.answer(f"📭 Нет активных сотрудников для рассылки ({audience.describe()})")
+        return
+    
+    attachments = f", вложений: {len(media)}" if media else ""
+    status_msg = await message.answer(
+        f"📤 Рассылка #{job.id}: отправляю {total} сотрудникам ({audience.describe()}{attachments})..."
+    )
+    job.status_message_id = status_msg.message_id
+    await app.db.set_broadcast_message(job.id, status_msg.message_id)
+    app.broadcast_manager.launch(job)
+
+async def change_broadcast_status(app: "App", message: types.Message, status, done_text):
+    """Общая часть команд паузы, продолжения и отмены рассылки"""
+    if not app.is_admin(message.from_user.id):
+        return
+    
+    args = message.text.split(maxsplit=1)
+    if len(args) > 1 and args[1].strip().isdigit():
+        job_id = int(args[1])
+    else:
+        unfinished = await app.db.get_unfinished_broadcasts()
+        if not unfinished:
+            await message.answer("📭 Нет активных рассылок")
+            return
+        job_id = unfinished[-1][0]
+    
+    if await app.broadcast_manager.set_status(job_id, status):
+        await message.answer(f"{done_text} #{job_id}")
+    else:
+        await message.answer(f"❌ Рассылка #{job_id} не найдена или уже завершена")
+
+@handlers.message(Command("pause_send"))
+async def cmd_pause_send(message: types.Message, app: "App"):
+    await change_broadcast_status(app, message, BROADCAST_PAUSED, "⏸ Пауза рассылки")
+
+@handlers.message(Command("resume_send"))
+async def cmd_resume_send(message: types.Message, app: "App"):
+    await change_broadcast_status(app, message, BROADCAST_RUNNING, "▶️ Продолжаю рассылку")
+
+@handlers.message(Command("cancel_send"))
+async def cmd_cancel_send(message: types.Message, app: "App"):
+    await change_broadcast_status(app, message, BROADCAST_CANCELLED, "⛔ Отменена рассылка")
+
+@handlers.message(Command("broadcasts"))
+async def cmd_broadcasts(message: types.Message, app: "App"):
+    if not app.is_admin(message.from_user.id):
+        return
+    
+    rows = await app.db.get_recent_broadcasts()
+    if not rows:
+        await message.answer("📭 Рассылок ещё не было")
+        return
+    
+    statuses = {
+        BROADCAST_RUNNING: "📤 идёт",
+        BROADCAST_PAUSED: "⏸ пауза",
+        BROADCAST_CANCELLED: "⛔ отменена",
+        BROADCAST_DONE: "✅ завершена",
+    }
+    text = "📋 Последние рассылки:\n\n"
+    for job_id, status, created_at, audience in rows:
+        counts = await app.db.get_broadcast_counts(job_id)
+        total = sum(counts.values())
+        sent = counts.get(RECIPIENT_SENT, 0)
+        text += f"#{job_id} {created_at} — {statuses.get(status, status)}, доставлено {sent}/{total}"
+        text += f" ({audience})\n" if audience else "\n"
+    await message.answer(text)
+
+USER_STATUS_FILTERS = {
+    "a": ("все", None),
+    "o": ("активные", 0),
+    "b": ("заблокированные", 1),
+}
 
-# ===== ОБРАБОТЧИКИ КОМАНД =====
-@dp.message(Command("start"))
-async def cmd_start(message: types.Message, state: FSMContext):
-    user_id = message.from_user.id
-    current_state = await state.get_state()
+def parse_users_filter(args):
+    """Разбирает аргументы /users: статус (актив/заблок) и рабочее место"""
+    status = "a"
+    workplace = []
+    for word in (args or "").split():
+        lowered = word.lower()
+        if lowered.startswith(("заблок", "blocked")):
+            status = "b"
+        elif lowered.startswith(("актив", "active")):
+            status = "o"
+        else:
+            workplace.append(word)
+    return status, " ".join(workplace)
+
+async def render_users_page(app: "App", status, workplace, after=None, before=None):
+    """Текст и клавиатура одной страницы списка сотрудников"""
+    rows, has_prev, has_next = await app.db.get_users_page(
+        after=after,
+        before=before,
+        workplace=workplace or None,
+        is_blocked=USER_STATUS_FILTERS[status][1]
+    )
+    title = f"📋 Сотрудники: {USER_STATUS_FILTERS[status][0]}"
+    if workplace:
+        title += f", {workplace}"
+    if not rows:
+        empty = "📭 База данных пуста" if status == "a" and not workplace else "📭 Никого не найдено"
+        return f"{title}\n\n{empty}", None
     
-    if current_state:
-        await state.clear()
-        await message.answer("🔄 Перезапускаю бота...")
+    text = f"{title}\n\n"
+    for user_id, name, user_workplace, is_blocked in rows:
+        blocked = " [ЗАБЛОКИРОВАН]" if is_blocked else ""
+        text += f"• {name} — {user_workplace} (ID: {user_id}){blocked}\n"
     
-    user = Database.get_user(user_id)
+    navigation = []
+    if has_prev:
+        navigation.append(InlineKeyboardButton(
+            text="◀️ Назад",
+            callback_data=UsersPage(action="p", cursor=rows[0][0], status=status,
+                                    place=workplace_key(workplace)).pack()
+        ))
+    if has_next:
+        navigation.append(InlineKeyboardButton(
+            text="Вперёд ▶️",
+            callback_data=UsersPage(action="n", cursor=rows[-1][0], status=status,
+                                    place=workplace_key(workplace)).pack()
+        ))
+    filters = [
+        InlineKeyboardButton(
+            text=("• " if code == status else "") + label.capitalize(),
+            callback_data=UsersPage(action="f", cursor=0, status=code,
+                                    place=workplace_key(workplace)).pack()
+        )
+        for code, (label, _) in USER_STATUS_FILTERS.items()
+    ]
+    keyboard = [navigation, filters] if navigation else [filters]
+    return text, InlineKeyboardMarkup(inline_keyboard=keyboard)
+
+@handlers.message(Command("users"))
+async def cmd_users(message: types.Message, command: CommandObject, app: "App"):
+    if not app.is_admin(message.from_user.id):
+        return
     
-    if user:
-        if user[2]:
-            Database.mark_user_unblocked(user_id)
-        await state.update_data(name=user[0], workplace=user[1])
-        await show_main_menu(message, state, user)
+    status, workplace = parse_users_filter(command.args)
+    text, keyboard = await render_users_page(app, status, workplace)
+    await message.answer(text, reply_markup=keyboard)
+
+async def resolve_workplace_key(app: "App", key):
+    """Место работы по ключу из кнопки: сначала справочник, потом места из базы"""
+    if not key:
+        return ""
+    for workplace in app.catalog.workplaces:
+        if workplace_key(workplace) == key:
+            return workplace
+    for workplace in await app.db.get_user_workplaces():
+        if workplace_key(workplace) == key:
+            return workplace
+    return None
+
+@handlers.callback_query(UsersPage.filter())
+async def users_page_callback(callback: types.CallbackQuery, callback_data: UsersPage, app: "App"):
+    if not app.is_admin(callback.from_user.id):
+        await callback.answer()
+        return
+    
+    workplace = await resolve_workplace_key(app, callback_data.place)
+    if workplace is None:
+        await callback.answer("Такого места работы больше нет — наберите /users заново", show_alert=True)
+        return
+    if callback_data.action == "n":
+        page = await render_users_page(app, callback_data.status, workplace, after=callback_data.cursor)
+    elif callback_data.action == "p":
+        page = await render_users_page(app, callback_data.status, workplace, before=callback_data.cursor)
     else:
-        await start_registration(message, state)
+        page = await render_users_page(app, callback_data.status, workplace)
+    text, keyboard = page
+    try:
+        await callback.message.edit_text(text, reply_markup=keyboard)
+    except TelegramBadRequest:
+        # Страница не изменилась (повторное нажатие на тот же фильтр)
+        pass
+    await callback.answer()
 
-@dp.message(Command("cancel"))
-async def cmd_cancel(message: types.Message, state: FSMContext):
-    await state.clear()
-    await message.answer(
-        "❌ Действие отменено.\n"
-        "Чтобы начать заново, нажмите /start",
-        reply_markup=ReplyKeyboardRemove()
-    )
+@handlers.message(Command("clear_blocked"))
+async def cmd_clear_blocked(message: types.Message, app: "App"):
+    if not app.is_admin(message.from_user.id):
+        return
+    
+    deleted = await app.db.delete_blocked_users()
+    
+    await message.answer(f"✅ Удалено {deleted} заблокировавших пользователей")
 
-@dp.message(Command("help"))
-async def cmd_help(message: types.Message):
-    help_text = (
-        f"{hbold('🤖 Помощь по боту')}\n\n"
-        f"{hbold('Основные команды:')}\n"
-        f"/start - начать работу\n"
-        f"/cancel - отменить текущее действие\n"
-        f"/help - показать эту справку\n\n"
-        f"{hbold('Как пользоваться:')}\n"
-        f"1. При первом запуске нужно зарегистрироваться\n"
-        f"2. В главном меню можно создать заявку или изменить профиль\n"
-        f"3. Для создания заявки выберите проблему из списка\n"
-        f"4. Сисадмин получит уведомление и свяжется с вами"
-    )
-    await message.answer(help_text, parse_mode="HTML")
+EXPORT_COLUMNS = {
+    "users": ("user_id", "name", "workplace", "registered_at", "is_blocked", "last_active"),
+    "tickets": ("id", "user_id", "name", "workplace", "problem", "created_at", "status",
+                "attempts", "delivered_at", "last_error"),
+}
+EXPORT_FORMATS = ("csv", "jsonl")
 
-@dp.message(Command("stats"))
-async def cmd_stats(message: types.Message):
-    if message.from_user.id != ADMIN_ID:
-        await message.answer("⛔ У вас нет прав для этой команды")
+@handlers.message(Command("export"))
+async def cmd_export(message: types.Message, command: CommandObject, app: "App"):
+    if not app.is_admin(message.from_user.id):
         return
     
-    stats = Database.get_stats()
-    text = (
-        f"{hbold('📊 Статистика бота:')}\n\n"
-        f"👥 Всего сотрудников: {stats['total_users']}\n"
-        f"✅ Активных: {stats['active_users']}\n"
-        f"🚫 Заблокировали бота: {stats['blocked_users']}"
-    )
-    await message.answer(text, parse_mode="HTML")
+    table, fmt = "users", "csv"
+    for word in (command.args or "").lower().split():
+        if word in EXPORT_COLUMNS:
+            table = word
+        elif word in EXPORT_FORMATS:
+            fmt = word
+        else:
+            await message.answer(
+                "❌ Не понял, что выгрузить.\n"
+                "Пример: /export users csv или /export tickets jsonl"
+            )
+            return
+    
+    # Файл пишется на диск и отправляется оттуда, не собираясь в памяти
+    fd, path = tempfile.mkstemp(prefix="export-", suffix=f".{fmt}")
+    os.close(fd)
+    try:
+        count = await app.db.export_rows(table, fmt, path)
+        await message.answer_document(
+            FSInputFile(path, filename=f"{table}-{time.strftime('%Y%m%d-%H%M')}.{fmt}"),
+            caption=f"📤 Выгружено строк: {count}"
+        )
+    finally:
+        os.remove(path)
 
-@dp.message(Command("send"))
-async def cmd_send(message: types.Message):
-    if message.from_user.id != ADMIN_ID:
-        await message.answer("⛔ Только админ может делать рассылку")
+class ImportReport:
+    def __init__(self):
+        self.rows = 0
+        self.added = 0
+        self.updated = 0
+        self.skipped = 0
+        self.errors = []  # (номер строки, причина), первые IMPORT_SHOWN_ERRORS
+
+    def reject(self, line, reason):
+        self.skipped += 1
+        if len(self.errors) < IMPORT_SHOWN_ERRORS:
+            self.errors.append((line, reason))
+
+    def text(self):
+        text = (
+            f"✅ Импорт завершён\n\n"
+            f"📄 Строк в файле: {self.rows}\n"
+            f"➕ Добавлено: {self.added}\n"
+            f"✏️ Обновлено: {self.updated}\n"
+            f"⚠️ Пропущено: {self.skipped}"
+        )
+        for line, reason in self.errors:
+            text += f"\n• строка {line}: {reason}"
+        if self.skipped > len(self.errors):
+            text += f"\n… и ещё {self.skipped - len(self.errors)}"
+        return text
+
+def read_import_records(path, fmt):
+    """(номер строки, словарь полей или None, если строка не разбирается)"""
+    if fmt == "csv":
+        with open(path, encoding="utf-8-sig", newline="") as f:
+            reader = csv.DictReader(f)
+            for record in reader:
+                yield reader.line_num, record
+    else:
+        with open(path, encoding="utf-8") as f:
+            for line, text in enumerate(f, 1):
+                if not text.strip():
+                    continue
+                try:
+                    record = json.loads(text)
+                except ValueError:
+                    record = None
+                yield line, record if isinstance(record, dict) else None
+
+def import_batches(path, fmt, report, workplaces):
+    """Проверенные строки пачками по IMPORT_BATCH_SIZE; отклонённые — в report"""
+    seen = set()
+    batch = []
+    for line, record in read_import_records(path, fmt):
+        report.rows += 1
+        if record is None:
+            report.reject(line, "строка не разбирается")
+            continue
+        try:
+            user_id = int(str(record.get("user_id", "")).strip())
+        except ValueError:
+            report.reject(line, "нет корректного user_id")
+            continue
+        name = str(record.get("name") or "").strip()
+        workplace = str(record.get("workplace") or "").strip()
+        last_active = str(record.get("last_active") or "").strip() or None
+        if last_active is not None:
+            try:
+                moment = datetime.datetime.fromisoformat(last_active)
+            except ValueError:
+                report.reject(line, f"некорректная дата last_active «{last_active}»")
+                continue
+            # В базе время UTC, как у CURRENT_TIMESTAMP
+            if moment.tzinfo is not None:
+                moment = moment.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+            last_active = moment.strftime("%Y-%m-%d %H:%M:%S")
+        if user_id <= 0:
+            report.reject(line, "нет корректного user_id")
+        elif user_id in seen:
+            report.reject(line, f"ID {user_id} уже встречался в файле")
+        elif not 2 <= len(name) <= 50:
+            report.reject(line, "имя должно быть от 2 до 50 символов")
+        elif workplace not in workplaces:
+            report.reject(line, f"неизвестное место «{workplace}»")
+        else:
+            seen.add(user_id)
+            batch.append((user_id, name, workplace, last_active))
+            if len(batch) >= IMPORT_BATCH_SIZE:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+IMPORT_FORMATS = {".csv": "csv", ".jsonl": "jsonl", ".json": "jsonl"}
+
+@handlers.message(Command("import"))
+async def cmd_import(message: types.Message, app: "App"):
+    if not app.is_admin(message.from_user.id):
         return
     
-    text = message.text.replace("/send", "", 1).strip()
-    if not text:
+    document = message.document
+    if document is None and message.reply_to_message is not None:
+        document = message.reply_to_message.document
+    if document is None:
         await message.answer(
-            "❌ Напишите текст после команды.\n"
-            "Пример: /send Завтра сервер перезагрузится в 23:00"
+            "📥 Пришлите файл .csv или .jsonl с подписью /import "
+            "(или ответьте /import на сообщение с файлом).\n\n"
+            "Нужные поля: user_id, name, workplace — как в /export "
+            "(last_active, если есть, сохраняется)."
         )
         return
-    
-    if len(text) > 4000:
-        await message.answer("❌ Сообщение слишком длинное (макс. 4000 символов)")
+    fmt = IMPORT_FORMATS.get(os.path.splitext(document.file_name or "")[1].lower())
+    if fmt is None:
+        await message.answer("❌ Нужен файл .csv или .jsonl")
+        return
+    if document.file_size and document.file_size > IMPORT_MAX_SIZE:
+        await message.answer("❌ Файл слишком большой (макс. 20 МБ)")
         return
     
-    users = Database.get_all_users(include_blocked=False)
-    if not users:
-        await message.answer("📭 Нет активных сотрудников для рассылки")
+    fd, path = tempfile.mkstemp(prefix="import-", suffix=f".{fmt}")
+    os.close(fd)
+    report = ImportReport()
+    try:
+        await app.bot.download(document, destination=path)
+        # Файл читается и проверяется в потоке, а в БД уходит пачками
+        loop = asyncio.get_running_loop()
+        batches = import_batches(path, fmt, report, app.catalog.workplaces)
+        while True:
+            batch = await loop.run_in_executor(None, next, batches, None)
+            if batch is None:
+                break
+            added, updated = await app.db.import_users(batch)
+            report.added += added
+            report.updated += updated
+    except (UnicodeDecodeError, csv.Error) as e:
+        await message.answer(
+            f"❌ Не удалось прочитать файл: {e}\n"
+            f"Загружено до ошибки: {report.added + report.updated}"
+        )
         return
+    finally:
+        os.remove(path)
     
-    status_msg = await message.answer(f"📤 Отправляю {len(users)} сотрудникам...")
+    logger.info(f"📥 Импорт сотрудников: +{report.added}, обновлено {report.updated}, пропущено {report.skipped}")
+    await message.answer(report.text())
+
+@handlers.message(Command("reload_catalog"))
+async def cmd_reload_catalog(message: types.Message, app: "App"):
+    if not app.is_admin(message.from_user.id):
+        return
     
-    success = 0
-    failed = 0
-    blocked = 0
+    try:
+        app.catalog = await asyncio.to_thread(Catalog.load)
+    except CatalogError as e:
+        await message.answer(f"❌ Справочник не обновлён: {e}")
+        return
     
-    for user_id, name in users:
-        try:
-            await bot.send_message(
-                user_id,
-                f"📢 Уведомление от админа:\n\n{text}"
-            )
-            success += 1
-            await asyncio.sleep(0.03)
-        except Exception as e:
-            failed += 1
-            if "bot was blocked" in str(e):
-                blocked += 1
-                Database.mark_user_blocked(user_id)
-                logger.info(f"Пользователь {name} ({user_id}) заблокировал бота")
-    
-    report = (
-        f"✅ Рассылка завершена\n\n"
-        f"📊 Всего: {len(users)}\n"
-        f"✅ Доставлено: {success}\n"
-        f"❌ Ошибок: {failed}"
+    await message.answer(
+        f"✅ Справочник обновлён\n\n"
+        f"📍 Мест работы: {len(app.catalog.workplaces)}\n"
+        f"❓ Проблем: {len(app.catalog.problems)}"
     )
+
+# ===== АДМИНЫ И ЗАЯВКИ =====
+ROUTE_ICONS = {"workplace": "📍", "problem": "❓"}
+
+def find_route(catalog, text):
+    """(вид, название) для места работы или проблемы из справочника, иначе None"""
+    if text in catalog.workplaces:
+        return "workplace", text
+    if text in catalog.problems:
+        return "problem", text
+    return None
+
+def parse_admin_args(args):
+    """Аргументы вида «<ID> [текст]»: (ID или None, текст)"""
+    parts = (args or "").split(maxsplit=1)
+    if not parts or not parts[0].isdigit():
+        return None, ""
+    return int(parts[0]), parts[1].strip() if len(parts) > 1 else ""
+
+@handlers.message(Command("admins"))
+async def cmd_admins(message: types.Message, app: "App"):
+    if not app.is_admin(message.from_user.id):
+        return
     
-    if blocked > 0:
-        report += f"\n🚫 Заблокировали бота: {blocked}"
-    
-    await status_msg.edit_text(report)
+    await app.ticket_router.load()
+    text = f"{hbold('👥 Админы:')}\n\n"
+    for admin_id, (name, on_call) in sorted(app.ticket_router.admins.items()):
+        status = "🟢 на смене" if on_call else "⚪️ не на смене"
+        text += (
+            f"• {html.escape(name) if name else 'без имени'} (ID: {admin_id}) — {status}, "
+            f"открытых заявок: {app.ticket_router.load_of(admin_id)}\n"
+        )
+        routes = sorted(
+            f"{ROUTE_ICONS[kind]} {html.escape(value)}"
+            for (kind, value), admin_ids in app.ticket_router.routes.items() if admin_id in admin_ids
+        )
+        if routes:
+            text += f"   {', '.join(routes)}\n"
+    text += "\n/oncall on|off — выйти на смену или уйти с неё"
+    if message.from_user.id == ADMIN_ID:
+        text += (
+            "\n/add_admin ID [имя] · /remove_admin ID\n"
+            "/route ID место-или-проблема · /unroute ID место-или-проблема"
+        )
+    await message.answer(text, parse_mode="HTML")
 
-@dp.message(Command("users"))
-async def cmd_users(message: types.Message):
+@handlers.message(Command("add_admin"))
+async def cmd_add_admin(message: types.Message, command: CommandObject, app: "App"):
     if message.from_user.id != ADMIN_ID:
         return
     
-    users = Database.get_all_users(include_blocked=True)
-    
-    if not users:
-        await message.answer("📭 База данных пуста")
+    admin_id, name = parse_admin_args(command.args)
+    if admin_id is None:
+        await message.answer("❌ Пример: /add_admin 123456789 Иван")
+        return
+    await app.db.save_admin(admin_id, name)
+    await app.ticket_router.load()
+    await message.answer(f"✅ Админ {name or admin_id} добавлен и на смене")
+
+@handlers.message(Command("remove_admin"))
+async def cmd_remove_admin(message: types.Message, command: CommandObject, app: "App"):
+    if message.from_user.id != ADMIN_ID:
         return
     
-    text = f"📋 Список сотрудников:\n\n"
-    for i, (user_id, name) in enumerate(users, 1):
-        user_data = Database.get_user(user_id)
-        blocked = " [ЗАБЛОКИРОВАН]" if user_data and user_data[2] else ""
-        text += f"{i}. {name} (ID: {user_id}){blocked}\n"
-        
-        if len(text) > 3500:
-            text += "..."
-            break
-    
-    await message.answer(text)
+    admin_id, _ = parse_admin_args(command.args)
+    if admin_id is None or admin_id == ADMIN_ID:
+        await message.answer("❌ Пример: /remove_admin 123456789 (главного админа удалить нельзя)")
+        return
+    if not await app.db.delete_admin(admin_id):
+        await message.answer(f"❌ Админ {admin_id} не найден")
+        return
+    await app.ticket_router.load()
+    # Невзятые заявки удалённого админа раздаются остальным
+    moved = await app.ticket_router.reassign(await app.db.get_admin_waiting_tickets(admin_id), fallback=ADMIN_ID)
+    await message.answer(f"✅ Админ {admin_id} удалён, передано заявок: {moved}")
 
-@dp.message(Command("clear_blocked"))
-async def cmd_clear_blocked(message: types.Message):
+async def change_route(app: "App", message: types.Message, args, add):
+    """Общая часть /route и /unroute"""
     if message.from_user.id != ADMIN_ID:
         return
     
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("DELETE FROM users WHERE is_blocked = 1")
-    deleted = cursor.rowcount
-    conn.commit()
-    conn.close()
+    admin_id, text = parse_admin_args(args)
+    route = find_route(app.catalog, text)
+    if admin_id is None or route is None:
+        await message.answer(
+            "❌ Укажите ID админа и место работы или проблему из справочника.\n"
+            "Пример: /route 123456789 Склад"
+        )
+        return
+    if admin_id not in app.ticket_router.admins:
+        await message.answer(f"❌ Админ {admin_id} не найден — сначала /add_admin")
+        return
+    if add:
+        await app.db.add_admin_route(admin_id, *route)
+    else:
+        await app.db.delete_admin_route(admin_id, *route)
+    await app.ticket_router.load()
+    action = "закреплено за" if add else "откреплено от"
+    await message.answer(f"✅ {ROUTE_ICONS[route[0]]} {route[1]} {action} админа {admin_id}")
+
+@handlers.message(Command("route"))
+async def cmd_route(message: types.Message, command: CommandObject, app: "App"):
+    await change_route(app, message, command.args, add=True)
+
+@handlers.message(Command("unroute"))
+async def cmd_unroute(message: types.Message, command: CommandObject, app: "App"):
+    await change_route(app, message, command.args, add=False)
+
+@handlers.message(Command("oncall"))
+async def cmd_oncall(message: types.Message, command: CommandObject, app: "App"):
+    admin_id = message.from_user.id
+    if not app.is_admin(admin_id):
+        return
     
-    await message.answer(f"✅ Удалено {deleted} заблокировавших пользователей")
+    arg = (command.args or "").strip().lower()
+    if arg not in ("on", "off"):
+        _, on_call = app.ticket_router.admins.get(admin_id, ("", True))
+        await message.answer(
+            f"Сейчас вы {'на смене' if on_call else 'не на смене'}.\n"
+            f"/oncall on — выйти на смену, /oncall off — уйти со смены"
+        )
+        return
+    await app.db.set_admin_on_call(admin_id, arg == "on")
+    await app.ticket_router.load()
+    await message.answer("🟢 Вы на смене" if arg == "on" else "⚪️ Вы ушли со смены — новые заявки пойдут другим")
+
+@handlers.callback_query(TicketAction.filter())
+async def ticket_action_callback(callback: types.CallbackQuery, callback_data: TicketAction, app: "App"):
+    admin_id = callback.from_user.id
+    if not app.is_admin(admin_id) or callback.message is None:
+        await callback.answer()
+        return
+    
+    message_id = callback.message.message_id
+    if callback_data.action == "ack":
+        count = await app.db.ack_tickets(message_id, admin_id)
+        await callback.answer(f"✅ Взято в работу заявок: {count}" if count else "Эти заявки уже в работе")
+    else:
+        closed = await app.db.close_tickets(message_id, admin_id)
+        app.ticket_router.closed(admin_id, closed)
+        await callback.answer(f"✔️ Закрыто заявок: {len(closed)}" if closed else "Эти заявки уже закрыты")
 
 # ===== ОСНОВНЫЕ ОБРАБОТЧИКИ СОСТОЯНИЙ =====
-@dp.message(Form.name)
-async def process_name(message: types.Message, state: FSMContext):
+@handlers.message(Form.name)
+async def process_name(message: types.Message, state: FSMContext, app: "App"):
     name = message.text.strip()
     if len(name) < 2 or len(name) > 50:
         await message.answer("Имя должно быть от 2 до 50 символов. Попробуйте еще раз:")
@@ -427,19 +4075,19 @@ async def process_name(message: types.Message, state: FSMContext):
         reply_markup=get_confirm_keyboard()
     )
 
-@dp.message(Form.confirm_name)
-async def confirm_name(message: types.Message, state: FSMContext):
+@handlers.message(Form.confirm_name)
+async def confirm_name(message: types.Message, state: FSMContext, app: "App"):
     if message.text == "✅ Да":
         await state.set_state(Form.workplace)
         await message.answer(
             "📍 Выберите ваше рабочее место:",
-            reply_markup=get_workplace_keyboard()
+            reply_markup=get_workplace_keyboard(app.catalog)
         )
     elif message.text == "❌ Нет":
         await state.set_state(Form.name)
         await message.answer(
             "Введите имя заново:",
-            reply_markup=ReplyKeyboardRemove()
+            reply_markup=REMOVE_KEYBOARD
         )
     else:
         await message.answer(
@@ -447,16 +4095,13 @@ async def confirm_name(message: types.Message, state: FSMContext):
             reply_markup=get_confirm_keyboard()
         )
 
-@dp.message(Form.workplace)
-async def process_workplace(message: types.Message, state: FSMContext):
+@handlers.message(Form.workplace)
+async def process_workplace(message: types.Message, state: FSMContext, app: "App"):
     workplace = message.text
-    valid_places = ["Офис1", "Офис2", "Ресепшен", "Менеджеры", "Касса", 
-                    "РОП,РКС,Приемка", "Логистика", "Салон б/у", "Сервис", "Склад"]
-    
-    if workplace not in valid_places:
+    if workplace not in app.catalog.workplaces:
         await message.answer(
             "Пожалуйста, выберите место из списка:",
-            reply_markup=get_workplace_keyboard()
+            reply_markup=get_workplace_keyboard(app.catalog)
         )
         return
     
@@ -467,17 +4112,17 @@ async def process_workplace(message: types.Message, state: FSMContext):
         reply_markup=get_confirm_keyboard()
     )
 
-@dp.message(Form.confirm_workplace)
-async def confirm_workplace(message: types.Message, state: FSMContext):
+@handlers.message(Form.confirm_workplace)
+async def confirm_workplace(message: types.Message, state: FSMContext, app: "App"):
     if message.text == "✅ Да":
         data = await state.get_data()
-        Database.save_user(message.from_user.id, data['name'], data['workplace'])
+        await app.db.save_user(message.from_user.id, data['name'], data['workplace'])
         await show_main_menu(message, state)
     elif message.text == "❌ Нет":
         await state.set_state(Form.workplace)
         await message.answer(
             "📍 Выберите рабочее место заново:",
-            reply_markup=get_workplace_keyboard()
+            reply_markup=get_workplace_keyboard(app.catalog)
         )
     else:
         await message.answer(
@@ -485,15 +4130,15 @@ async def confirm_workplace(message: types.Message, state: FSMContext):
             reply_markup=get_confirm_keyboard()
         )
 
-@dp.message(Form.edit_choice)
-async def process_main_menu(message: types.Message, state: FSMContext):
+@handlers.message(Form.edit_choice)
+async def process_main_menu(message: types.Message, state: FSMContext, app: "App"):
     data = await state.get_data()
     
     if message.text == "📝 Новая заявка":
         await state.set_state(Form.problem)
         await message.answer(
             "Выберите проблему:",
-            reply_markup=get_problem_keyboard()
+            reply_markup=get_problem_keyboard(app.catalog)
         )
     elif message.text == "⚙️ Изменить профиль":
         await state.set_state(Form.edit_profile)
@@ -510,19 +4155,19 @@ async def process_main_menu(message: types.Message, state: FSMContext):
             reply_markup=get_main_menu_keyboard()
         )
 
-@dp.message(Form.edit_profile)
-async def process_edit_profile(message: types.Message, state: FSMContext):
+@handlers.message(Form.edit_profile)
+async def process_edit_profile(message: types.Message, state: FSMContext, app: "App"):
     if message.text == "✏️ Изменить имя":
         await state.set_state(Form.edit_name)
         await message.answer(
             "Введите новое имя:",
-            reply_markup=ReplyKeyboardRemove()
+            reply_markup=REMOVE_KEYBOARD
         )
     elif message.text == "📍 Изменить место":
         await state.set_state(Form.edit_workplace)
         await message.answer(
             "📍 Выберите новое рабочее место:",
-            reply_markup=get_workplace_keyboard()
+            reply_markup=get_workplace_keyboard(app.catalog)
         )
     elif message.text == "◀️ Назад":
         await show_main_menu(message, state)
@@ -532,8 +4177,8 @@ async def process_edit_profile(message: types.Message, state: FSMContext):
             reply_markup=get_edit_profile_keyboard()
         )
 
-@dp.message(Form.edit_name)
-async def process_edit_name(message: types.Message, state: FSMContext):
+@handlers.message(Form.edit_name)
+async def process_edit_name(message: types.Message, state: FSMContext, app: "App"):
     new_name = message.text.strip()
     if len(new_name) < 2 or len(new_name) > 50:
         await message.answer("Имя должно быть от 2 до 50 символов. Попробуйте еще раз:")
@@ -541,76 +4186,70 @@ async def process_edit_name(message: types.Message, state: FSMContext):
     
     data = await state.get_data()
     await state.update_data(name=new_name)
-    Database.save_user(message.from_user.id, new_name, data['workplace'])
+    await app.db.save_user(message.from_user.id, new_name, data['workplace'])
     await show_main_menu(message, state)
 
-@dp.message(Form.edit_workplace)
-async def process_edit_workplace(message: types.Message, state: FSMContext):
+@handlers.message(Form.edit_workplace)
+async def process_edit_workplace(message: types.Message, state: FSMContext, app: "App"):
     new_workplace = message.text
-    valid_places = ["Офис1", "Офис2", "Ресепшен", "Менеджеры", "Касса", 
-                    "РОП,РКС,Приемка", "Логистика", "Салон б/у", "Сервис", "Склад"]
-    
-    if new_workplace not in valid_places:
+    if new_workplace not in app.catalog.workplaces:
         await message.answer(
             "Пожалуйста, выберите место из списка:",
-            reply_markup=get_workplace_keyboard()
+            reply_markup=get_workplace_keyboard(app.catalog)
         )
         return
     
     data = await state.get_data()
     await state.update_data(workplace=new_workplace)
-    Database.save_user(message.from_user.id, data['name'], new_workplace)
+    await app.db.save_user(message.from_user.id, data['name'], new_workplace)
     await show_main_menu(message, state)
 
-@dp.message(Form.problem)
-async def process_problem(message: types.Message, state: FSMContext):
+@handlers.message(Form.problem)
+async def process_problem(message: types.Message, state: FSMContext, app: "App"):
     problem = message.text
-    valid_problems = ["1С", "Принтер", "Сильвер", "ВПН", "Проблемы с ПК", 
-                      "Картридж", "Камеры", "ПАМАГИТИ"]
-    
-    if problem not in valid_problems:
+    if problem not in app.catalog.problems:
         await message.answer(
             "Пожалуйста, выберите проблему из списка:",
-            reply_markup=get_problem_keyboard()
+            reply_markup=get_problem_keyboard(app.catalog)
+        )
+        return
+    
+    wait = app.flood_control.cooldown_left(message.from_user.id, "ticket")
+    if wait:
+        await message.answer(
+            f"⏳ Новую заявку можно отправить через {int(wait) + 1} с.",
+            reply_markup=get_problem_keyboard(app.catalog)
         )
         return
     
     data = await state.get_data()
-    Database.update_last_active(message.from_user.id)
+    app.db.update_last_active(message.from_user.id)
     
-    try:
-        await bot.send_message(
-            ADMIN_ID,
-            f"🚨 Новая заявка!\n\n"
-            f"👤 Имя: {data['name']}\n"
-            f"📍 Место: {data['workplace']}\n"
-            f"❓ Проблема: {problem}\n"
-            f"🆔 ID: {message.from_user.id}"
-        )
-        logger.info(f"✅ Заявка отправлена админу от {data['name']}")
-    except Exception as e:
-        logger.error(f"❌ Ошибка отправки админу: {e}")
-        await message.answer("⚠️ Не удалось отправить заявку. Попробуйте позже.")
-        await state.clear()
-        return
+    # Заявка сохраняется в БД за выбранным админом и уходит ему в фоне (TicketDispatcher)
+    ticket_id = await app.ticket_router.create_ticket(
+        message.from_user.id, data['name'], data['workplace'], problem
+    )
+    # Кулдаун — только за созданную заявку: сорвавшаяся попытка не блокирует сотрудника
+    app.flood_control.start_cooldown(message.from_user.id, "ticket", TICKET_COOLDOWN)
+    app.ticket_dispatcher.notify()
     
     await state.clear()
     await message.answer(
-        f"✅ Заявка принята!\n\n"
-        f"Сисадмин уже получил уведомление.\n"
+        f"✅ Заявка #{ticket_id} принята!\n\n"
+        f"Сисадмин получит уведомление в ближайшее время.\n"
         f"Чтобы создать новую заявку, нажмите /start",
-        reply_markup=ReplyKeyboardRemove()
+        reply_markup=REMOVE_KEYBOARD
     )
 
 # ===== УНИВЕРСАЛЬНЫЙ ОБРАБОТЧИК =====
-@dp.message()
-async def handle_any_message(message: types.Message, state: FSMContext):
+@handlers.message()
+async def handle_any_message(message: types.Message, state: FSMContext, app: "App"):
     """Обработчик для любых других сообщений"""
     user_id = message.from_user.id
     current_state = await state.get_state()
     
     # Проверяем, есть ли пользователь в базе
-    user = Database.get_user(user_id)
+    user = await app.db.get_user(user_id)
     
     # Если пользователя НЕТ в базе - начинаем регистрацию
     if not user:
@@ -622,10 +4261,10 @@ async def handle_any_message(message: types.Message, state: FSMContext):
     
     # Если был заблокирован - снимаем блокировку
     if is_blocked:
-        Database.mark_user_unblocked(user_id)
+        app.db.mark_user_unblocked(user_id)
     
     # Обновляем активность
-    Database.update_last_active(user_id)
+    app.db.update_last_active(user_id)
     
     # Сохраняем данные в состояние
     await state.update_data(name=user_name, workplace=user_workplace)
@@ -645,13 +4284,13 @@ async def handle_any_message(message: types.Message, state: FSMContext):
             await message.answer(
                 f"👤 {hbold(user_name)} | 📍 {hbold(user_workplace)}\n\n"
                 f"⚠️ Выберите проблему из списка:",
-                reply_markup=get_problem_keyboard(),
+                reply_markup=get_problem_keyboard(app.catalog),
                 parse_mode="HTML"
             )
         else:
             await message.answer(
                 "⚠️ Выберите проблему из списка:",
-                reply_markup=get_problem_keyboard()
+                reply_markup=get_problem_keyboard(app.catalog)
             )
         return
     
@@ -670,33 +4309,718 @@ async def handle_any_message(message: types.Message, state: FSMContext):
     if current_state in state_info:
         await message.answer(
             f"⚠️ {state_info[current_state]}",
-            reply_markup=get_appropriate_keyboard(current_state)
+            reply_markup=get_appropriate_keyboard(current_state, app.catalog)
         )
 
-def get_appropriate_keyboard(state):
+STATE_KEYBOARDS = {
+    Form.confirm_name: get_confirm_keyboard,
+    Form.workplace: get_workplace_keyboard,
+    Form.confirm_workplace: get_confirm_keyboard,
+    Form.edit_choice: get_main_menu_keyboard,
+    Form.edit_profile: get_edit_profile_keyboard,
+    Form.edit_workplace: get_workplace_keyboard,
+    Form.problem: get_problem_keyboard
+}
+
+# Эти клавиатуры строятся из справочника приложения
+CATALOG_KEYBOARDS = {get_workplace_keyboard, get_problem_keyboard}
+
+def get_appropriate_keyboard(state, catalog):
     """Возвращает клавиатуру для конкретного состояния"""
-    keyboards = {
-        Form.confirm_name: get_confirm_keyboard(),
-        Form.workplace: get_workplace_keyboard(),
-        Form.confirm_workplace: get_confirm_keyboard(),
-        Form.edit_choice: get_main_menu_keyboard(),
-        Form.edit_profile: get_edit_profile_keyboard(),
-        Form.edit_workplace: get_workplace_keyboard(),
-        Form.problem: get_problem_keyboard()
-    }
-    return keyboards.get(state, ReplyKeyboardRemove())
+    keyboard = STATE_KEYBOARDS.get(state)
+    if keyboard is None:
+        return REMOVE_KEYBOARD
+    return keyboard(catalog) if keyboard in CATALOG_KEYBOARDS else keyboard()
+
+# ===== ЗАПИСЬ ТРАФИКА =====
+class TrafficRecorder(BaseMiddleware):
+    """Журнал входящих обновлений для replay.py.
+
+    Каждая строка gzip-файла — JSON {"t": время получения, "s": состояние FSM,
+    "u": обновление}. ID пользователей и чатов заменяются HMAC от RECORD_KEY
+    (ID админа сохраняется, чтобы воспроизводились его команды), имена
+    и юзернеймы затираются, а текст, введённый в состояниях ввода имени,
+    заменяется заглушкой. Файл только дописывается; сжатие и запись идут
+    в отдельном потоке раз в RECORD_FLUSH_INTERVAL.
+    """
+
+    ID_KEYS = ("user_id", "chat_id", "user_chat_id")
+    NAME_KEYS = ("last_name", "username", "phone_number")
+    SCRUBBED_STATES = (Form.name.state, Form.edit_name.state)
+
+    def __init__(self, key=RECORD_KEY, flush_interval=RECORD_FLUSH_INTERVAL):
+        self.flush_interval = flush_interval
+        if not key:
+            key = secrets.token_hex(16)
+        self._key = key.encode()
+        self._lines = []
+        self._file = None
+        self._task = None
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="recorder")
+
+    def anonymize(self, value):
+        if value == ADMIN_ID:
+            return value
+        digest = hmac.new(self._key, str(value).encode(), "sha256").digest()
+        anonymous = int.from_bytes(digest[:6], "big") or 1
+        return -anonymous if value < 0 else anonymous
+
+    def scrub(self, obj):
+        """Обезличивает словарь обновления на месте"""
+        if isinstance(obj, list):
+            for item in obj:
+                self.scrub(item)
+            return
+        if not isinstance(obj, dict):
+            return
+        # User и Chat — объекты с id и признаком is_bot или type
+        if isinstance(obj.get("id"), int) and ("is_bot" in obj or "type" in obj):
+            obj["id"] = self.anonymize(obj["id"])
+            if "first_name" in obj:
+                obj["first_name"] = "Аноним"
+            for key in self.NAME_KEYS:
+                obj.pop(key, None)
+        for key in self.ID_KEYS:
+            if isinstance(obj.get(key), int):
+                obj[key] = self.anonymize(obj[key])
+        for value in obj.values():
+            self.scrub(value)
+
+    async def __call__(self, handler, event, data):
+        if self._file is not None:
+            state = data.get("raw_state")
+            update = event.model_dump(mode="json", exclude_none=True, by_alias=True)
+            self.scrub(update)
+            message = update.get("message")
+            if state in self.SCRUBBED_STATES and message and "text" in message:
+                message["text"] = f"Аноним {message['from']['id'] % 10000}"
+            record = {"t": round(time.time(), 3), "s": state, "u": update}
+            self._lines.append(json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n")
+        return await handler(event, data)
+
+    def _write(self, lines):
+        self._file.write("".join(lines))
+        self._file.flush()
+
+    async def flush(self):
+        if self._file is None or not self._lines:
+            return
+        lines, self._lines = self._lines, []
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._writer, self._write, lines)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except OSError as e:
+                logger.error(f"❌ Не удалось записать журнал трафика: {e}")
+
+    async def open(self, path):
+        if not RECORD_KEY:
+            logger.warning("⚠️ RECORD_KEY не задан — обезличенные ID изменятся после перезапуска")
+        loop = asyncio.get_running_loop()
+        self._file = await loop.run_in_executor(
+            self._writer, functools.partial(gzip.open, path, "at", encoding="utf-8")
+        )
+        self._task = asyncio.create_task(self._run())
+        logger.info(f"⏺ Запись трафика в {path}")
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._file is not None:
+            await self.flush()
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(self._writer, self._file.close)
+            self._file = None
+
+
+# ===== ПРИЁМ ОБНОВЛЕНИЙ =====
+def update_user_id(update):
+    """ID пользователя (или чата), от которого пришло обновление"""
+    event = update.event
+    user = getattr(event, "from_user", None)
+    if user is not None:
+        return user.id
+    chat = getattr(event, "chat", None)
+    if chat is not None:
+        return chat.id
+    return 0
+
+
+class UpdatePool:
+    """Ограниченный пул обработчиков обновлений.
+
+    У каждого обработчика своя очередь, а пользователь всегда попадает в
+    одну и ту же — так сообщения одного человека обрабатываются строго
+    по порядку, а разные пользователи — параллельно.
+
+    При остановке то, что так и не было взято в обработку, отдаёт
+    leftovers — для сохранения в БД и обработки после запуска. Начатые
+    обработчики дорабатывают (не дольше UPDATE_HANDLER_DEADLINE) и
+    повторно не запускаются: заявка или сообщение не уйдут дважды.
+    """
+
+    def __init__(self, dispatcher, bot, workers=UPDATE_WORKERS, queue_size=UPDATE_QUEUE_SIZE):
+        self.dispatcher = dispatcher
+        self.bot = bot
+        self._queues = [asyncio.Queue(maxsize=max(queue_size // workers, 1)) for _ in range(workers)]
+        self._workers = []
+        self._handling = set()  # Задачи начатых обработчиков
+        self.unfinished = {}  # update_id -> принятое, но ещё не взятое в обработку обновление
+
+    def submit(self, update):
+        """Ставит обновление в очередь; False — очередь переполнена"""
+        queue = self._queues[update_user_id(update) % len(self._queues)]
+        try:
+            queue.put_nowait(update)
+        except asyncio.QueueFull:
+            return False
+        self.unfinished[update.update_id] = update
+        return True
+
+    async def _handle(self, update):
+        try:
+            await self.dispatcher.feed_update(self.bot, update)
+        except Exception as e:
+            logger.error(f"❌ Ошибка обработки обновления {update.update_id}: {e}")
+
+    async def _work(self, queue):
+        while True:
+            update = await queue.get()
+            # Взятое в обработку в leftovers уже не попадёт, даже если обработку прервут
+            self.unfinished.pop(update.update_id, None)
+            task = asyncio.create_task(self._handle(update))
+            self._handling.add(task)
+            task.add_done_callback(self._handling.discard)
+            try:
+                # Отмена обработчика очереди при остановке не прерывает начатую обработку
+                await asyncio.shield(task)
+            finally:
+                queue.task_done()
+
+    def start(self):
+        self._workers = [asyncio.create_task(self._work(queue)) for queue in self._queues]
+
+    async def stop(self, timeout=UPDATE_DRAIN_TIMEOUT, deadline=UPDATE_HANDLER_DEADLINE):
+        """Дорабатывает очередь (не дольше timeout) и останавливает обработчики.
+
+        Начатым обработчикам даётся ещё deadline секунд, потом они отменяются.
+        """
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(*(queue.join() for queue in self._queues)),
+                timeout
+            )
+        except asyncio.TimeoutError:
+            logger.warning(
+                f"⚠️ Не взято в обработку при остановке: {len(self.unfinished)} — обработаются после запуска"
+            )
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        if self._handling:
+            _, pending = await asyncio.wait(set(self._handling), timeout=deadline)
+            if pending:
+                logger.warning(f"⚠️ Прервано начатых обработчиков: {len(pending)} — повторно не запускаются")
+                for task in pending:
+                    task.cancel()
+                await asyncio.gather(*pending, return_exceptions=True)
+
+    def leftovers(self):
+        """JSON обновлений, не взятых в обработку, по порядку update_id (после stop)"""
+        return [
+            update.model_dump_json(exclude_none=True, by_alias=True)
+            for _, update in sorted(self.unfinished.items())
+        ]
+
+
+class WebhookServer:
+    """Приём обновлений по webhook.
+
+    Обновление проверяется по секретному токену, передаётся в submit и
+    сразу подтверждается Telegram. Если submit вернул False (очереди
+    переполнены), отвечаем 503 — Telegram повторит доставку позже.
+    Принятое, но не обработанное к остановке сохраняется в БД
+    (pending_updates) и обрабатывается после запуска.
+    """
+
+    def __init__(self, bot, secret, submit, path=WEBHOOK_PATH):
+        self.bot = bot
+        self.secret = secret
+        self.submit = submit
+        self.path = path
+        self._runner = None
+
+    async def handle(self, request):
+        token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if not hmac.compare_digest(token, self.secret):
+            return web.Response(status=401)
+        try:
+            update = types.Update.model_validate(await request.json(), context={"bot": self.bot})
+        except ValueError:
+            return web.Response(status=400)
+        if not self.submit(update):
+            return web.Response(status=503)
+        return web.Response()
+
+    async def start(self, allowed_updates, host=WEBHOOK_HOST, port=WEBHOOK_PORT, url=WEBHOOK_URL):
+        app = web.Application()
+        app.router.add_post(self.path, self.handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        if url:
+            await self.bot.set_webhook(
+                url.rstrip("/") + self.path,
+                secret_token=self.secret,
+                allowed_updates=allowed_updates
+            )
+        else:
+            logger.warning("⚠️ WEBHOOK_URL не задан — webhook в Telegram не регистрируется")
+        logger.info(f"🌐 Webhook слушает {host}:{port}{self.path}")
+
+    async def stop(self):
+        """Перестаёт принимать обновления"""
+        if self._runner:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+async def poll_updates(bot, submit, allowed_updates, stopping):
+    """Long polling без обработки: обновления только передаются в submit.
+
+    Работает до установки stopping и возвращает offset — номер первого
+    обновления, получение которого Telegram ещё не подтверждено.
+    Прерванный запрос ничего не подтверждает: его обновления придут снова.
+    """
+    await bot.delete_webhook()
+    offset = None
+    errors = 0
+    stopped = asyncio.ensure_future(stopping.wait())
+    try:
+        while not stopping.is_set():
+            request = asyncio.ensure_future(bot.get_updates(
+                offset=offset,
+                timeout=POLLING_TIMEOUT,
+                allowed_updates=allowed_updates,
+                request_timeout=POLLING_TIMEOUT + 10
+            ))
+            await asyncio.wait((request, stopped), return_when=asyncio.FIRST_COMPLETED)
+            if not request.done():
+                request.cancel()
+                await asyncio.gather(request, return_exceptions=True)
+                break
+            try:
+                updates = request.result()
+            except TelegramRetryAfter as e:
+                delay = e.retry_after
+                logger.warning(f"⚠️ Telegram просит подождать с получением обновлений {delay} с")
+                await asyncio.wait((stopped,), timeout=delay)
+                continue
+            except Exception as e:
+                # Любая ошибка — в том числе TelegramConflictError, пока при перезапуске
+                # работает и старый процесс, — не останавливает приём, а откладывает его
+                errors += 1
+                delay = min(2 ** errors, 30)
+                logger.error(f"❌ Ошибка получения обновлений: {e}, повтор через {delay} с")
+                await asyncio.wait((stopped,), timeout=delay)
+                continue
+            errors = 0
+            for update in updates:
+                while not submit(update):
+                    if stopping.is_set():
+                        # Непереданные не подтверждены — Telegram пришлёт их снова
+                        return offset
+                    await asyncio.sleep(0.05)
+                offset = update.update_id + 1
+    finally:
+        stopped.cancel()
+    return offset
+
+
+async def confirm_updates(bot, offset):
+    """Подтверждает Telegram обновления до offset, чтобы после перезапуска они не пришли снова"""
+    if offset is None:
+        return
+    try:
+        await bot.get_updates(offset=offset, limit=1, timeout=0)
+    except TelegramAPIError as e:
+        logger.warning(f"⚠️ Не удалось подтвердить обновления до {offset}: {e}")
+
+
+async def restore_pending_updates(app, submit):
+    """Передаёт в submit обновления, сохранённые при прошлой остановке"""
+    payloads = await app.db.take_pending_updates()
+    for payload in payloads:
+        update = types.Update.model_validate_json(payload, context={"bot": app.bot})
+        while not submit(update):
+            await asyncio.sleep(0.05)
+    if payloads:
+        logger.info(f"💾 Обновлений, сохранённых при прошлой остановке: {len(payloads)}")
+
+
+async def run_webhook(app, submit, stopping):
+    secret = WEBHOOK_SECRET or secrets.token_urlsafe(32)
+    server = WebhookServer(app.bot, secret, submit)
+    await server.start(app.dp.resolve_used_update_types())
+    try:
+        await stopping.wait()
+    finally:
+        # Webhook в Telegram не удаляем: пока нас нет, он повторяет доставку
+        await server.stop()
+
+# ===== НЕСКОЛЬКО ПРОЦЕССОВ =====
+class ProcessRouter:
+    """Раздаёт обновления процессам-обработчикам по хешу ID пользователя.
+
+    Все обновления одного пользователя попадают в один процесс: порядок
+    сообщений сохраняется, а его состояние FSM и кэш профиля живут только
+    там. Общие данные процессы делят через SQLite (WAL). Отправку рассылок
+    и заявок ведёт только обработчик 0 — лимиты Telegram общие на бота.
+    Обработчик, завершившийся сам, останавливает весь бот (monitor):
+    без него его пользователи остались бы без ответа.
+    """
+
+    def __init__(self, workers=BOT_WORKERS, queue_size=UPDATE_QUEUE_SIZE):
+        self._context = multiprocessing.get_context("spawn")
+        self._queues = [self._context.Queue(maxsize=queue_size) for _ in range(workers)]
+        self._processes = []
+
+    def submit(self, update):
+        queue = self._queues[update_user_id(update) % len(self._queues)]
+        try:
+            queue.put_nowait(update.model_dump_json(exclude_none=True, by_alias=True))
+        except queue_module.Full:
+            return False
+        return True
+
+    def start(self):
+        for index, queue in enumerate(self._queues):
+            process = self._context.Process(
+                target=worker_process,
+                args=(index, queue),
+                name=f"bot-worker-{index}"
+            )
+            process.start()
+            self._processes.append(process)
+
+    async def monitor(self, stopping, interval=WORKER_POLL_INTERVAL):
+        while not stopping.is_set():
+            await asyncio.sleep(interval)
+            for process in self._processes:
+                if not process.is_alive():
+                    logger.error(f"❌ {process.name} завершился (код {process.exitcode}), останавливаю бота")
+                    stopping.set()
+                    return
+
+    @staticmethod
+    def _send_stop(queue, process):
+        """Ставит в очередь сигнал остановки, пока процесс жив и может её разобрать"""
+        while process.is_alive():
+            try:
+                queue.put(None, timeout=WORKER_POLL_INTERVAL)
+                return
+            except queue_module.Full:
+                pass
+
+    @staticmethod
+    def _drain(queue):
+        """Обновления, оставшиеся в очереди остановившегося процесса"""
+        payloads = []
+        while True:
+            try:
+                payload = queue.get(timeout=0.1)
+            except queue_module.Empty:
+                return payloads
+            if payload is not None:
+                payloads.append(payload)
+
+    async def stop(self, timeout=WORKER_STOP_TIMEOUT):
+        """Процессы дорабатывают свои очереди и останавливаются сами; зависшие убиваются.
+
+        Возвращает обновления, которые остались в очередях, — их нужно сохранить.
+        """
+        loop = asyncio.get_running_loop()
+        for queue, process in zip(self._queues, self._processes):
+            await loop.run_in_executor(None, self._send_stop, queue, process)
+        deadline = time.monotonic() + timeout
+        for process in self._processes:
+            await loop.run_in_executor(None, process.join, max(deadline - time.monotonic(), 0))
+            if process.is_alive():
+                logger.warning(f"⚠️ {process.name} не остановился вовремя")
+                process.kill()
+                await loop.run_in_executor(None, process.join)
+        self._processes = []
+        leftovers = []
+        for queue in self._queues:
+            leftovers += await loop.run_in_executor(None, self._drain, queue)
+        return leftovers
+
+
+async def watch_catalog(app):
+    """Перечитывает справочник при изменении файла (в каждом процессе)"""
+    while True:
+        await asyncio.sleep(CATALOG_CHECK_INTERVAL)
+        if app.catalog.mtime != await asyncio.to_thread(catalog_mtime):
+            try:
+                app.catalog = await asyncio.to_thread(Catalog.load)
+                logger.info("🔁 Справочник перечитан")
+            except CatalogError as e:
+                logger.error(f"❌ Справочник: {e}")
+
+
+async def run_worker(app, index, queue):
+    """Процесс-обработчик: получает обновления от ProcessRouter.
+
+    Останавливается по сигналу остановки в очереди, по SIGTERM/SIGINT или
+    когда пропал процесс приёма; необработанное сохраняет в БД.
+    """
+    await app.start_services(
+        primary=index == 0,
+        metrics_port=METRICS_PORT and METRICS_PORT + 1 + index,
+        record_path=RECORD_PATH and f"{RECORD_PATH}.{index}"
+    )
+    pool = UpdatePool(app.dp, app.bot)
+    pool.start()
+    watcher = asyncio.create_task(watch_catalog(app))
+    stopping = asyncio.Event()
+    handle_stop_signals(stopping)
+    parent = multiprocessing.parent_process()
+    loop = asyncio.get_running_loop()
+    logger.info(f"👷 Обработчик {index} запущен (pid {os.getpid()})")
+    try:
+        while not stopping.is_set():
+            try:
+                payload = await loop.run_in_executor(None, queue.get, True, WORKER_POLL_INTERVAL)
+            except queue_module.Empty:
+                if parent is not None and not parent.is_alive():
+                    logger.warning(f"⚠️ Процесс приёма пропал, обработчик {index} останавливается")
+                    break
+                continue
+            if payload is None:
+                break
+            update = types.Update.model_validate_json(payload, context={"bot": app.bot})
+            while not pool.submit(update):
+                await asyncio.sleep(0.01)
+    finally:
+        watcher.cancel()
+        await pool.stop()
+        await app.db.save_pending_updates(pool.leftovers())
+        await app.stop_services()
+        await app.bot.session.close()
+
+
+def worker_process(index, queue):
+    # Сигнал остановки, полученный всей группой процессов, ничего не теряет:
+    # недоработанное обработчик сохраняет сам, а оставшееся в его очереди —
+    # процесс приёма (ProcessRouter.stop)
+    logging.basicConfig(level=logging.INFO)
+    app = create_app()
+    asyncio.run(run_worker(app, index, queue))
+
+
+async def run_ingress(app, stopping):
+    """Процесс приёма: только получает обновления и раздаёт их обработчикам"""
+    await app.db.init_db()
+    await app.db.recover_interrupted_broadcasts()
+    await app.metrics_server.start()
+    router = ProcessRouter()
+    router.start()
+    monitor = asyncio.create_task(router.monitor(stopping))
+    allowed_updates = app.dp.resolve_used_update_types()
+    offset = None
+    try:
+        await restore_pending_updates(app, router.submit)
+        if BOT_MODE == "webhook":
+            await run_webhook(app, router.submit, stopping)
+        else:
+            offset = await poll_updates(app.bot, router.submit, allowed_updates, stopping)
+    finally:
+        monitor.cancel()
+        await app.db.save_pending_updates(await router.stop())
+        await confirm_updates(app.bot, offset)
+        await app.db_engine.close()
+        await app.metrics_server.stop()
+        await app.bot.session.close()
 
 # ===== ЗАПУСК БОТА =====
-async def main():
+class App:
+    """Экземпляр бота: Bot, диспетчер, база и фоновые компоненты.
+
+    Импорт модуля ничего не создаёт и не читает — всё происходит здесь.
+    Экземпляры независимы (своя база, кэши, сессии FSM, роутер) и могут
+    жить в одном процессе. Обработчики получают экземпляр аргументом app
+    из workflow_data диспетчера. Соединения с БД и Bot API открываются
+    позже — в start_services и при первых запросах.
+    """
+
+    def __init__(self, token=None, db_path=None):
+        self.catalog = load_catalog()
+        self.metrics = Metrics()
+        self.db_engine = DatabaseEngine(db_path or DB_PATH)
+        self.user_cache = UserCache()
+        self.activity_buffer = ActivityBuffer(self.db_engine)
+        self.db = Database(
+            self.db_engine, self.user_cache, self.activity_buffer, self.metrics,
+            sync_interval=WORKER_POLL_INTERVAL if BOT_WORKERS > 1 else None
+        )
+        self.fsm_storage = SQLiteStorage(self.db_engine, self.metrics)
+        self.flood_control = FloodControl(self.metrics)
+        self.send_limiter = RateLimiter()
+        self.broadcaster = Broadcaster(self.send_limiter)
+        self.broadcast_manager = BroadcastManager(self)
+        self.album_collector = AlbumCollector(functools.partial(send_album, self))
+        self.ticket_dispatcher = TicketDispatcher(self)
+        self.ticket_router = TicketRouter(self)
+        self.maintenance = MaintenanceScheduler(self.db)
+        self.recorder = TrafficRecorder()
+        self.metrics_server = MetricsServer(self.metrics)
+
+        token = token or BOT_TOKEN
+        if BOT_API_URL:
+            self.bot = Bot(token=token, session=AiohttpSession(api=TelegramAPIServer.from_base(BOT_API_URL)))
+        else:
+            self.bot = Bot(token=token)
+        self.bot.session.middleware(ApiMetricsMiddleware(self.metrics))
+
+        self.dp = Dispatcher(storage=self.fsm_storage, app=self)
+        self.dp.update.outer_middleware(self.recorder)
+        self.dp.update.outer_middleware(self.maintenance)
+        self.dp.message.outer_middleware(self.flood_control)
+        for observer in (self.dp.message, self.dp.callback_query, self.dp.my_chat_member):
+            observer.middleware(HandlerMetricsMiddleware())
+        self.dp.include_router(handlers.create_router())
+        self._register_gauges()
+
+    def _register_gauges(self):
+        """Датчики состояния этого экземпляра в его реестре метрик"""
+        metrics = self.metrics
+        metrics.gauge("bot_user_cache_entries", "Профилей в кэше", lambda: len(self.user_cache._entries))
+        metrics.gauge("bot_user_cache_hit_ratio", "Доля попаданий в кэш профилей",
+                      lambda: self.user_cache.stats()["hit_rate"])
+        metrics.gauge("bot_activity_pending", "Пользователей в буфере активности",
+                      lambda: len(self.activity_buffer._pending))
+        metrics.gauge("bot_fsm_sessions", "Сессий FSM в памяти", lambda: len(self.fsm_storage._sessions))
+        metrics.gauge("bot_fsm_dirty_sessions", "Сессий FSM, ждущих записи в БД",
+                      lambda: len(self.fsm_storage._dirty))
+        metrics.gauge("bot_fsm_memory_bytes", "Оценка памяти, занятой сессиями FSM",
+                      lambda: self.fsm_storage.memory)
+        metrics.gauge("bot_flood_tracked_users", "Пользователей в таблице ограничений",
+                      lambda: len(self.flood_control._buckets))
+        metrics.gauge("bot_broadcasts_active", "Рассылок, выполняемых этим процессом",
+                      lambda: len(self.broadcast_manager.jobs))
+
+    def is_admin(self, user_id):
+        return self.ticket_router.is_admin(user_id)
+
+    async def start_services(self, primary=True, metrics_port=METRICS_PORT, record_path=RECORD_PATH):
+        """Запускает БД и фоновые задачи.
+
+        primary — процесс, который ведёт рассылки, доставку заявок и
+        обслуживание БД; при нескольких процессах остальные только
+        оставляют эту работу в БД.
+        """
+        shared = BOT_WORKERS > 1
+        await self.db.init_db()
+        await self.metrics_server.start(port=metrics_port)
+        if record_path:
+            await self.recorder.open(record_path)
+        self.activity_buffer.start()
+        self.fsm_storage.start()
+        if primary:
+            await self.broadcast_manager.resume_all(recover=not shared)
+            if shared:
+                self.broadcast_manager.watch()
+            self.maintenance.start()
+        else:
+            self.broadcast_manager.runs_jobs = False
+        await self.ticket_router.start(primary)
+        if primary:
+            self.ticket_dispatcher.start(poll_interval=WORKER_POLL_INTERVAL if shared else None)
+
+    async def stop_services(self):
+        """Останавливает фоновые задачи; всё несохранённое записывается до закрытия БД"""
+        await self.album_collector.close()
+        await self.broadcast_manager.stop()
+        await self.maintenance.stop()
+        await self.ticket_dispatcher.stop()
+        await self.ticket_router.stop()
+        await self.fsm_storage.close()
+        await self.activity_buffer.stop()
+        await self.db_engine.close()
+        await self.metrics_server.stop()
+        await self.recorder.close()
+
+def create_app(token=None, db_path=None):
+    """Новый независимый экземпляр бота (см. App)"""
+    return App(token, db_path)
+
+def handle_stop_signals(stopping):
+    """SIGTERM и SIGINT запускают плавную остановку; повторный сигнал — немедленную"""
+    loop = asyncio.get_running_loop()
+
+    def stop(sig):
+        logger.info(f"🛑 Получен {sig.name}, останавливаюсь")
+        stopping.set()
+        loop.remove_signal_handler(sig)
+
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, stop, sig)
+        except NotImplementedError:
+            # Windows: остаётся KeyboardInterrupt по Ctrl+C
+            pass
+
+async def main(app):
     print("="*50)
     print("🚀 Бот для вызова сисадмина запущен!")
     print(f"👤 Админ ID: {ADMIN_ID}")
     print(f"📁 База данных: {DB_PATH}")
+    print(f"📡 Режим: {BOT_MODE}")
+    print(f"👷 Процессов-обработчиков: {BOT_WORKERS}")
     print("="*50)
-    await dp.start_polling(bot)
+    stopping = asyncio.Event()
+    handle_stop_signals(stopping)
+    if BOT_WORKERS > 1:
+        await run_ingress(app, stopping)
+        return
+    
+    await app.start_services()
+    pool = UpdatePool(app.dp, app.bot)
+    pool.start()
+    offset = None
+    try:
+        await restore_pending_updates(app, pool.submit)
+        if BOT_MODE == "webhook":
+            await run_webhook(app, pool.submit, stopping)
+        else:
+            offset = await poll_updates(app.bot, pool.submit, app.dp.resolve_used_update_types(), stopping)
+    finally:
+        logger.info("🛑 Остановка: дорабатываю принятые обновления")
+        await pool.stop()
+        # Недоработанные обработаются после запуска, Telegram подтверждаем всё полученное
+        await app.db.save_pending_updates(pool.leftovers())
+        await confirm_updates(app.bot, offset)
+        await app.stop_services()
+        await app.bot.session.close()
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    if not BOT_TOKEN:
+        print("❌ Токен не найден!")
+        exit(1)
+    app = create_app()
     try:
-        asyncio.run(main())
+        asyncio.run(main(app))
     except KeyboardInterrupt:
-        print("🛑 Бот остановлен")
\ No newline at end of file
+        pass
+    print("🛑 Бот остановлен")
@@ -0,0 +1,218 @@
+"""Воспроизведение записанного трафика (см. RECORD_PATH в bot.py).
+
+Подаёт обновления из журнала в настоящий dp с поддельным Bot API и
+временной базой — с исходными паузами, в N раз быстрее или без пауз.
+Перед запуском заводит сотрудников, встреченных в журнале, и выставляет
+им состояние FSM, в котором они были в момент первой записи, чтобы
+диалоги шли так же, как в бою.
+
+Запуск:
+    python replay.py traffic.jsonl.gz                 # в исходном темпе
+    python replay.py traffic.jsonl.gz.* --speed 10    # журналы процессов, в 10 раз быстрее
+    python replay.py traffic.jsonl.gz --max --api-latency 30
+"""
+import argparse
+import asyncio
+import gzip
+import heapq
+import json
+import time
+import zlib
+
+from bench import DbCounter, bot, create_app, percentile, write_json
+
+from aiogram.dispatcher.event.bases import UNHANDLED
+from aiogram.fsm.storage.base import StorageKey
+from aiogram.types import Update
+
+REGISTRATION_STATES = {
+    bot.Form.name.state,
+    bot.Form.confirm_name.state,
+    bot.Form.workplace.state,
+    bot.Form.confirm_workplace.state,
+}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Воспроизведение журнала трафика")
+    parser.add_argument("logs", nargs="+", help="файлы журнала (записи сливаются по времени)")
+    pace = parser.add_mutually_exclusive_group()
+    pace.add_argument("--speed", type=float, default=1.0, help="во сколько раз быстрее оригинала")
+    pace.add_argument("--max", action="store_true", help="без пауз, как можно быстрее")
+    parser.add_argument("--concurrency", type=int, default=bot.UPDATE_WORKERS,
+                        help="одновременно обрабатываемых обновлений")
+    parser.add_argument("--api-latency", type=float, default=0.0, help="задержка ответа Bot API, мс")
+    parser.add_argument("--no-seed", action="store_true", help="не заводить сотрудников из журнала")
+    parser.add_argument("--json", help="записать результаты в файл")
+    return parser.parse_args()
+
+
+def read_log(path):
+    """Записи одного журнала; обрезанный хвост (файл ещё пишется) пропускается"""
+    try:
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    return
+    except (EOFError, zlib.error, gzip.BadGzipFile) as e:
+        print(f"⚠️ {path}: журнал оборван ({e}), читаю до этого места")
+
+
+def read_logs(paths):
+    return heapq.merge(*(read_log(path) for path in paths), key=lambda record: record["t"])
+
+
+async def seed(app, paths):
+    """Заводит сотрудников из журнала с их первым записанным состоянием.
+
+    Зарегистрированным считается тот, чьё первое непустое состояние не из
+    регистрации: новичок после /start сразу попадает в Form.name.
+    """
+    first_states = {}
+    known_states = {}  # user_id -> первое непустое состояние
+    for record in read_logs(paths):
+        update = Update.model_validate(record["u"])
+        user_id = bot.update_user_id(update)
+        if not user_id or user_id == bot.ADMIN_ID:
+            continue
+        first_states.setdefault(user_id, record["s"])
+        if record["s"] is not None:
+            known_states.setdefault(user_id, record["s"])
+
+    workplace = sorted(app.catalog.workplaces)[0]
+    registered = [uid for uid in first_states if known_states.get(uid) not in REGISTRATION_STATES]
+    await app.db_engine.executemany(
+        "INSERT OR IGNORE INTO users (user_id, name, workplace) VALUES (?, ?, ?)",
+        [(user_id, f"Аноним {user_id % 10000}", workplace) for user_id in registered]
+    )
+    for user_id, state in first_states.items():
+        if state is None:
+            continue
+        key = StorageKey(bot_id=app.bot.id, chat_id=user_id, user_id=user_id)
+        await app.fsm_storage.set_state(key, state)
+        await app.fsm_storage.set_data(key, {"name": f"Аноним {user_id % 10000}", "workplace": workplace})
+    await app.fsm_storage.flush()
+    return len(first_states), len(registered)
+
+
+async def replay(app, paths, args):
+    """Подаёт обновления по расписанию; задержка — от расчётного прихода до конца обработки.
+
+    Обновления, которые не дошли ни до одного обработчика (отброшены защитой
+    от флуда или никому не подошли), в задержки не попадают и считаются отдельно.
+    """
+    latencies = []
+    errors = 0
+    unhandled = 0
+    lag = 0.0
+    semaphore = asyncio.Semaphore(args.concurrency)
+    inflight = asyncio.Semaphore(args.concurrency * 10)
+    previous = {}  # user_id -> задача с предыдущим обновлением пользователя
+
+    async def handle(update, arrived, before):
+        nonlocal errors, unhandled
+        try:
+            if before is not None:
+                await asyncio.wait([before])
+            async with semaphore:
+                response = await app.dp.feed_update(app.bot, update)
+            if response is UNHANDLED:
+                unhandled += 1
+            else:
+                latencies.append(time.perf_counter() - arrived)
+        except Exception:
+            errors += 1
+        finally:
+            inflight.release()
+
+    started = time.perf_counter()
+    first_t = None
+    tasks = set()
+    for record in read_logs(paths):
+        if first_t is None:
+            first_t = record["t"]
+        if not args.max:
+            due = started + (record["t"] - first_t) / args.speed
+            delay = due - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            else:
+                lag = max(lag, -delay)
+        await inflight.acquire()
+        update = Update.model_validate(record["u"], context={"bot": app.bot})
+        user_id = bot.update_user_id(update)
+        arrived = time.perf_counter() if args.max else max(due, started)
+        task = asyncio.create_task(handle(update, arrived, previous.get(user_id)))
+        previous[user_id] = task
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+    if tasks:
+        await asyncio.wait(tasks)
+    return latencies, errors, unhandled, time.perf_counter() - started, lag
+
+
+def throttled(app):
+    """Отказы защиты от флуда по причинам: {"flood": n, "ticket": n}"""
+    return {dict(labels)["reason"]: value for labels, value in app.metrics.counters("bot_throttled_total").items()}
+
+
+async def main(args):
+    # Темп журнала сжимается — во столько же раз сжимаются лимиты и кулдауны
+    app = create_app(args.api_latency / 1000, speed=None if args.max else args.speed)
+    counter = DbCounter(app.db_engine)
+    await app.start_services(metrics_port=0, record_path=None)
+    try:
+        if not args.no_seed:
+            users, registered = await seed(app, args.logs)
+            print(f"👥 Сотрудников в журнале: {users}, заведено зарегистрированными: {registered}")
+        reads, writes = counter.snapshot()
+        throttled_before = throttled(app)
+        latencies, errors, unhandled, elapsed, lag = await replay(app, args.logs, args)
+        throttled_after = throttled(app)
+        await app.activity_buffer.flush()
+        await app.fsm_storage.flush()
+    finally:
+        await app.stop_services()
+
+    count = len(latencies)
+    dropped = throttled_after.get("flood", 0) - throttled_before.get("flood", 0)
+    cooldowns = throttled_after.get("ticket", 0) - throttled_before.get("ticket", 0)
+    result = {
+        "updates": count,
+        "errors": errors,
+        "unhandled": unhandled,
+        "throttled_flood": dropped,
+        "throttled_cooldown": cooldowns,
+        "seconds": round(elapsed, 3),
+        "updates_per_second": round(count / elapsed, 1) if elapsed else 0.0,
+        "p50_ms": round(percentile(latencies, 0.5) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+        "max_lag_ms": round(lag * 1000, 2),
+        "db_reads": counter.reads - reads,
+        "db_writes": counter.writes - writes,
+    }
+    print(
+        f"📼 Обновлений: {count} за {result['seconds']} с ({result['updates_per_second']}/с), "
+        f"ошибок: {errors}\n"
+        f"🚦 Не обработано: {unhandled} (из них отброшено защитой от флуда: {dropped}), "
+        f"отказов по кулдауну заявок: {cooldowns}\n"
+        f"⏱ Задержка: p50 {result['p50_ms']} мс, p99 {result['p99_ms']} мс; "
+        f"отставание подачи до {result['max_lag_ms']} мс\n"
+        f"🗄 Чтений БД: {result['db_reads']}, записей: {result['db_writes']}"
+    )
+    handlers = sorted(
+        app.metrics.histograms("bot_handler_seconds").items(),
+        key=lambda item: item[1].sum,
+        reverse=True
+    )
+    for labels, h in handlers[:bot.PERF_TOP]:
+        name = " / ".join(str(value) for _, value in labels)
+        print(f"   {name}: {h.count} шт., p50 {h.quantile(0.5) * 1000:.1f} мс, p99 {h.quantile(0.99) * 1000:.1f} мс")
+    if args.json:
+        await asyncio.to_thread(write_json, args.json, result)
+
+
+if __name__ == "__main__":
+    asyncio.run(main(parse_args()))
@@ -0,0 +1,18 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bot  # noqa: E402
+
+
+@pytest.fixture
+def app(tmp_path):
+    """Экземпляр бота с пустой базой во временном каталоге"""
+    app = bot.create_app(token="42:TEST", db_path=str(tmp_path / "bot.db"))
+    asyncio.run(app.db.init_db())
+    yield app
+    asyncio.run(app.db_engine.close())
@@ -0,0 +1,83 @@
+import asyncio
+import datetime
+
+from aiogram.types import Chat, Message, Update, User
+
+import bench
+import bot
+
+
+def admin_command(app, text):
+    """Прогоняет команду главного админа через диспетчер; возвращает тексты ответов"""
+    session = app.bot.session = bench.FakeSession()
+    message = Message(
+        message_id=1,
+        date=datetime.datetime.now(),
+        chat=Chat(id=bot.ADMIN_ID, type="private"),
+        from_user=User(id=bot.ADMIN_ID, is_bot=False, first_name="Админ"),
+        text=text
+    )
+    asyncio.run(app.dp.feed_update(app.bot, Update(update_id=1, message=message)))
+    return [sent_text for _, _, sent_text in session.sent]
+
+
+def test_admins_escapes_names_and_routes(app):
+    asyncio.run(app.db.save_admin(7, "<Иван & Ко>"))
+    asyncio.run(app.db.add_admin_route(7, "workplace", "Склад <А>"))
+    [text] = admin_command(app, "/admins")
+    assert "&lt;Иван &amp; Ко&gt;" in text
+    assert "Склад &lt;А&gt;" in text
+
+
+def test_stats_escapes_workplaces_and_problems(app):
+    asyncio.run(app.db.save_user(1, "Иван", "Цех <1> & склад"))
+    [text] = admin_command(app, "/stats")
+    assert "Цех &lt;1&gt; &amp; склад: 1" in text
+
+
+def load_admins(app, admins, routes=()):
+    """admins — {admin_id: на смене}, routes — (admin_id, вид, название)"""
+    async def scenario():
+        for admin_id, on_call in admins.items():
+            await app.db.save_admin(admin_id, f"Админ {admin_id}")
+            await app.db.set_admin_on_call(admin_id, on_call)
+        for route in routes:
+            await app.db.add_admin_route(*route)
+        await app.ticket_router.load()
+
+    asyncio.run(scenario())
+    return app.ticket_router
+
+
+def test_route_prefers_problem_then_workplace_then_unrouted(app):
+    router = load_admins(app, {1: True, 2: True, 3: True}, [
+        (1, "problem", "Принтер"),
+        (2, "workplace", "Склад"),
+    ])
+    assert router.choose("Склад", "Принтер") == 1
+    assert router.choose("Склад", "1С") == 2
+    assert router.choose("Касса", "1С") == 3
+    # Закреплённый админ не на смене — заявка уходит следующей группе
+    asyncio.run(app.db.set_admin_on_call(1, False))
+    asyncio.run(router.load())
+    assert router.choose("Склад", "Принтер") == 2
+
+
+def test_route_picks_least_loaded_on_call_admin(app):
+    router = load_admins(app, {1: True, 2: True, 3: False})
+
+    async def scenario():
+        return [await router.create_ticket(user_id, "Иван", "Склад", "Принтер") for user_id in range(4)]
+
+    asyncio.run(scenario())
+    assert (router.load_of(1), router.load_of(2), router.load_of(3)) == (2, 2, 0)
+
+
+def test_ticket_falls_back_to_main_admin(app):
+    router = load_admins(app, {1: False})
+    assert router.choose("Склад", "Принтер") is None
+    asyncio.run(router.create_ticket(7, "Иван", "Склад", "Принтер"))
+    assigned = asyncio.run(app.db_engine.read(
+        lambda conn: conn.execute("SELECT assigned_admin FROM tickets").fetchall()
+    ))
+    assert assigned == [(bot.ADMIN_ID,)]
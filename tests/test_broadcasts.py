@@ -0,0 +1,69 @@
+import asyncio
+import datetime
+
+import pytest
+
+import bench
+import bot
+
+WORKPLACES = ("Склад", "Склад 2", "Бухгалтерия")
+
+
+def test_audience_parse_filters_and_text():
+    audience, text = bot.Audience.parse(
+        "@Склад 2 @Бухгалтерия активные:7 после:01.09.2024 {name}, привет", WORKPLACES
+    )
+    assert audience.workplaces == ["Склад 2", "Бухгалтерия"]
+    assert audience.active_days == 7
+    assert audience.registered_after == datetime.date(2024, 9, 1)
+    assert text == "{name}, привет"
+
+
+def test_audience_parse_stops_at_first_plain_word():
+    audience, text = bot.Audience.parse("Склад закрыт, активные:7 не фильтр", WORKPLACES)
+    assert audience.describe() == "все сотрудники"
+    assert text == "Склад закрыт, активные:7 не фильтр"
+
+
+@pytest.mark.parametrize("text", ["@Гараж привет", "активные:0 привет", "после:31.02.2024 привет"])
+def test_audience_parse_rejects_bad_filters(text):
+    with pytest.raises(ValueError):
+        bot.Audience.parse(text, WORKPLACES)
+
+
+def test_audience_where_uses_filter_indexes():
+    where, params = bot.Audience(["Склад"], active_days=3).where()
+    assert where == "+is_blocked = 0 AND workplace IN (?) AND last_active >= datetime('now', ?)"
+    assert params == ["Склад", "-3 days"]
+    assert bot.Audience().where() == ("is_blocked = 0", [])
+
+
+def test_resumed_broadcast_sends_nobody_twice(app):
+    session = app.bot.session = bench.FakeSession()
+    app.send_limiter.bucket = bot.TokenBucket(1_000_000)
+    app.send_limiter.chat_interval = 0
+    workplace = next(iter(app.catalog.workplaces))
+
+    async def scenario():
+        for user_id in range(1, 11):
+            await app.db.save_user(user_id, f"Сотрудник {user_id}", workplace)
+        job_id, total = await app.db.create_broadcast("привет", bot.ADMIN_ID, bot.Audience())
+        assert total == 10
+
+        # Процесс упал посреди пачки: 1 доставлен, 2 и 3 захвачены, но неизвестно, дошли ли
+        await app.db.claim_broadcast_batch(job_id, 3)
+        await app.db.save_broadcast_results(job_id, [(bot.RECIPIENT_SENT, None, 1)])
+
+        await app.db.recover_interrupted_broadcasts()
+        await app.broadcast_manager.resume_all(recover=False)
+        await asyncio.gather(*app.broadcast_manager._tasks.values())
+        # Повторный запуск завершённую рассылку не трогает
+        await app.broadcast_manager.resume_all()
+        assert not app.broadcast_manager.jobs
+        return job_id
+
+    job_id = asyncio.run(scenario())
+    assert sorted(chat_id for _, chat_id, _ in session.sent) == list(range(4, 11))
+    counts = asyncio.run(app.db.get_broadcast_counts(job_id))
+    assert counts == {bot.RECIPIENT_SENT: 8, bot.RECIPIENT_FAILED: 2}
+    assert asyncio.run(app.db.get_broadcast_status(job_id)) == bot.BROADCAST_DONE
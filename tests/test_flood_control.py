@@ -0,0 +1,62 @@
+import asyncio
+
+import pytest
+
+import bot
+
+
+class FakeMessage:
+    def __init__(self, user_id, text):
+        self.from_user = type("User", (), {"id": user_id})()
+        self.text = text
+        self.answers = []
+
+    async def answer(self, text, **kwargs):
+        self.answers.append(text)
+
+
+class FakeState:
+    def __init__(self, data):
+        self.data = data
+
+    async def get_data(self):
+        return dict(self.data)
+
+    async def clear(self):
+        self.data = {}
+
+
+def submit_ticket(app, user_id):
+    problem = next(iter(app.catalog.problems))
+    message = FakeMessage(user_id, problem)
+    asyncio.run(bot.process_problem(message, FakeState({"name": "Иван", "workplace": "Склад"}), app))
+    return message
+
+
+def test_flood_bucket_refills():
+    flood = bot.FloodControl(bot.Metrics(), rate=1000, burst=2)
+    assert flood.allow(1) == (True, False)
+    assert flood.allow(1) == (True, False)
+    assert flood.allow(1) == (False, True)
+    assert flood.allow(1) == (False, False)
+
+
+def test_cooldown_starts_only_after_ticket_is_created(app, monkeypatch):
+    async def fail(*args):
+        raise RuntimeError("db down")
+
+    monkeypatch.setattr(app.ticket_router, "create_ticket", fail)
+    with pytest.raises(RuntimeError):
+        submit_ticket(app, 7)
+    assert app.flood_control.cooldown_left(7, "ticket") == 0
+
+    async def create(*args):
+        return 1
+
+    monkeypatch.setattr(app.ticket_router, "create_ticket", create)
+    message = submit_ticket(app, 7)
+    assert message.answers[-1].startswith("✅ Заявка #1")
+    assert app.flood_control.cooldown_left(7, "ticket") > 0
+
+    message = submit_ticket(app, 7)
+    assert message.answers[-1].startswith("⏳")
@@ -0,0 +1,87 @@
+import asyncio
+
+from aiogram.fsm.storage.base import StorageKey
+
+import bot
+
+
+def storage_key(user_id):
+    return StorageKey(bot_id=42, chat_id=user_id, user_id=user_id)
+
+
+def stored_sessions(app):
+    return asyncio.run(app.db_engine.read(
+        lambda conn: conn.execute("SELECT state, data FROM fsm_sessions ORDER BY key").fetchall()
+    ))
+
+
+def test_new_session_survives_memory_pressure(app):
+    # Лимит меньше одной записи: каждая новая сессия сразу «сверх лимита»
+    storage = bot.SQLiteStorage(app.db_engine, app.metrics, memory_limit=0)
+
+    async def scenario():
+        await storage.set_state(storage_key(1), "Registration:name")
+        await storage.flush()
+        await storage.set_data(storage_key(2), {"name": "Иван"})
+        await storage.flush()
+
+    asyncio.run(scenario())
+    assert stored_sessions(app) == [("Registration:name", ""), (None, '{"name": "Иван"}')]
+
+
+def test_state_and_data_survive_restart(app):
+    async def scenario():
+        storage = bot.SQLiteStorage(app.db_engine, app.metrics)
+        await storage.set_state(storage_key(1), "Registration:workplace")
+        await storage.set_data(storage_key(1), {"name": "Иван"})
+        await storage.close()
+
+        restarted = bot.SQLiteStorage(app.db_engine, app.metrics)
+        return await restarted.get_state(storage_key(1)), await restarted.get_data(storage_key(1))
+
+    assert asyncio.run(scenario()) == ("Registration:workplace", {"name": "Иван"})
+
+
+def test_expired_session_is_dropped(app):
+    async def scenario():
+        storage = bot.SQLiteStorage(app.db_engine, app.metrics, ttl=60)
+        await storage.set_state(storage_key(1), "Registration:name")
+        await storage.set_state(storage_key(2), "Registration:name")
+        await storage.close()
+        await app.db_engine.execute(
+            "UPDATE fsm_sessions SET updated_at = updated_at - 3600 WHERE key = ?",
+            (storage.key_builder.build(storage_key(1)),)
+        )
+
+        restarted = bot.SQLiteStorage(app.db_engine, app.metrics, ttl=60)
+        # Просроченная сессия не подгружается, даже пока строка ещё в БД
+        assert await restarted.get_state(storage_key(1)) is None
+        assert await restarted.expire() == 1
+        return await restarted.get_state(storage_key(2))
+
+    assert asyncio.run(scenario()) == "Registration:name"
+    assert stored_sessions(app) == [("Registration:name", "")]
+
+
+def test_repeated_writes_are_coalesced(app, monkeypatch):
+    storage = bot.SQLiteStorage(app.db_engine, app.metrics)
+    writes = []
+    original = app.db_engine.write
+
+    async def write(func, *args):
+        writes.append(func)
+        return await original(func, *args)
+
+    monkeypatch.setattr(app.db_engine, "write", write)
+
+    async def scenario():
+        for step in range(10):
+            await storage.set_state(storage_key(1), f"Ticket:step{step}")
+            await storage.set_data(storage_key(1), {"step": step})
+        await storage.flush()
+        # Ничего не менялось — второй сброс в БД не ходит
+        await storage.flush()
+
+    asyncio.run(scenario())
+    assert len(writes) == 1
+    assert stored_sessions(app) == [("Ticket:step9", '{"step": 9}')]
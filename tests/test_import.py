@@ -0,0 +1,53 @@
+import asyncio
+
+import bot
+
+
+def run_import(app, path):
+    report = bot.ImportReport()
+    for batch in bot.import_batches(str(path), "csv", report, app.catalog.workplaces):
+        added, updated = asyncio.run(app.db.import_users(batch))
+        report.added += added
+        report.updated += updated
+    return report
+
+
+def test_import_keeps_source_last_active(app, tmp_path):
+    workplace = "Склад"
+    path = tmp_path / "users.csv"
+    path.write_text(
+        "user_id,name,workplace,last_active\n"
+        f"1,Иван,{workplace},2024-03-01 09:30:00\n"
+        f"2,Пётр,{workplace},\n"
+        f"3,Анна,{workplace},вчера\n",
+        encoding="utf-8"
+    )
+    report = run_import(app, path)
+    assert (report.added, report.skipped) == (2, 1)
+
+    rows = asyncio.run(app.db_engine.read(
+        lambda conn: conn.execute("SELECT user_id, last_active FROM users ORDER BY user_id").fetchall()
+    ))
+    assert rows == [(1, "2024-03-01 09:30:00"), (2, None)]
+
+    stats = asyncio.run(app.db.get_stats())
+    assert stats["daily_activity"] == [("2024-03-01", 1)]
+    assert stats["weekly_activity"] == [("2024-09", 1)]
+
+
+def test_reimport_does_not_touch_activity(app, tmp_path):
+    workplace = "Склад"
+    path = tmp_path / "users.csv"
+    path.write_text(f"user_id,name,workplace\n1,Иван,{workplace}\n", encoding="utf-8")
+    run_import(app, path)
+    asyncio.run(app.db_engine.execute(
+        "UPDATE users SET last_active = '2024-05-05 10:00:00' WHERE user_id = 1"
+    ))
+
+    path.write_text(f"user_id,name,workplace,last_active\n1,Иван Петров,{workplace},\n", encoding="utf-8")
+    report = run_import(app, path)
+    assert report.updated == 1
+    row = asyncio.run(app.db_engine.read(
+        lambda conn: conn.execute("SELECT name, last_active FROM users").fetchone()
+    ))
+    assert row == ("Иван Петров", "2024-05-05 10:00:00")
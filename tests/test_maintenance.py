@@ -0,0 +1,37 @@
+import asyncio
+
+import bot
+
+
+def test_retention_deletes_old_tickets_in_batches(app, monkeypatch):
+    scheduler = bot.MaintenanceScheduler(app.db, batch_size=2)
+    batches = []
+    purge_batch = app.db.purge_batch
+
+    async def counted(table, *args):
+        keys = await purge_batch(table, *args)
+        if table == "tickets":
+            batches.append(len(keys))
+        return keys
+
+    monkeypatch.setattr(app.db, "purge_batch", counted)
+
+    def seed(conn):
+        rows = [("delivered", "-200 days")] * 5 + [("failed", "-200 days"), ("pending", "-200 days")] \
+            + [("delivered", "-1 days")] * 2
+        conn.executemany(
+            "INSERT INTO tickets (user_id, name, workplace, problem, status, created_at) "
+            "VALUES (1, 'Иван', 'Склад', 'Принтер', ?, datetime('now', ?))",
+            rows
+        )
+
+    asyncio.run(app.db_engine.write(seed))
+    result = asyncio.run(scheduler.retention())
+
+    assert "закрытые заявки: 6" in result
+    assert batches == [2, 2, 2, 0]
+    left = asyncio.run(app.db_engine.read(
+        lambda conn: conn.execute("SELECT status, created_at > datetime('now', '-2 days') FROM tickets").fetchall()
+    ))
+    # Незакрытая старая остаётся, как и свежие
+    assert sorted(left) == [("delivered", 1), ("delivered", 1), ("pending", 0)]
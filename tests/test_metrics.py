@@ -0,0 +1,41 @@
+import asyncio
+
+import pytest
+from aiogram.exceptions import TelegramNetworkError, TelegramRetryAfter
+from aiogram.methods import SendMessage
+
+import bot
+
+
+def test_apps_keep_separate_registries(app, tmp_path):
+    other = bot.create_app(token="43:TEST", db_path=str(tmp_path / "other.db"))
+    try:
+        app.user_cache.put(1, ("Иван", "Склад", 0))
+        app.flood_control.cooldown_left(1, "ticket")
+        app.flood_control.start_cooldown(1, "ticket", 60)
+        app.flood_control.cooldown_left(1, "ticket")
+
+        assert "bot_user_cache_entries 1" in app.metrics.render()
+        assert "bot_user_cache_entries 0" in other.metrics.render()
+        assert app.metrics.counters("bot_throttled_total") == {(("reason", "ticket"),): 1}
+        assert other.metrics.counters("bot_throttled_total") == {}
+    finally:
+        asyncio.run(other.db_engine.close())
+
+
+def test_api_errors_are_labeled_by_error_code(app):
+    method = SendMessage(chat_id=1, text="привет")
+    middleware = bot.ApiMetricsMiddleware(app.metrics)
+
+    async def fail(error):
+        async def make_request(bot_, method_):
+            raise error
+        with pytest.raises(type(error)):
+            await middleware(make_request, app.bot, method)
+
+    asyncio.run(fail(TelegramRetryAfter(method=method, message="Too Many Requests", retry_after=3)))
+    asyncio.run(fail(TelegramNetworkError(method=method, message="timeout")))
+    assert app.metrics.counters("bot_api_errors_total") == {
+        (("method", "sendMessage"), ("error", "429")): 1,
+        (("method", "sendMessage"), ("error", "TelegramNetworkError")): 1,
+    }
@@ -0,0 +1,104 @@
+import asyncio
+import sqlite3
+
+import bot
+
+
+def legacy_database(path):
+    """База первой версии бота: только users, без user_version"""
+    conn = sqlite3.connect(path)
+    conn.execute("""
+        CREATE TABLE users (
+            user_id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            workplace TEXT NOT NULL,
+            registered_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            is_blocked INTEGER DEFAULT 0,
+            last_active TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    conn.execute("CREATE INDEX idx_is_blocked ON users(is_blocked)")
+    conn.execute("CREATE INDEX idx_last_active ON users(last_active)")
+    conn.executemany(
+        "INSERT INTO users (user_id, name, workplace, is_blocked, last_active) VALUES (?, ?, ?, ?, ?)",
+        [
+            (1, "Иван", "Склад", 0, "2024-03-01 09:00:00"),
+            (2, "Пётр", "Склад", 1, "2024-03-01 10:00:00"),
+            (3, "Анна", "Бухгалтерия", 0, "2024-03-05 11:00:00"),
+        ]
+    )
+    conn.commit()
+    conn.close()
+
+
+def migrate(path, migrations=None, batch_size=bot.MIGRATION_BATCH_SIZE):
+    async def run():
+        engine = bot.DatabaseEngine(str(path))
+        try:
+            return await bot.Migrator(engine, migrations, batch_size).migrate()
+        finally:
+            await engine.close()
+    return asyncio.run(run())
+
+
+def query(path, sql):
+    conn = sqlite3.connect(path)
+    try:
+        return conn.execute(sql).fetchall()
+    finally:
+        conn.close()
+
+
+def test_legacy_database_upgrades_to_latest(tmp_path):
+    path = tmp_path / "users.db"
+    legacy_database(path)
+
+    # Пачками по одной строке — перенос данных идёт в несколько транзакций
+    assert migrate(path, batch_size=1) == bot.MIGRATIONS[-1].version
+    assert query(path, "PRAGMA user_version") == [(bot.MIGRATIONS[-1].version,)]
+    assert query(path, "SELECT * FROM migration_progress") == []
+
+    assert query(path, "SELECT workplace, total, blocked FROM workplace_stats ORDER BY workplace") == [
+        ("Бухгалтерия", 1, 0), ("Склад", 2, 1)
+    ]
+    assert query(path, "SELECT day, users FROM activity_daily ORDER BY day") == [
+        ("2024-03-01", 2), ("2024-03-05", 1)
+    ]
+    assert query(path, "SELECT version FROM cache_versions WHERE name = 'users'") == [(0,)]
+    assert query(path, "SELECT COUNT(*) FROM pending_updates") == [(0,)]
+    # Данные сотрудников миграции не трогают
+    assert query(path, "SELECT user_id, name, is_blocked FROM users ORDER BY user_id") == [
+        (1, "Иван", 0), (2, "Пётр", 1), (3, "Анна", 0)
+    ]
+
+
+def test_tickets_and_broadcasts_survive_upgrade(tmp_path):
+    path = tmp_path / "users.db"
+    assert migrate(path, bot.MIGRATIONS[:1]) == 1
+    conn = sqlite3.connect(path)
+    conn.executemany(
+        "INSERT INTO tickets (user_id, name, workplace, problem, status, delivered_at) VALUES (?, ?, ?, ?, ?, ?)",
+        [
+            (1, "Иван", "Склад", "Принтер", "delivered", "2024-03-01 09:00:00"),
+            (1, "Иван", "Склад", "Сеть", "pending", None),
+        ]
+    )
+    conn.execute("INSERT INTO broadcasts (text, admin_chat_id) VALUES ('Скобки {не шаблон}', 1)")
+    conn.commit()
+    conn.close()
+
+    assert migrate(path) == bot.MIGRATIONS[-1].version
+    assert query(path, "SELECT problem, assigned_admin, closed_at FROM tickets ORDER BY id") == [
+        ("Принтер", bot.ADMIN_ID, "2024-03-01 09:00:00"),
+        ("Сеть", bot.ADMIN_ID, None),
+    ]
+    # Текст старой рассылки экранирован и отображается как был
+    text, media = query(path, "SELECT text, media FROM broadcasts")[0]
+    assert bot.MessageTemplate(text).render(("", "")) == "Скобки {не шаблон}"
+    assert media is None
+
+
+def test_migrated_database_is_not_touched_again(tmp_path):
+    path = tmp_path / "users.db"
+    latest = migrate(path)
+    assert migrate(path) == latest
@@ -0,0 +1,96 @@
+import asyncio
+import datetime
+
+from aiogram.types import Chat, Message, PhotoSize, Update, User
+
+import bench
+import bot
+
+
+def admin_message(message_id, **fields):
+    return Message(
+        message_id=message_id,
+        date=datetime.datetime.now(),
+        chat=Chat(id=bot.ADMIN_ID, type="private"),
+        from_user=User(id=bot.ADMIN_ID, is_bot=False, first_name="Админ"),
+        **fields
+    )
+
+
+def prepare(app, monkeypatch):
+    """Поддельный Bot API с именем бота и перехват запуска рассылки"""
+    app.bot.session = bench.FakeSession()
+
+    async def me():
+        return User(id=42, is_bot=True, first_name="Бот", username="MyBot")
+
+    started = []
+
+    async def start(text, chat_id, audience, media):
+        started.append((text, audience.describe(), media))
+        return None, 0
+
+    monkeypatch.setattr(app.bot, "me", me)
+    monkeypatch.setattr(app.broadcast_manager, "start", start)
+    return started
+
+
+def test_send_with_bot_mention(app, monkeypatch):
+    started = prepare(app, monkeypatch)
+    workplace = next(iter(app.catalog.workplaces))
+
+    async def scenario():
+        for message_id, text in enumerate((
+            f"/send@MyBot @{workplace} привет",
+            "/send@OtherBot не нам",
+        ), 1):
+            update = Update(update_id=message_id, message=admin_message(message_id, text=text))
+            await app.dp.feed_update(app.bot, update)
+
+    asyncio.run(scenario())
+    assert started == [("привет", bot.Audience([workplace]).describe(), None)]
+
+
+def test_album_caption_with_bot_mention(app, monkeypatch):
+    started = prepare(app, monkeypatch)
+    photo = [PhotoSize(file_id="p1", file_unique_id="u1", width=1, height=1)]
+    album = [
+        admin_message(1, media_group_id="g", photo=photo),
+        admin_message(2, media_group_id="g", photo=photo, caption="/send@MyBot отчёт"),
+    ]
+    asyncio.run(bot.send_album(app, [part.as_(app.bot) for part in album]))
+    assert started == [("отчёт", bot.Audience().describe(), [("photo", "p1"), ("photo", "p1")])]
+
+
+def test_two_apps_handle_updates_independently(app, tmp_path, monkeypatch):
+    other = bot.create_app(token="43:TEST", db_path=str(tmp_path / "other.db"))
+    asyncio.run(other.db.init_db())
+    try:
+        started = prepare(app, monkeypatch)
+        started_other = prepare(other, monkeypatch)
+
+        async def scenario():
+            for instance, text in ((app, "/send первому"), (other, "/send второму")):
+                update = Update(update_id=1, message=admin_message(1, text=text))
+                await instance.dp.feed_update(instance.bot, update)
+
+        asyncio.run(scenario())
+        assert [text for text, _, _ in started] == ["первому"]
+        assert [text for text, _, _ in started_other] == ["второму"]
+    finally:
+        asyncio.run(other.db_engine.close())
+
+
+def test_caption_limit_counts_broadcast_header(app, monkeypatch):
+    started = prepare(app, monkeypatch)
+    photo = [PhotoSize(file_id="p1", file_unique_id="u1", width=1, height=1)]
+    fits = bot.BROADCAST_CAPTION_LIMIT - len(bot.BROADCAST_HEADER)
+
+    async def scenario():
+        for text in ("я" * (fits + 1), "я" * fits):
+            message = admin_message(1, photo=photo, caption=f"/send {text}").as_(app.bot)
+            await bot.start_broadcast(app, message, text, [("photo", "p1")])
+
+    asyncio.run(scenario())
+    assert [len(text) for text, _, _ in started] == [fits]
+    assert app.bot.session.sent[0][2].startswith("❌ Сообщение слишком длинное")
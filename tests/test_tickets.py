@@ -0,0 +1,57 @@
+import asyncio
+
+import bench
+import bot
+
+
+def fast_send(app):
+    """Поддельный Bot API без пауз между сообщениями"""
+    session = app.bot.session = bench.FakeSession()
+    app.send_limiter.bucket = bot.TokenBucket(1_000_000)
+    app.send_limiter.chat_interval = 0
+    return session
+
+
+async def create_tickets(app, problem, count):
+    for user_id in range(1, count + 1):
+        await app.db.create_ticket(user_id, f"Сотрудник {user_id}", "Склад", problem, bot.ADMIN_ID)
+    return await app.db.claim_due_tickets(count)
+
+
+def ticket_messages(app):
+    return asyncio.run(app.db_engine.read(
+        lambda conn: conn.execute("SELECT status, admin_message_id FROM tickets ORDER BY id").fetchall()
+    ))
+
+
+def test_storm_is_coalesced_into_one_message(app):
+    session = fast_send(app)
+    aggregator = bot.TicketAggregator(app, window=60, edit_interval=0.05)
+
+    async def scenario():
+        for ticket in await create_tickets(app, "Принтер", 4):
+            await aggregator.deliver(bot.ADMIN_ID, ticket[:6])
+        await asyncio.sleep(0.2)
+        await aggregator.stop()
+
+    asyncio.run(scenario())
+    texts = [text for _, _, text in session.sent]
+    assert texts[0].startswith("🚨 Новая заявка #1!")
+    # Остальные три дописаны в то же сообщение одной правкой
+    assert len(texts) == 2
+    assert texts[1].startswith("🚨 Принтер — заявок: 4")
+    assert ticket_messages(app) == [("delivered", 1)] * 4
+
+
+def test_group_closes_after_window(app):
+    session = fast_send(app)
+    aggregator = bot.TicketAggregator(app, window=-1)
+
+    async def scenario():
+        for ticket in await create_tickets(app, "Принтер", 2):
+            await aggregator.deliver(bot.ADMIN_ID, ticket[:6])
+        await aggregator.stop()
+
+    asyncio.run(scenario())
+    assert [text.split("\n")[0] for _, _, text in session.sent] == ["🚨 Новая заявка #1!", "🚨 Новая заявка #2!"]
+    assert ticket_messages(app) == [("delivered", 1), ("delivered", 2)]
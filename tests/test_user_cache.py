@@ -0,0 +1,39 @@
+import asyncio
+
+import bot
+
+
+def test_fills_for_different_users_do_not_cancel_each_other():
+    cache = bot.UserCache()
+    first = cache.fill_token(1)
+    second = cache.fill_token(2)
+    cache.put(1, ("Иван", "Склад", 0), first)
+    cache.put(2, ("Пётр", "Склад", 0), second)
+    assert cache.get(1) == (True, ("Иван", "Склад", 0))
+    assert cache.get(2) == (True, ("Пётр", "Склад", 0))
+
+
+def test_write_to_same_user_discards_pending_fill():
+    cache = bot.UserCache()
+    token = cache.fill_token(1)
+    cache.invalidate(1)
+    cache.put(1, ("Иван", "Склад", 0), token)
+    assert cache.get(1) == (False, None)
+
+    token = cache.fill_token(1)
+    cache.set_blocked(1, 1)
+    cache.put(1, ("Иван", "Склад", 0), token)
+    assert cache.get(1) == (False, None)
+
+
+def test_concurrent_misses_are_all_cached(app):
+    workplace = next(iter(app.catalog.workplaces))
+
+    async def scenario():
+        for user_id in range(1, 6):
+            await app.db.save_user(user_id, f"Сотрудник {user_id}", workplace)
+        app.user_cache.clear()
+        await asyncio.gather(*(app.db.get_user(user_id) for user_id in range(1, 6)))
+
+    asyncio.run(scenario())
+    assert all(app.user_cache.get(user_id)[0] for user_id in range(1, 6))
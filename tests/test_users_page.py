@@ -0,0 +1,52 @@
+import asyncio
+
+import bot
+
+# 64 символа кириллицей — 128 байт, больше всей callback_data
+LONG_WORKPLACE = ("Бухгалтерия главного офиса: " * 3)[:64]
+
+
+def seed_users(app, count, workplace):
+    def insert(conn):
+        conn.executemany(
+            "INSERT INTO users (user_id, name, workplace) VALUES (?, ?, ?)",
+            [(user_id, f"Сотрудник {user_id}", workplace) for user_id in range(1, count + 1)]
+        )
+    asyncio.run(app.db_engine.write(insert))
+
+
+def buttons(keyboard):
+    return {button.text: button.callback_data for row in keyboard.inline_keyboard for button in row}
+
+
+def test_callback_data_fits_with_long_workplace():
+    data = bot.UsersPage(
+        action="n", cursor=2 ** 53, status="b", place=bot.workplace_key(LONG_WORKPLACE)
+    ).pack()
+    assert len(data.encode()) <= 64
+    assert bot.UsersPage.unpack(data).place == bot.workplace_key(LONG_WORKPLACE)
+
+
+def test_pages_through_long_cyrillic_workplace(app):
+    seed_users(app, bot.USERS_PAGE_SIZE * 2 + 5, LONG_WORKPLACE)
+
+    async def scenario():
+        text, keyboard = await bot.render_users_page(app, "a", LONG_WORKPLACE)
+        assert LONG_WORKPLACE in text
+        forward = buttons(keyboard)["Вперёд ▶️"]
+        assert len(forward.encode()) <= 64
+
+        page = bot.UsersPage.unpack(forward)
+        # Места нет в справочнике — ключ находится по сводке workplace_stats
+        workplace = await bot.resolve_workplace_key(app, page.place)
+        assert workplace == LONG_WORKPLACE
+        text, keyboard = await bot.render_users_page(app, page.status, workplace, after=page.cursor)
+        assert f"(ID: {bot.USERS_PAGE_SIZE + 1})" in text
+        assert "◀️ Назад" in buttons(keyboard)
+
+    asyncio.run(scenario())
+
+
+def test_unknown_workplace_key_is_not_resolved(app):
+    assert asyncio.run(bot.resolve_workplace_key(app, "deadbeef")) is None
+    assert asyncio.run(bot.resolve_workplace_key(app, "")) == ""
@@ -0,0 +1,53 @@
+import asyncio
+
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+import bot
+
+UPDATE = {
+    "update_id": 1,
+    "message": {"message_id": 1, "date": 0, "chat": {"id": 5, "type": "private"}, "text": "hi"},
+}
+
+
+def post_updates(app, requests, accept=True):
+    """Прогоняет запросы (заголовки, тело) через WebhookServer; возвращает статусы и принятые update_id"""
+    submitted = []
+
+    def submit(update):
+        if accept:
+            submitted.append(update.update_id)
+        return accept
+
+    server = bot.WebhookServer(app.bot, "s3cret", submit)
+    web_app = web.Application()
+    web_app.router.add_post(server.path, server.handle)
+
+    async def scenario():
+        async with TestClient(TestServer(web_app)) as client:
+            statuses = []
+            for headers, body in requests:
+                response = await client.post(server.path, json=body, headers=headers)
+                statuses.append(response.status)
+            return statuses
+
+    return asyncio.run(scenario()), submitted
+
+
+def test_webhook_rejects_bad_secret(app):
+    statuses, submitted = post_updates(app, [
+        ({}, UPDATE),
+        ({"X-Telegram-Bot-Api-Secret-Token": "wrong"}, UPDATE),
+        ({"X-Telegram-Bot-Api-Secret-Token": "s3cret"}, UPDATE),
+    ])
+    assert statuses == [401, 401, 200]
+    assert submitted == [1]
+
+
+def test_webhook_asks_to_retry_when_queues_are_full(app):
+    statuses, _ = post_updates(app, [
+        ({"X-Telegram-Bot-Api-Secret-Token": "s3cret"}, {"update_id": "нет"}),
+        ({"X-Telegram-Bot-Api-Secret-Token": "s3cret"}, UPDATE),
+    ], accept=False)
+    assert statuses == [400, 503]
@@ -0,0 +1,140 @@
+import asyncio
+
+from aiogram.methods import GetUpdates
+
+import bot
+
+
+def test_bulk_changes_reach_cache_of_other_process(app, tmp_path):
+    # Второй экземпляр на той же базе — как обработчик в другом процессе
+    worker = bot.create_app(token="43:TEST", db_path=str(tmp_path / "bot.db"))
+    worker.db.sync_interval = 0
+    workplace = next(iter(app.catalog.workplaces))
+
+    async def scenario():
+        await worker.db.save_user(1, "Иван", workplace)
+        await worker.db.save_user(2, "Пётр", workplace)
+        assert await worker.db.get_user(1) == ("Иван", workplace, 0)
+
+        await app.db.import_users([(1, "Иван Петров", workplace, None)])
+        assert await worker.db.get_user(1) == ("Иван Петров", workplace, 0)
+
+        await app.db.mark_users_blocked([2])
+        assert await worker.db.get_user(2) == ("Пётр", workplace, 1)
+        assert await app.db.delete_blocked_users() == 1
+        assert await worker.db.get_user(2) is None
+
+        # Свои массовые правки кэш процесса не сбрасывают
+        await worker.db.get_user(1)
+        await worker.db.mark_users_blocked([3])
+        hits = worker.user_cache.hits
+        await worker.db.get_user(1)
+        assert worker.user_cache.hits == hits + 1
+
+    try:
+        asyncio.run(scenario())
+    finally:
+        asyncio.run(worker.db_engine.close())
+
+
+def test_secondary_worker_leaves_broadcast_to_primary(app):
+    workplace = next(iter(app.catalog.workplaces))
+
+    async def scenario():
+        await app.db.save_user(1, "Иван", workplace)
+        app.broadcast_manager.runs_jobs = False
+        job, total = await app.broadcast_manager.start("привет", bot.ADMIN_ID, bot.Audience())
+        app.broadcast_manager.launch(job)
+        assert total == 1 and not app.broadcast_manager.jobs
+        assert [row[0] for row in await app.db.get_unfinished_broadcasts()] == [job.id]
+
+    asyncio.run(scenario())
+
+
+def make_update(update_id, chat_id=5):
+    return bot.types.Update.model_validate({
+        "update_id": update_id,
+        "message": {"message_id": update_id, "date": 0, "chat": {"id": chat_id, "type": "private"}, "text": "hi"},
+    })
+
+
+def test_only_updates_never_started_survive_restart(app):
+    class SlowDispatcher:
+        started = []
+
+        async def feed_update(self, bot_, update):
+            self.started.append(update.update_id)
+            await asyncio.sleep(60)
+
+    async def scenario():
+        pool = bot.UpdatePool(SlowDispatcher(), app.bot, workers=1)
+        pool.start()
+        for update_id in (3, 1, 2):
+            assert pool.submit(make_update(update_id))
+        await pool.stop(timeout=0.05, deadline=0.05)
+        # Начатое (3) прервано и повторно не запускается, ждавшие в очереди — по порядку update_id
+        assert SlowDispatcher.started == [3]
+        await app.db.save_pending_updates(pool.leftovers())
+
+        restored = []
+        await bot.restore_pending_updates(app, lambda u: restored.append(u.update_id) or True)
+        assert restored == [1, 2]
+        assert await app.db.take_pending_updates() == []
+
+    asyncio.run(scenario())
+
+
+def test_started_handler_finishes_after_drain_timeout(app):
+    class Dispatcher:
+        finished = []
+
+        async def feed_update(self, bot_, update):
+            await asyncio.sleep(0.2)
+            self.finished.append(update.update_id)
+
+    async def scenario():
+        pool = bot.UpdatePool(Dispatcher(), app.bot, workers=1)
+        pool.start()
+        assert pool.submit(make_update(1))
+        assert pool.submit(make_update(2))
+        await asyncio.sleep(0)
+        await pool.stop(timeout=0.05, deadline=5)
+        return pool.leftovers()
+
+    leftovers = asyncio.run(scenario())
+    assert Dispatcher.finished == [1]
+    assert [bot.types.Update.model_validate_json(payload).update_id for payload in leftovers] == [2]
+
+
+def test_polling_survives_api_errors(app, monkeypatch):
+    method = GetUpdates()
+    responses = [
+        bot.TelegramConflictError(method=method, message="Conflict: terminated by other getUpdates request"),
+        bot.TelegramRetryAfter(method=method, message="Too Many Requests", retry_after=0),
+        [make_update(1)],
+    ]
+    stopping = asyncio.Event()
+
+    async def get_updates(**kwargs):
+        if not responses:
+            stopping.set()
+            await asyncio.sleep(60)
+        response = responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    async def delete_webhook():
+        return True
+
+    monkeypatch.setattr(app.bot, "get_updates", get_updates)
+    monkeypatch.setattr(app.bot, "delete_webhook", delete_webhook)
+    submitted = []
+
+    async def scenario():
+        return await bot.poll_updates(
+            app.bot, lambda update: submitted.append(update.update_id) or True, None, stopping
+        )
+
+    assert asyncio.run(scenario()) == 2
+    assert submitted == [1]